@@ -3,14 +3,31 @@
 # 支援代理間回饋循環與資訊共享機制
 # pip install pymongo[srv] sentence-transformers sqlalchemy psycopg2-binary python-dotenv openai
 
-import os, json, re, math
-from typing import List, Dict, Any, Tuple, Optional
+import os, json, re, math, time, asyncio
+from typing import List, Dict, Any, Tuple, Optional, Union, TYPE_CHECKING
 from dataclasses import dataclass
+from decimal import Decimal
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text, inspect
 from sqlalchemy.engine import Engine
-from pymongo import MongoClient
-import certifi
+from schema_catalog import SchemaCatalog
+from embedding_service import embed_query
+from mongo_pool import get_collection
+from vector_index import get_local_index
+from hybrid_search import get_hybrid_searcher
+from schema_linker import SchemaLinker
+from plan_cache import PlanCache
+from context_packer import ContextPacker, pack_references, add_schema, add_samples
+from llm_cache import LLMCache
+from result_stream import iter_result, consume
+from sql_preflight import SqlPreflight, PREFLIGHT_ENABLED, apply_statement_timeout
+from sql_analyzer import analyze_sql
+from index_advisor import WorkloadLog, WORKLOAD_LOG_ENABLED
+
+if TYPE_CHECKING:
+    from columnar_result import ColumnarResult
+    from result_cache import ResultCache
+    from duckdb_backend import DuckDbAgent
 
 # ---------- Agent Communication Protocol ----------
 @dataclass
@@ -28,9 +45,11 @@ class PipelineContext:
     user_query: str
     reference_context: str = ""
     db_overview: Dict[str, Any] = None
+    linked_overview: Dict[str, Any] = None  # schema linking 後只含相關表/欄位的 db_overview
     rewritten_query: Dict[str, Any] = None
     table_plan: Dict[str, Any] = None
-    processed_data: List[Dict[str, Any]] = None
+    processed_data: Union[List[Dict[str, Any]], "ColumnarResult"] = None
+    result_summary: Dict[str, Any] = None   # 串流模式下的累計統計（processed_data 僅為預覽）
     sql_query: str = ""
     analysis_result: str = ""
     agent_messages: List[AgentMessage] = None
@@ -38,19 +57,40 @@ class PipelineContext:
     def __post_init__(self):
         if self.agent_messages is None:
             self.agent_messages = []
+    
+    def schema_view(self) -> Dict[str, Any]:
+        """給代理 prompt 使用的 schema：有 linking 結果時用之，否則為完整 db_overview"""
+        return self.linked_overview or self.db_overview
+    
+    def row_count(self) -> int:
+        """結果總列數；串流模式下取自累計統計而非預覽長度"""
+        if self.result_summary:
+            return self.result_summary.get("row_count", 0)
+        return len(self.processed_data) if self.processed_data else 0
 
 # ---------- Load env ----------
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+RESULT_MODE = os.getenv("RESULT_MODE", "buffered")   # buffered | stream
+STREAM_PREVIEW_ROWS = int(os.getenv("STREAM_PREVIEW_ROWS", "50"))
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "rows")   # rows | columnar (pyarrow)
+SCHEMA_LINKING = os.getenv("SCHEMA_LINKING", "1") != "0"
+PLAN_CACHE_ENABLED = os.getenv("PLAN_CACHE", "1") != "0"
+DB_BACKEND = os.getenv("DB_BACKEND", "postgres")   # postgres (Neon) | duckdb (本地 Parquet)
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") != "0"
 
 PG_URI  = os.getenv("PG_URI")
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB  = os.getenv("MONGO_DB", "ragdb")
 MONGO_COL = os.getenv("MONGO_COL", "cards")
 MONGO_VECTOR_INDEX = os.getenv("MONGO_VECTOR_INDEX", "cards_env")
+REF_SEARCH_MODE = os.getenv("REF_SEARCH_MODE", "atlas")   # atlas | local | hybrid
 
-if not PG_URI:
+if DB_BACKEND not in ("postgres", "duckdb"):
+    raise RuntimeError(f"Unknown DB_BACKEND: {DB_BACKEND} (postgres | duckdb)")
+if DB_BACKEND == "postgres" and not PG_URI:
     raise RuntimeError("PG_URI is required (Neon connection string).")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is required.")
@@ -58,42 +98,96 @@ if not MONGO_URI:
     print("[warn] MONGO_URI not set; reference retrieval will be disabled.")
 
 # ---------- OpenAI client ----------
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 oai = OpenAI(api_key=OPENAI_API_KEY)
+aoai = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# 重複問題直接由快取回應，不呼叫 API（LLM_CACHE=0 可停用）
+llm_cache: Optional[LLMCache] = LLMCache() if LLM_CACHE_ENABLED else None
 
-def chat(messages, model=OPENAI_CHAT_MODEL, temperature=0.1, max_tokens=800):
+def chat(messages, model=OPENAI_CHAT_MODEL, temperature=0.1, max_tokens=800, use_cache=True,
+         semantic_key: Optional[str] = None):
+    """semantic_key：prompt 中的使用者問題，語意快取只比對這段文字"""
+    if use_cache and llm_cache is not None:
+        cached = llm_cache.get(model, messages, temperature, max_tokens, semantic_key)
+        if cached is not None:
+            return cached
     resp = oai.chat.completions.create(
         model=model,
         messages=messages,
         temperature=temperature,
         max_tokens=max_tokens,
     )
-    return resp.choices[0].message.content.strip()
+    out = resp.choices[0].message.content.strip()
+    if use_cache and llm_cache is not None:
+        llm_cache.put(model, messages, temperature, max_tokens, out, semantic_key)
+    return out
+
+async def achat(messages, model=OPENAI_CHAT_MODEL, temperature=0.1, max_tokens=800, use_cache=True,
+                semantic_key: Optional[str] = None):
+    """chat() 的 asyncio 版本（AsyncOpenAI），共用同一個回應快取"""
+    if use_cache and llm_cache is not None:
+        cached = await asyncio.to_thread(llm_cache.get, model, messages, temperature, max_tokens, semantic_key)
+        if cached is not None:
+            return cached
+    resp = await aoai.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
+    out = resp.choices[0].message.content.strip()
+    if use_cache and llm_cache is not None:
+        await asyncio.to_thread(llm_cache.put, model, messages, temperature, max_tokens, out, semantic_key)
+    return out
+
+# 同模板（只差日期/國別/VIP 參數）的問題重新綁定已驗證的 SQL（PLAN_CACHE=0 可停用）
+plan_cache: Optional[PlanCache] = PlanCache() if PLAN_CACHE_ENABLED else None
 
 # ---------- Postgres engine ----------
-pg_engine: Engine = create_engine(PG_URI, pool_pre_ping=True)
+# DB_BACKEND=duckdb 時不建立 Postgres 連線，結果快取與 EXPLAIN 檢查也只適用於 Postgres
+pg_engine: Optional[Engine] = create_engine(PG_URI, pool_pre_ping=True) if DB_BACKEND == "postgres" else None
+
+# 相同 SQL 的結果以 Parquet 快取，資料表有寫入/重新載入時失效（RESULT_CACHE=0 可停用）
+result_cache: Optional["ResultCache"] = None
+if RESULT_CACHE_ENABLED and pg_engine is not None:
+    from result_cache import ResultCache
+    result_cache = ResultCache(pg_engine)
+
+# 執行前 EXPLAIN：規劃錯誤提早失敗、超過成本上限的查詢交回改寫或拒絕（PREFLIGHT=0 可停用）
+sql_preflight: Optional[SqlPreflight] = SqlPreflight() if PREFLIGHT_ENABLED and pg_engine is not None else None
+
+# 實際送到資料庫的 SQL 與耗時，供 index_advisor.py 探勘（WORKLOAD_LOG=0 可停用）
+workload_log: Optional[WorkloadLog] = WorkloadLog() if WORKLOAD_LOG_ENABLED else None
 
 # ---------- Mongo (reference) ----------
 def mongo_cards_collection():
     if not MONGO_URI:
         return None
-    client = MongoClient(MONGO_URI, tls=True, tlsCAFile=certifi.where())
-    return client[MONGO_DB][MONGO_COL]
+    return get_collection(MONGO_DB, MONGO_COL, uri=MONGO_URI)
 
-def reference_search(query: str, k: int = 6) -> List[Dict[str, Any]]:
+def reference_search(query: str, k: int = 6, mode: str = None,
+                     card_type: Optional[str] = None) -> List[Dict[str, Any]]:
     """
-    Vector search over Mongo Atlas Vector Search ($vectorSearch).
+    Reference retrieval over the cards collection.
+    mode: atlas = Mongo Atlas Vector Search ($vectorSearch)；local = 本地 memory-mapped 向量索引
+    （依 updatedAt 增量同步）；hybrid = 本地 BM25 + 向量以 RRF 融合（card_type 於評分前過濾）。
+    Atlas 失敗時退回本地索引。
     Returns list of {title, type, text, meta, score}
     """
+    mode = mode or REF_SEARCH_MODE
+    if mode == "hybrid":
+        return hybrid_reference_search(query, k, card_type)
+    if mode == "local":
+        return local_vector_search(query, k, card_type)
+
     col = mongo_cards_collection()
     if col is None:
-        return []
+        return local_vector_search(query, k, card_type)
     
     try:
         # 使用 $vectorSearch 前提：你已建立 Vector 索引，field=embedding(384, cosine)
-        from sentence_transformers import SentenceTransformer
-        model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-        qv = model.encode([query], normalize_embeddings=True)[0].tolist()
+        qv = embed_query(query)
 
         pipeline = [
             {
@@ -102,7 +196,9 @@ def reference_search(query: str, k: int = 6) -> List[Dict[str, Any]]:
                     "path": "embedding",
                     "queryVector": qv,
                     "numCandidates": max(100, k*20),
-                    "limit": k
+                    "limit": k,
+                    # type 過濾需在 Atlas 索引中把 type 設為 filter 欄位
+                    **({"filter": {"type": card_type}} if card_type else {})
                 }
             },
             {"$project": {
@@ -112,22 +208,27 @@ def reference_search(query: str, k: int = 6) -> List[Dict[str, Any]]:
         ]
         return list(col.aggregate(pipeline))
     except Exception as e:
-        print(f"[warn] MongoDB vector search failed: {e}")
-        return []
+        print(f"[warn] MongoDB vector search failed, using local index: {e}")
+        return local_vector_search(query, k, card_type)
+
+def local_vector_search(query: str, k: int = 6, card_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    """本地向量索引 top-k；有 Mongo 連線時先做增量同步，沒有時直接使用已持久化的索引"""
+    index = get_local_index()
+    index.maybe_sync(mongo_cards_collection())
+    return index.search(embed_query(query), k=k, card_type=card_type)
+
+def hybrid_reference_search(query: str, k: int = 6, card_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    """BM25（精確欄位名如 VipLV、LoginDate）+ 向量，以 reciprocal-rank fusion 合併"""
+    searcher = get_hybrid_searcher()
+    searcher.index.maybe_sync(mongo_cards_collection())
+    return searcher.search(query, embed_query(query), k=k, card_type=card_type)
 
 # ---------- Utility ----------
 def clamp(n, lo, hi): return max(lo, min(hi, n))
 
-def build_ref_context(cards: List[Dict[str, Any]], max_chars: int = 9000) -> str:
-    """Turn retrieved cards into a compact context string."""
-    out = []
-    used = 0
-    for d in cards:
-        block = f"# {d.get('title','')}\n[type={d.get('type','')}] score={round(float(d.get('score',0)),4)}\n{d.get('text','')}\n"
-        if used + len(block) > max_chars:
-            break
-        out.append(block); used += len(block)
-    return "\n---\n".join(out)
+def build_ref_context(cards: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> str:
+    """Turn retrieved cards into a compact context string (token budget: PROMPT_BUDGET_REFERENCES)."""
+    return pack_references(cards, max_tokens)
 
 def allowlist_from_pg(engine: Engine) -> Dict[str, List[str]]:
     """Fallback allowlist by introspecting PG public schema."""
@@ -142,56 +243,98 @@ def allowlist_from_pg(engine: Engine) -> Dict[str, List[str]]:
 class DbAgent:
     """負責與 PostgreSQL 互動，提供資料庫結構資訊與資料擷取"""
     
-    def __init__(self, engine: Engine):
+    def __init__(self, engine: Engine, catalog: Optional[SchemaCatalog] = None,
+                 result_cache: Optional["ResultCache"] = None, preflight: Optional[SqlPreflight] = None,
+                 workload_log: Optional[WorkloadLog] = None):
         self.engine = engine
         self.name = "DbAgent"
+        self.catalog = catalog or SchemaCatalog(engine)
+        self.result_cache = result_cache
+        self.preflight = preflight
+        self.workload_log = workload_log
     
-    def scan_schema(self, sample_rows: int = 5) -> Dict[str, Any]:
-        """掃描資料庫結構並提供樣本資料"""
-        insp = inspect(self.engine)
-        info: Dict[str, Any] = {
-            "tables": [],
-            "scan_timestamp": math.floor(os.times().elapsed * 1000),
-            "total_tables": 0
-        }
-        
-        table_names = insp.get_table_names(schema="public")
-        info["total_tables"] = len(table_names)
-        
-        for t in table_names:
-            cols = insp.get_columns(t, schema="public")
-            col_defs = [{"name": c["name"], "type": str(c["type"])} for c in cols]
-
-            # 取得樣本資料
-            with self.engine.begin() as conn:
-                try:
-                    rows = conn.execute(text(f'SELECT * FROM public."{t}" LIMIT :n'), {"n": sample_rows}).mappings().all()
-                    rows = [dict(r) for r in rows]
-                    row_count = conn.execute(text(f'SELECT COUNT(*) as cnt FROM public."{t}"')).scalar()
-                except Exception as e:
-                    rows = []
-                    row_count = 0
-                    
-            info["tables"].append({
-                "name": t, 
-                "columns": col_defs, 
-                "sample": rows,
-                "total_rows": row_count
-            })
-        return info
+    def scan_schema(self, sample_rows: int = 5, refresh: bool = False) -> Dict[str, Any]:
+        """掃描資料庫結構並提供樣本資料（經由 schema catalog 快取，列數為 reltuples 估計值）"""
+        return self.catalog.get(sample_rows=sample_rows, force=refresh)
+    
+    def _prepare(self, conn, sql: str):
+        """在執行查詢的交易內設定 statement_timeout 並做 EXPLAIN 檢查；失敗時拋出例外，查詢不會被執行"""
+        apply_statement_timeout(conn)
+        if self.preflight is not None:
+            self.preflight.check(conn, sql)
+    
+    def _record(self, sql: str, started: float, rows: Optional[int] = None, error: str = "", mode: str = "buffered"):
+        """記錄一次資料庫執行（不含快取命中）的耗時"""
+        if self.workload_log is not None:
+            self.workload_log.record(sql, (time.perf_counter() - started) * 1000, rows=rows, error=error, mode=mode)
     
     def execute_query(self, sql: str, max_rows: int = 20000) -> Tuple[List[Dict[str, Any]], str]:
         """安全執行 SQL 查詢"""
         if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
             return [], "Refused: not a SELECT/WITH statement."
+        cached, token = self.result_cache.lookup(sql, max_rows) if self.result_cache else (None, None)
+        if cached is not None:
+            return cached.to_pylist(), ""
+        started = time.perf_counter()
         try:
             with self.engine.begin() as conn:
+                self._prepare(conn, sql)
                 res = conn.execute(text(sql))
                 rows = res.mappings().fetchmany(size=max_rows)
                 rows = [dict(r) for r in rows]
+            self._record(sql, started, rows=len(rows))
+            if token is not None:
+                self.result_cache.store_rows(token, rows)
             return rows, ""
         except Exception as e:
-            return [], f"{type(e).__name__}: {e}"
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error)
+            return [], error
+    
+    def execute_query_columnar(self, sql: str, max_rows: int = 20000) -> Tuple[Optional["ColumnarResult"], str]:
+        """安全執行 SQL 查詢，結果以 pyarrow 欄式表回傳"""
+        from columnar_result import ColumnarResult
+        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
+            return None, "Refused: not a SELECT/WITH statement."
+        cached, token = self.result_cache.lookup(sql, max_rows) if self.result_cache else (None, None)
+        if cached is not None:
+            return ColumnarResult(cached), ""
+        started = time.perf_counter()
+        try:
+            with self.engine.begin() as conn:
+                self._prepare(conn, sql)
+                result = ColumnarResult.from_result(conn.execute(text(sql)), max_rows=max_rows)
+            self._record(sql, started, rows=len(result), mode="columnar")
+            if token is not None:
+                self.result_cache.store(token, result.table)
+            return result, ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error, mode="columnar")
+            return None, error
+    
+    def execute_query_stream(self, sql: str, row_pipeline=None, preview_rows: int = STREAM_PREVIEW_ROWS,
+                             max_rows: Optional[int] = None,
+                             batch_size: int = 2000) -> Tuple[List[Dict[str, Any]], Dict[str, Any], str]:
+        """以 server-side cursor 串流執行 SQL，只保留預覽列並計算累計統計"""
+        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
+            return [], {}, "Refused: not a SELECT/WITH statement."
+        started = time.perf_counter()
+        try:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(stream_results=True, max_row_buffer=batch_size)
+                with conn.begin():
+                    self._prepare(conn, sql)
+                    rows = iter_result(conn.execute(text(sql)), batch_size=batch_size, max_rows=max_rows)
+                    if row_pipeline is not None:
+                        rows = row_pipeline(rows)
+                    preview, summary = consume(rows, preview_rows=preview_rows)
+            self._record(sql, started, rows=summary.get("row_count"), mode="stream")
+            return preview, summary, ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error, mode="stream")
+            return [], {}, error
     
     def get_table_stats(self, table_name: str) -> Dict[str, Any]:
         """取得特定資料表的統計資訊"""
@@ -247,31 +390,44 @@ Return ONLY valid JSON (no markdown, no extra text):
     
     def rewrite_query(self, context: PipelineContext) -> Dict[str, Any]:
         """改寫使用者查詢"""
-        # 提取詳細的 schema 信息
+        return self.parse_rewrite(chat(**self.rewrite_request(context)), context)
+    
+    def _schema_summary(self, context: PipelineContext) -> Dict[str, List[str]]:
+        """提取詳細的 schema 信息"""
         schema_summary = {}
         if context.db_overview and "tables" in context.db_overview:
             for table in context.db_overview["tables"]:
                 schema_summary[table["name"]] = [col["name"] for col in table["columns"]]
-        
+        return schema_summary
+    
+    def rewrite_request(self, context: PipelineContext) -> Dict[str, Any]:
+        """組出改寫查詢的 chat() 參數"""
+        # schema 與樣本列依 token 預算打包，與查詢最相關的表優先保留
+        packer = ContextPacker()
+        add_schema(packer, context.schema_view(), context.user_query)
+        add_samples(packer, context.schema_view(), context.user_query)
         prompt = f"""<reference>
 {context.reference_context}
 </reference>
 <query>{context.user_query}</query>
 <actual_db_schema>
-Available tables and their columns:
-{json.dumps(schema_summary, ensure_ascii=False, indent=2)}
+Available tables and their columns, as Table(col1, col2, ...):
+{packer.render("schema")}
 </actual_db_schema>
 <schema_details>
-{json.dumps(context.db_overview.get('tables', [])[:5], ensure_ascii=False) if context.db_overview else '{}'}
+Sample rows per table:
+{packer.render("samples")}
 </schema_details>
 IMPORTANT: Only reference tables and columns that exist in the actual_db_schema above.
 Follow the system rules and output JSON only."""
         
-        out = chat([
+        return {"messages": [
             {"role":"system","content":self.system_prompt},
             {"role":"user","content":prompt}
-        ], max_tokens=600)
-        
+        ], "max_tokens": 600, "semantic_key": context.user_query}
+    
+    def parse_rewrite(self, out: str, context: PipelineContext) -> Dict[str, Any]:
+        """解析改寫結果；非 JSON 時回退為原始查詢"""
         try:
             result = json.loads(out)
             # 添加代理資訊
@@ -281,6 +437,7 @@ Follow the system rules and output JSON only."""
             }
             return result
         except Exception as e:
+            schema_summary = self._schema_summary(context)
             return {
                 "goal": context.user_query, 
                 "available_tables": list(schema_summary.keys()),
@@ -294,6 +451,9 @@ Follow the system rules and output JSON only."""
     
     def refine_query(self, context: PipelineContext, feedback: Dict[str, Any]) -> Dict[str, Any]:
         """根據回饋精煉查詢"""
+        return self.parse_refine(chat(**self.refine_request(context, feedback)), context)
+    
+    def refine_request(self, context: PipelineContext, feedback: Dict[str, Any]) -> Dict[str, Any]:
         refinement_prompt = f"""
 Original query: {context.user_query}
 Previous rewrite: {json.dumps(context.rewritten_query, ensure_ascii=False)}
@@ -302,11 +462,12 @@ Feedback from downstream agents: {json.dumps(feedback, ensure_ascii=False)}
 Please refine the query based on the feedback. Output JSON only.
 """
         
-        out = chat([
+        return {"messages": [
             {"role":"system","content":self.system_prompt + "\nYou are now refining based on feedback."},
             {"role":"user","content":refinement_prompt}
-        ], max_tokens=400)
-        
+        ], "max_tokens": 400, "semantic_key": context.user_query}
+    
+    def parse_refine(self, out: str, context: PipelineContext) -> Dict[str, Any]:
         try:
             result = json.loads(out)
             result["refined"] = True
@@ -350,19 +511,35 @@ Return STRICT JSON with schema validation:
     
     def decide_tables(self, context: PipelineContext) -> Dict[str, Any]:
         """決定需要使用的資料表"""
+        return self.parse_plan(chat(**self.decide_request(context)))
+    
+    def decide_request(self, context: PipelineContext) -> Dict[str, Any]:
+        intent = json.dumps(context.rewritten_query, ensure_ascii=False)
+        # 改寫結果中點名的表優先；其餘依與查詢/意圖的相關度在預算內保留
+        pinned = (context.rewritten_query or {}).get("available_tables") or []
+        packer = ContextPacker()
+        schema = context.schema_view()
+        add_schema(packer, schema, f"{context.user_query} {intent}", with_types=True, pinned=pinned)
+        add_samples(packer, schema, f"{context.user_query} {intent}", rows_per_table=1, pinned=pinned)
+        join_hints = json.dumps(schema.get("join_hints", []) if schema else [], ensure_ascii=False)
         prompt = f"""<intent_json>
-{json.dumps(context.rewritten_query, ensure_ascii=False)}
+{intent}
 </intent_json>
 <db_overview>
-{json.dumps(context.db_overview, ensure_ascii=False)}
+Tables as Table(column type, ...) -- approximate row count:
+{packer.render("schema")}
+Sample rows:
+{packer.render("samples")}
+Join hints (shared key columns): {join_hints}
 </db_overview>
 Output the strict JSON schema specified by the system."""
         
-        out = chat([
+        return {"messages": [
             {"role":"system","content":self.system_prompt},
             {"role":"user","content":prompt}
-        ], max_tokens=900)
-        
+        ], "max_tokens": 900}
+    
+    def parse_plan(self, out: str) -> Dict[str, Any]:
         # 清理可能的 markdown 包裝
         clean_out = out.strip()
         if clean_out.startswith("```json"):
@@ -436,20 +613,35 @@ CONSTRAINTS:
 - Prefer simple aggregates for trend (GROUP BY day integer).
 - Add meaningful column aliases for better readability.
 - IMPORTANT: Always wrap table names and column names with double quotes for PostgreSQL (e.g., FROM public."TableName", SELECT "ColumnName").
+- If <rollups> lists a daily rollup that can answer the question (filters and groups only on its date column and dimensions, needs only its counts/sums), query the rollup instead of its source table.
 Return the SQL only.
 """
     
     def generate_sql(self, context: PipelineContext, error_feedback: str = "") -> str:
         """根據計畫生成SQL語句，支援錯誤回饋修正"""
+        return self.clean_sql(chat(**self.sql_request(context, error_feedback)), context)
+    
+    def sql_request(self, context: PipelineContext, error_feedback: str = "") -> Dict[str, Any]:
+        plan = json.dumps(context.table_plan, ensure_ascii=False)
+        # 計畫中的表一定保留，其他表在 schema 預算內作為修正參考
+        pinned = [t.get("name") for t in (context.table_plan or {}).get("tables", [])]
+        packer = ContextPacker()
+        add_schema(packer, context.schema_view(), f"{context.user_query} {plan} {error_feedback}", pinned=pinned)
         base_prompt = f"""<plan>
-{json.dumps(context.table_plan, ensure_ascii=False)}
+{plan}
 </plan>
 <original_query>
 {context.user_query}
 </original_query>
 <db_schema_detail>
-{json.dumps([{"name": t["name"], "columns": [c["name"] for c in t["columns"]]} for t in context.db_overview.get("tables", [])], ensure_ascii=False)}
+{packer.render("schema")}
 </db_schema_detail>"""
+        rollups = self.rollup_hints(context, pinned)
+        if rollups:
+            base_prompt += f"""
+<rollups>
+{rollups}
+</rollups>"""
 
         if error_feedback:
             prompt = f"""{base_prompt}
@@ -465,11 +657,30 @@ Generate corrected SQL now."""
             prompt = f"""{base_prompt}
 Generate the SQL now."""
         
-        sql = chat([
+        return {"messages": [
             {"role":"system","content":self.system_prompt},
             {"role":"user","content":prompt}
-        ], max_tokens=600)
-        
+        ], "max_tokens": 600, "semantic_key": context.user_query}
+    
+    @staticmethod
+    def rollup_hints(context: PipelineContext, plan_tables: List[str]) -> str:
+        """計畫中來源表（未有計畫時為全部）對應的每日彙總表，附上可用的維度與量測"""
+        lines = []
+        for t in (context.db_overview or {}).get("tables", []):
+            r = t.get("rollup")
+            if not r or (plan_tables and r["source"] not in plan_tables):
+                continue
+            measures = ", ".join(f"{k}={v}" for k, v in r["measures"].items())
+            lines.append(f'"{t["name"]}" <- "{r["source"]}" (~{t.get("total_rows", 0)} rows): '
+                         f'one row per {r["date_column"]} ({r.get("date_type", "day")}) x {", ".join(r["dimensions"]) or "-"}; '
+                         f'measures: {measures}')
+        if lines:
+            lines.append("user_count is distinct per day and group: do not SUM it for unique users over a "
+                         "period; rows with a NULL date are not in rollups; questions needing other columns, "
+                         "joins or row-level detail must use the source.")
+        return "\n".join(lines)
+    
+    def clean_sql(self, sql: str, context: PipelineContext) -> str:
         # 清理 markdown 格式
         sql = sql.strip()
         if sql.startswith("```sql"):
@@ -494,6 +705,28 @@ Generate the SQL now."""
     def execute_and_process(self, context: PipelineContext) -> Tuple[List[Dict[str, Any]], str]:
         """執行SQL並處理結果資料"""
         sql = context.sql_query
+        
+        # 離線檢查（唯讀 + 識別字對照 schema catalog）；不合格的 SQL 不送到資料庫，錯誤直接回饋重試
+        validation = self.validate_sql(sql, context.db_overview)
+        if not validation["valid"]:
+            return [], validation["error"]
+        
+        if RESULT_MODE == "stream":
+            # 串流模式：後處理以 generator 串接，只保留預覽列與累計統計
+            preview, summary, error = self.db_agent.execute_query_stream(
+                sql, row_pipeline=lambda rows: (self._process_row(r) for r in rows))
+            if error:
+                return [], error
+            context.result_summary = summary
+            return preview, ""
+        
+        if RESULT_FORMAT == "columnar":
+            # 欄式模式：Decimal/日期轉換以 pyarrow 向量化完成
+            table, error = self.db_agent.execute_query_columnar(sql)
+            if error:
+                return [], error
+            return table.post_process(), ""
+        
         rows, error = self.db_agent.execute_query(sql)
         
         if error:
@@ -507,49 +740,28 @@ Generate the SQL now."""
         """對查詢結果進行後處理"""
         if not rows:
             return rows
-        
-        processed = []
-        for row in rows:
-            processed_row = {}
-            for key, value in row.items():
-                # 處理 Decimal 類型
-                from decimal import Decimal
-                if isinstance(value, Decimal):
-                    value = float(value)
-                
-                # 日期格式轉換
-                if key.lower().find('date') != -1 and isinstance(value, int) and len(str(value)) == 8:
-                    processed_row[key] = value
-                    processed_row[f"{key}_formatted"] = f"{str(value)[:4]}-{str(value)[4:6]}-{str(value)[6:8]}"
-                else:
-                    processed_row[key] = value
-            processed.append(processed_row)
-        
-        return processed
-    
-    def validate_sql(self, sql: str) -> Dict[str, Any]:
-        """驗證SQL語句的安全性和正確性"""
-        validation = {
-            "safe": True,
-            "issues": [],
-            "warnings": []
-        }
-        
-        # 基本安全檢查
-        dangerous_keywords = ['drop', 'delete', 'insert', 'update', 'alter', 'truncate', 'create']
-        sql_lower = sql.lower()
-        
-        for keyword in dangerous_keywords:
-            if keyword in sql_lower:
-                validation["safe"] = False
-                validation["issues"].append(f"Dangerous keyword detected: {keyword}")
-        
-        # 檢查是否為 SELECT 語句
-        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
-            validation["safe"] = False
-            validation["issues"].append("Not a SELECT or WITH statement")
-        
-        return validation
+        return [self._process_row(row) for row in rows]
+    
+    @staticmethod
+    def _process_row(row: Dict[str, Any]) -> Dict[str, Any]:
+        """單列後處理：Decimal 轉 float、YYYYMMDD 整數日期加上 *_formatted 欄位"""
+        processed_row = {}
+        for key, value in row.items():
+            # 處理 Decimal 類型
+            if isinstance(value, Decimal):
+                value = float(value)
+            
+            # 日期格式轉換
+            if key.lower().find('date') != -1 and isinstance(value, int) and len(str(value)) == 8:
+                processed_row[key] = value
+                processed_row[f"{key}_formatted"] = f"{str(value)[:4]}-{str(value)[4:6]}-{str(value)[6:8]}"
+            else:
+                processed_row[key] = value
+        return processed_row
+    
+    def validate_sql(self, sql: str, db_overview: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """以 SQL 解析器驗證唯讀性，並對照 schema catalog 檢查表/欄位（不連資料庫）"""
+        return analyze_sql(sql, db_overview)
 
 # ---------- Agent 5: Data Analysis Agent (資料分析代理) ----------
 class DataAnalysisAgent:
@@ -568,32 +780,38 @@ Keep it concise and actionable. Respond in Traditional Chinese.
     
     def analyze_data(self, context: PipelineContext) -> str:
         """分析資料並產生報告"""
-        sample = context.processed_data[:50] if context.processed_data else []
+        return chat(**self.analysis_request(context))
+    
+    def analysis_request(self, context: PipelineContext) -> Dict[str, Any]:
+        # 預覽列與代理通訊記錄依 token 預算打包：前面的列、較新的訊息優先保留
+        packer = ContextPacker()
+        for i, row in enumerate(context.processed_data[:50] if context.processed_data else []):
+            packer.add("samples", json.dumps(row, ensure_ascii=False, default=str), priority=-i, obj=row)
+        for i, msg in enumerate(context.agent_messages or []):
+            item = {"agent": msg.sender, "type": msg.message_type, "summary": str(msg.content)[:100]}
+            packer.add("history", json.dumps(item, ensure_ascii=False, default=str), priority=i, obj=item)
+        sample = packer.select("samples")
         
         payload = {
             "question": context.user_query,
             "sql": context.sql_query,
             "preview_rows": sample,
             "preview_count": len(sample),
-            "total_rows": len(context.processed_data) if context.processed_data else 0,
-            "agent_messages": [
-                {"agent": msg.sender, "type": msg.message_type, "summary": str(msg.content)[:100]}
-                for msg in context.agent_messages[-3:] if context.agent_messages
-            ]
+            "total_rows": context.row_count(),
+            "result_summary": context.result_summary,
+            "agent_messages": packer.select("history")
         }
         
-        out = chat([
+        return {"messages": [
             {"role":"system","content":self.system_prompt},
-            {"role":"user","content":json.dumps(payload, ensure_ascii=False)}
-        ], max_tokens=600)
-        
-        return out
+            {"role":"user","content":json.dumps(payload, ensure_ascii=False, default=str)}
+        ], "max_tokens": 600}
     
     def generate_feedback_to_agents(self, context: PipelineContext) -> Dict[str, Any]:
         """生成給其他代理的回饋訊息"""
         feedback = {
-            "data_quality": "good" if context.processed_data and len(context.processed_data) > 0 else "poor",
-            "row_count": len(context.processed_data) if context.processed_data else 0,
+            "data_quality": "good" if context.row_count() > 0 else "poor",
+            "row_count": context.row_count(),
             "suggestions": []
         }
         
@@ -610,12 +828,20 @@ Keep it concise and actionable. Respond in Traditional Chinese.
 class AgentCoordinator:
     """協調所有代理的執行與溝通"""
     
-    def __init__(self, engine: Engine):
-        self.db_agent = DbAgent(engine)
+    max_retries = 2
+    
+    def __init__(self, engine: Optional[Engine], catalog: Optional[SchemaCatalog] = None,
+                 result_cache: Optional["ResultCache"] = None, preflight: Optional[SqlPreflight] = None,
+                 workload_log: Optional[WorkloadLog] = None,
+                 db_agent: Union[DbAgent, "DuckDbAgent", None] = None):
+        # db_agent：直接指定執行後端（例如 DuckDbAgent，或與其他協調器共用同一個 DbAgent）
+        self.db_agent = db_agent or DbAgent(engine, catalog, result_cache, preflight, workload_log)
         self.rewrite_agent = RewriteAgent()
         self.table_decide_agent = TableDecideAgent()
         self.table_process_agent = TableProcessAgent(self.db_agent)
         self.data_analysis_agent = DataAnalysisAgent()
+        self.schema_linker = SchemaLinker(collection_fn=mongo_cards_collection) if SCHEMA_LINKING else None
+        self.plan_cache = plan_cache
         
     def execute_pipeline(self, user_query: str, ref_context: str = "") -> PipelineContext:
         """執行完整的多代理流程"""
@@ -625,15 +851,32 @@ class AgentCoordinator:
             reference_context=ref_context
         )
         
-        # Step 1: 資料庫代理掃描結構
+        # Step 1: 資料庫代理讀取 schema catalog（僅在資料表變動時才重新掃描）
         context.db_overview = self.db_agent.scan_schema(sample_rows=3)
-        self._add_message(context, "DbAgent", "System", "schema_scan", 
-                         {"tables_found": context.db_overview["total_tables"]})
+        self._on_schema_scanned(context)
+        
+        # 計畫快取命中：重新綁定參數後直接執行，略過改寫/決策/SQL 生成
+        cache_key = self.apply_cached_plan(context)
+        if cache_key:
+            context.processed_data, error = self.table_process_agent.execute_and_process(context)
+            cache_key = self.on_cached_result(context, cache_key, error)
+        if not cache_key:
+            self._plan_and_execute(context)
+        
+        # Step 5: 資料分析代理
+        context.analysis_result = self.data_analysis_agent.analyze_data(context)
+        self._on_analysis_complete(context)
+        
+        return context
+    
+    def _plan_and_execute(self, context: PipelineContext):
+        """Step 2-4：改寫 → 決策 → SQL 生成與執行（含重試）；成功時存入計畫快取"""
+        self.link_schema(context)
         
         # Step 2: 改寫代理處理查詢
         context.rewritten_query = self.rewrite_agent.rewrite_query(context)
-        self._add_message(context, "RewriteAgent", "TableDecideAgent", "query_rewritten",
-                         {"confidence": context.rewritten_query.get("confidence", 0.5)})
+        self._on_query_rewritten(context)
+        self.link_schema(context)
         
         # Step 3: 資料表決策代理
         context.table_plan = self.table_decide_agent.decide_tables(context)
@@ -646,14 +889,13 @@ class AgentCoordinator:
             context.rewritten_query = refined_query
             context.table_plan = self.table_decide_agent.decide_tables(context)
         
-        self._add_message(context, "TableDecideAgent", "TableProcessAgent", "plan_decided",
-                         {"tables_count": len(context.table_plan.get("tables", []))})
+        self._on_plan_decided(context)
         
         # Step 4: 資料表處理代理 (支援重試機制)
-        max_retries = 2
         retry_count = 0
+        error = ""
         
-        while retry_count <= max_retries:
+        while retry_count <= self.max_retries:
             if retry_count == 0:
                 context.sql_query = self.table_process_agent.generate_sql(context)
             else:
@@ -664,38 +906,106 @@ class AgentCoordinator:
             
             context.processed_data, error = self.table_process_agent.execute_and_process(context)
             
-            if not error:
-                # 成功執行
-                self._add_message(context, "TableProcessAgent", "DataAnalysisAgent", "data_ready",
-                                 {"rows_processed": len(context.processed_data), "retries_used": retry_count})
+            done, retry_count, replan = self._on_execution_result(context, error, retry_count)
+            if done:
                 break
-            else:
-                retry_count += 1
-                if retry_count <= max_retries:
-                    self._add_message(context, "TableProcessAgent", "TableDecideAgent", "execution_error_retry",
-                                     {"error": error, "retry_count": retry_count})
-                    
-                    # 如果是 schema 相關錯誤，重新生成 table plan
-                    if "does not exist" in error or "UndefinedTable" in error or "UndefinedColumn" in error:
-                        error_feedback = {
-                            "sql_error": error,
-                            "available_tables": [t["name"] for t in context.db_overview.get("tables", [])],
-                            "suggestion": "Use only tables and columns that exist in schema"
-                        }
-                        context.table_plan = self.table_decide_agent.decide_tables(context)
-                else:
-                    # 最終失敗
-                    self._add_message(context, "TableProcessAgent", "DataAnalysisAgent", "execution_failed",
-                                     {"final_error": error, "total_retries": retry_count - 1})
+            if replan:
+                self.link_schema(context, widen=True)
+                context.table_plan = self.table_decide_agent.decide_tables(context)
         
-        # Step 5: 資料分析代理
-        context.analysis_result = self.data_analysis_agent.analyze_data(context)
+        # 成功執行的 SQL 依問題模板存入計畫快取
+        self.store_plan(context, error)
+    
+    def link_schema(self, context: PipelineContext, widen: bool = False):
+        """schema linking：依查詢（與改寫後的意圖）挑出 top-N 表與相關欄位；
+        widen=True 用於 schema 錯誤後重新決策，放寬為兩倍表數且保留所有欄位"""
+        if self.schema_linker is None or not context.db_overview:
+            return
+        query_text = context.user_query
+        if context.rewritten_query:
+            query_text += "\n" + json.dumps(context.rewritten_query, ensure_ascii=False)
+        if widen:
+            linker = self.schema_linker
+            context.linked_overview = linker.link(query_text, context.db_overview,
+                                                  top_n=linker.top_n * 2, max_columns=0)
+        else:
+            context.linked_overview = self.schema_linker.link(query_text, context.db_overview)
+        self._add_message(context, "DbAgent", "System", "schema_linked",
+                         {"tables_linked": len(context.schema_view().get("tables", [])),
+                          "tables_total": context.db_overview.get("total_tables", 0)})
+    
+    # ---------- 計畫快取（同步與 async 協調器共用） ----------
+    def apply_cached_plan(self, context: PipelineContext) -> Optional[str]:
+        """命中時把重新綁定的 SQL / table_plan / rewritten_query 放入 context，回傳快取 key"""
+        if self.plan_cache is None:
+            return None
+        hit = self.plan_cache.lookup(context.user_query)
+        if hit is None:
+            return None
+        context.rewritten_query = hit["rewritten_query"] or {"goal": context.user_query}
+        context.table_plan = hit["table_plan"]
+        context.sql_query = hit["sql"]
+        self._add_message(context, "PlanCache", "TableProcessAgent", "plan_cache_hit",
+                         {"template": hit["template"]})
+        return hit["key"]
+    
+    def on_cached_result(self, context: PipelineContext, key: str, error: str) -> Optional[str]:
+        """快取 SQL 執行失敗時刪除該筆並回傳 None（改走完整流程）"""
+        if error:
+            self.plan_cache.invalidate(key)
+            self._add_message(context, "PlanCache", "RewriteAgent", "plan_cache_invalidated", {"error": error})
+            context.processed_data, context.result_summary = None, None
+            return None
+        self._add_message(context, "TableProcessAgent", "DataAnalysisAgent", "data_ready",
+                         {"rows_processed": context.row_count(), "retries_used": 0, "plan_cache": True})
+        return key
+    
+    def store_plan(self, context: PipelineContext, error: str):
+        # 0 列的結果多半是條件寫錯，不當成可重用的計畫
+        if self.plan_cache is not None and not error and context.sql_query and context.row_count() > 0:
+            self.plan_cache.store(context.user_query, context.sql_query, context.table_plan, context.rewritten_query)
+    
+    # ---------- 各階段共用的訊息記錄（同步與 async 協調器共用） ----------
+    def _on_schema_scanned(self, context: PipelineContext):
+        self._add_message(context, "DbAgent", "System", "schema_scan", 
+                         {"tables_found": context.db_overview["total_tables"]})
+    
+    def _on_query_rewritten(self, context: PipelineContext):
+        self._add_message(context, "RewriteAgent", "TableDecideAgent", "query_rewritten",
+                         {"confidence": context.rewritten_query.get("confidence", 0.5)})
+    
+    def _on_plan_decided(self, context: PipelineContext):
+        self._add_message(context, "TableDecideAgent", "TableProcessAgent", "plan_decided",
+                         {"tables_count": len(context.table_plan.get("tables", []))})
+    
+    def _on_execution_result(self, context: PipelineContext, error: str,
+                             retry_count: int) -> Tuple[bool, int, bool]:
+        """處理一次 SQL 執行結果，回傳 (是否結束, 新的重試次數, 是否需要重新決策資料表)"""
+        if not error:
+            # 成功執行
+            self._add_message(context, "TableProcessAgent", "DataAnalysisAgent", "data_ready",
+                             {"rows_processed": context.row_count(), "retries_used": retry_count})
+            return True, retry_count, False
         
+        retry_count += 1
+        # 成本閘門設為 reject 時不重試
+        if retry_count <= self.max_retries and not error.startswith("QueryRejected"):
+            self._add_message(context, "TableProcessAgent", "TableDecideAgent", "execution_error_retry",
+                             {"error": error, "retry_count": retry_count})
+            
+            # 如果是 schema 相關錯誤，重新生成 table plan
+            replan = "does not exist" in error or "UndefinedTable" in error or "UndefinedColumn" in error
+            return False, retry_count, replan
+        
+        # 最終失敗
+        self._add_message(context, "TableProcessAgent", "DataAnalysisAgent", "execution_failed",
+                         {"final_error": error, "total_retries": retry_count - 1})
+        return True, retry_count, False
+    
+    def _on_analysis_complete(self, context: PipelineContext):
         # 生成回饋給其他代理
         feedback = self.data_analysis_agent.generate_feedback_to_agents(context)
         self._add_message(context, "DataAnalysisAgent", "System", "analysis_complete", feedback)
-        
-        return context
     
     def _add_message(self, context: PipelineContext, sender: str, receiver: str, 
                     msg_type: str, content: Dict[str, Any]):
@@ -710,7 +1020,12 @@ class AgentCoordinator:
         context.agent_messages.append(message)
 
 # ---------- 初始化全域代理協調器 ----------
-coordinator = AgentCoordinator(pg_engine)
+if DB_BACKEND == "duckdb":
+    from duckdb_backend import DuckDbAgent
+    coordinator = AgentCoordinator(None, db_agent=DuckDbAgent(workload_log=workload_log))
+else:
+    coordinator = AgentCoordinator(pg_engine, result_cache=result_cache, preflight=sql_preflight,
+                                   workload_log=workload_log)
 
 # ---------- Top-level ask() function ----------
 def ask(user_query: str) -> str:
@@ -718,12 +1033,16 @@ def ask(user_query: str) -> str:
     
     # 0) Reference retrieval (Mongo Vector Search)
     ref_cards = reference_search(user_query, k=6)
-    ref_context = build_ref_context(ref_cards, max_chars=9000)
+    ref_context = build_ref_context(ref_cards)
     
     # 1) 執行多代理協作流程
     context = coordinator.execute_pipeline(user_query, ref_context)
     
     # 2) 生成詳細輸出報告
+    return format_report(context, ref_cards)
+
+def format_report(context: PipelineContext, ref_cards: List[Dict[str, Any]]) -> str:
+    """將 pipeline 執行結果整理成文字報告"""
     lines = []
     lines.append("🤖 == Multi-Agent Pipeline Execution Report == 🤖\n")
     
@@ -755,7 +1074,7 @@ def ask(user_query: str) -> str:
     lines.append("")
     
     # 資料結果預覽
-    lines.append(f"📊 [Data Results] {min(len(context.processed_data), 10) if context.processed_data else 0} of {len(context.processed_data) if context.processed_data else 0} rows")
+    lines.append(f"📊 [Data Results] {min(len(context.processed_data), 10) if context.processed_data else 0} of {context.row_count()} rows")
     if context.processed_data:
         for i, row in enumerate(context.processed_data[:10]):
             lines.append(f"  {i+1}: {str(row)}")
@@ -782,7 +1101,19 @@ def ask(user_query: str) -> str:
     lines.append(f"  • Total agents involved: 5")
     lines.append(f"  • Messages exchanged: {len(context.agent_messages)}")
     lines.append(f"  • Tables analyzed: {context.db_overview['total_tables'] if context.db_overview else 0}")
-    lines.append(f"  • Rows processed: {len(context.processed_data) if context.processed_data else 0}")
+    lines.append(f"  • Rows processed: {context.row_count()}")
+    if llm_cache is not None:
+        st = llm_cache.stats()
+        lines.append(f"  • LLM cache: {st['hits'] + st['semantic_hits']} hits / {st['misses']} misses")
+    if plan_cache is not None:
+        st = plan_cache.stats()
+        lines.append(f"  • Plan cache: {st['hits']} hits / {st['misses']} misses ({st['entries']} templates)")
+    if result_cache is not None:
+        st = result_cache.stats()
+        lines.append(f"  • Result cache: {st['hits']} hits / {st['misses']} misses ({st['entries']} results, {st['mb']} MB)")
+    if sql_preflight is not None:
+        st = sql_preflight.stats()
+        lines.append(f"  • SQL preflight: {st['checked']} planned / {st['plan_errors']} plan errors / {st['over_cost']} over cost")
     
     return "\n".join(lines)
 
@@ -0,0 +1,133 @@
+# async_pipeline.py — asyncio 版本的多代理流程
+# 與 AgentCoordinator 相同的 PipelineContext / AgentMessage 契約與輸出，
+# 但 LLM 呼叫改用 AsyncOpenAI，且互不相依的階段並行執行：
+#   reference_search (Mongo 向量搜尋) ‖ scan_schema (schema catalog)
+# 阻塞式 I/O（SQLAlchemy、pymongo）透過 asyncio.to_thread 交給執行緒。
+
+import asyncio
+import inspect
+from typing import List, Dict, Any, Union, Awaitable
+
+from ask import (
+    AgentCoordinator, PipelineContext, achat, pg_engine, coordinator,
+    reference_search, build_ref_context, format_report,
+)
+
+
+class AsyncAgentCoordinator(AgentCoordinator):
+    """以 asyncio 協調所有代理；各代理的 prompt 與解析邏輯與同步版本共用"""
+
+    async def execute_pipeline(self, user_query: str,
+                               ref_context: Union[str, Awaitable[str]] = "") -> PipelineContext:
+        """執行完整的多代理流程；ref_context 可傳入 awaitable，與 schema 掃描並行"""
+        context = PipelineContext(user_query=user_query)
+
+        # Step 0+1: 參考資料檢索與 schema catalog 並行
+        schema_task = asyncio.to_thread(self.db_agent.scan_schema, sample_rows=3)
+        if inspect.isawaitable(ref_context):
+            context.db_overview, context.reference_context = await asyncio.gather(schema_task, ref_context)
+        else:
+            context.reference_context = ref_context
+            context.db_overview = await schema_task
+        self._on_schema_scanned(context)
+
+        # 計畫快取命中：重新綁定參數後直接執行，略過改寫/決策/SQL 生成
+        cache_key = await asyncio.to_thread(self.apply_cached_plan, context)
+        if cache_key:
+            context.processed_data, error = await asyncio.to_thread(
+                self.table_process_agent.execute_and_process, context)
+            cache_key = self.on_cached_result(context, cache_key, error)
+        if not cache_key:
+            await self._plan_and_execute(context)
+
+        # Step 5: 資料分析代理
+        context.analysis_result = await achat(**self.data_analysis_agent.analysis_request(context))
+        self._on_analysis_complete(context)
+
+        return context
+
+    async def _plan_and_execute(self, context: PipelineContext):
+        """Step 2-4（async 版）：改寫 → 決策 → SQL 生成與執行（含重試）；成功時存入計畫快取"""
+        await asyncio.to_thread(self.link_schema, context)
+
+        # Step 2: 改寫代理處理查詢
+        out = await achat(**self.rewrite_agent.rewrite_request(context))
+        context.rewritten_query = self.rewrite_agent.parse_rewrite(out, context)
+        self._on_query_rewritten(context)
+        await asyncio.to_thread(self.link_schema, context)
+
+        # Step 3: 資料表決策代理
+        context.table_plan = await self._decide_tables(context)
+        validation = self.table_decide_agent.validate_plan(context.table_plan, context.db_overview)
+
+        # 如果計畫有問題，回饋給改寫代理
+        if not validation["valid"]:
+            feedback = {"issues": validation["issues"], "db_available": list(context.db_overview.keys())}
+            out = await achat(**self.rewrite_agent.refine_request(context, feedback))
+            context.rewritten_query = self.rewrite_agent.parse_refine(out, context)
+            context.table_plan = await self._decide_tables(context)
+
+        self._on_plan_decided(context)
+
+        # Step 4: 資料表處理代理 (支援重試機制)
+        retry_count = 0
+        error = ""
+        agent = self.table_process_agent
+
+        while retry_count <= self.max_retries:
+            if retry_count == 0:
+                out = await achat(**agent.sql_request(context))
+            else:
+                # 重試時提供錯誤回饋
+                out = await achat(**agent.sql_request(context, error))
+                self._add_message(context, "TableProcessAgent", "System", "sql_retry",
+                                  {"retry_attempt": retry_count, "previous_error": error})
+            context.sql_query = agent.clean_sql(out, context)
+
+            context.processed_data, error = await asyncio.to_thread(agent.execute_and_process, context)
+
+            done, retry_count, replan = self._on_execution_result(context, error, retry_count)
+            if done:
+                break
+            if replan:
+                await asyncio.to_thread(self.link_schema, context, True)
+                context.table_plan = await self._decide_tables(context)
+
+        # 成功執行的 SQL 依問題模板存入計畫快取
+        await asyncio.to_thread(self.store_plan, context, error)
+
+    async def _decide_tables(self, context: PipelineContext) -> Dict[str, Any]:
+        out = await achat(**self.table_decide_agent.decide_request(context))
+        return self.table_decide_agent.parse_plan(out)
+
+
+# ---------- 初始化全域 async 協調器（與同步版共用同一個 DbAgent：schema catalog、結果快取、preflight 與工作負載紀錄） ----------
+async_coordinator = AsyncAgentCoordinator(pg_engine, db_agent=coordinator.db_agent)
+
+
+async def ask_async(user_query: str) -> str:
+    """ask() 的 asyncio 版本：輸出格式相同，但參考檢索與 schema 掃描並行"""
+    ref_task = asyncio.create_task(asyncio.to_thread(reference_search, user_query, 6))
+
+    async def ref_context() -> str:
+        return build_ref_context(await ref_task)
+
+    context = await async_coordinator.execute_pipeline(user_query, ref_context())
+    return format_report(context, ref_task.result())
+
+
+async def ask_many_async(questions: List[str], max_concurrency: int = 4) -> List[str]:
+    """同時處理多個問題（以 semaphore 限制並行數，避免 API 限流）"""
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def run(q: str) -> str:
+        async with sem:
+            return await ask_async(q)
+
+    return await asyncio.gather(*(run(q) for q in questions))
+
+
+if __name__ == "__main__":
+    import sys
+    q = sys.argv[1] if len(sys.argv) > 1 else "請給我 2024-10-01 到 2024-10-31 台灣(TW) 的 SessionActive 筆數與每日趨勢"
+    print(asyncio.run(ask_async(q)))
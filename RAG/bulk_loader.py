@@ -0,0 +1,247 @@
+# bulk_loader.py — 以 COPY FROM STDIN 串流載入 CSV 到 PostgreSQL
+# 取代 DataFrame.to_sql(method="multi") 的大型多列 INSERT：
+#   1) 只讀取樣本推斷欄位型別（一次）
+#   2) 建表後以 COPY 直接串流原始檔案（不經 pandas 解析整個檔案）
+#   3) 回報進度與 rows/s；多檔並行載入見 load_tables_to_pg.run_jobs（process pool + 續傳）
+# pip install psycopg2-binary pandas python-dotenv
+
+import os, io, csv, json, time
+from itertools import islice
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+PG_URI = os.getenv("PG_URI")
+TYPE_SAMPLE_ROWS = int(os.getenv("CSV_TYPE_SAMPLE_ROWS", os.getenv("CSV_CHUNK_SIZE", "10000")))
+PROGRESS_EVERY_MB = float(os.getenv("COPY_PROGRESS_MB", "64"))
+CHUNK_ROWS = int(os.getenv("CSV_CHUNK_SIZE", "10000"))
+STATE_SCHEMA = os.getenv("ETL_STATE_SCHEMA", "etl")   # 載入狀態表放在獨立 schema，不會出現在 public 的 schema 掃描
+
+
+def pg_dsn(uri: Optional[str] = None) -> str:
+    """把 SQLAlchemy 形式的 URI（postgresql+psycopg2://）轉成 libpq 可用的 DSN"""
+    uri = uri or PG_URI
+    if not uri:
+        raise RuntimeError("PG_URI is required (Neon connection string).")
+    scheme, sep, rest = uri.partition("://")
+    return scheme.split("+", 1)[0] + sep + rest
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+# ---------- 型別推斷 ----------
+def _pg_type(dtype) -> str:
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE PRECISION"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMP"
+    return "TEXT"
+
+
+def infer_columns(csv_path: Path, sample_rows: int = TYPE_SAMPLE_ROWS) -> List[Tuple[str, str]]:
+    """只讀取前 sample_rows 列推斷 PostgreSQL 欄位型別"""
+    df = pd.read_csv(csv_path, nrows=sample_rows, low_memory=False)
+    cols = []
+    for name, dtype in df.dtypes.items():
+        pg_type = _pg_type(dtype)
+        cols.append((str(name), pg_type))
+    return cols
+
+
+def create_table(cur, schema: str, table: str, columns: List[Tuple[str, str]],
+                 replace: bool = True, with_pk: bool = True):
+    """建表；with_pk 時先建好 id IDENTITY 主鍵，COPY 只寫入 CSV 欄位，id 由 identity 自動產生，
+    載入後不需再整表回填（CSV 本身已有 id 欄位時不加）"""
+    tbl_q = f"{quote_ident(schema)}.{quote_ident(table)}"
+    if replace:
+        cur.execute(f"DROP TABLE IF EXISTS {tbl_q}")
+    col_defs = [f"{quote_ident(n)} {t}" for n, t in columns]
+    if with_pk and "id" not in {n for n, _ in columns}:
+        col_defs.insert(0, f'"id" BIGINT GENERATED BY DEFAULT AS IDENTITY '
+                           f'CONSTRAINT {quote_ident(table + "_pk")} PRIMARY KEY')
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {tbl_q} ({', '.join(col_defs)})")
+
+
+# ---------- COPY 串流 ----------
+class _ProgressReader:
+    """包裝檔案物件，COPY 讀取時順便回報進度"""
+
+    def __init__(self, f, label: str, total_bytes: int):
+        self.f = f
+        self.label = label
+        self.total = total_bytes
+        self.read_bytes = 0
+        self.started = time.time()
+        self._next_report = PROGRESS_EVERY_MB * 1024 * 1024
+
+    def read(self, size: int = -1):
+        data = self.f.read(size)
+        self.read_bytes += len(data)
+        if self.read_bytes >= self._next_report:
+            self._next_report += PROGRESS_EVERY_MB * 1024 * 1024
+            elapsed = max(time.time() - self.started, 1e-6)
+            pct = 100.0 * self.read_bytes / self.total if self.total else 0.0
+            print(f"  - {self.label}: {self.read_bytes / 2**20:.0f} MB ({pct:.1f}%), "
+                  f"{self.read_bytes / 2**20 / elapsed:.1f} MB/s")
+        return data
+
+    def readline(self, size: int = -1):
+        line = self.f.readline(size)
+        self.read_bytes += len(line)
+        return line
+
+
+def copy_csv(cur, csv_path: Path, schema: str, table: str,
+             columns: Optional[List[str]] = None) -> int:
+    """以 COPY FROM STDIN 串流整個 CSV（含標頭列），回傳載入列數"""
+    tbl_q = f"{quote_ident(schema)}.{quote_ident(table)}"
+    col_sql = f" ({', '.join(quote_ident(c) for c in columns)})" if columns else ""
+    with open(csv_path, "rb") as f:
+        reader = _ProgressReader(f, csv_path.name, csv_path.stat().st_size)
+        cur.copy_expert(f"COPY {tbl_q}{col_sql} FROM STDIN WITH (FORMAT csv, HEADER true)", reader)
+    return cur.rowcount
+
+
+def load_csv(conn, csv_path: Path, schema: str = "public", table: Optional[str] = None,
+             replace: bool = True, with_pk: bool = True) -> Dict[str, Any]:
+    """推斷型別 → 建表 → COPY，於單一交易內完成；回傳載入統計"""
+    table = table or csv_path.stem
+    started = time.time()
+    columns = infer_columns(csv_path)
+    with conn.cursor() as cur:
+        create_table(cur, schema, table, columns, replace=replace, with_pk=with_pk)
+        rows = copy_csv(cur, csv_path, schema, table, [n for n, _ in columns])
+    conn.commit()
+    elapsed = max(time.time() - started, 1e-6)
+    return {
+        "file": str(csv_path),
+        "table": f"{schema}.{table}",
+        "rows": rows,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(rows / elapsed, 1),
+        "mb_per_sec": round(csv_path.stat().st_size / 2**20 / elapsed, 2),
+    }
+
+
+# ---------- 可續傳的分塊 COPY ----------
+def ensure_state_table(cur):
+    """每個 (schema, table) 一列：來源檔簽章、已提交的 chunk 數與列數、狀態與完成時間"""
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {quote_ident(STATE_SCHEMA)}")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {quote_ident(STATE_SCHEMA)}.load_state (
+            schema_name  TEXT NOT NULL,
+            table_name   TEXT NOT NULL,
+            file_path    TEXT NOT NULL,
+            file_size    BIGINT NOT NULL,
+            file_mtime   BIGINT NOT NULL,
+            columns      TEXT NOT NULL,
+            chunk_rows   INTEGER NOT NULL,
+            chunks_done  INTEGER NOT NULL DEFAULT 0,
+            rows_loaded  BIGINT NOT NULL DEFAULT 0,
+            status       TEXT NOT NULL,
+            loaded_at    TIMESTAMPTZ,
+            PRIMARY KEY (schema_name, table_name)
+        )
+    """)
+
+
+def _file_signature(csv_path: Path) -> Tuple[int, int]:
+    st = csv_path.stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def load_csv_resumable(conn, csv_path: Path, schema: str = "public", table: Optional[str] = None,
+                       chunk_rows: int = CHUNK_ROWS, with_pk: bool = True) -> Dict[str, Any]:
+    """分塊 COPY，每個 chunk 與進度一起提交；中斷後以相同檔案重跑會從最後提交的 chunk 續傳，
+    檔案已完整載入且未變更時直接略過"""
+    table = table or csv_path.stem
+    state_q = f"{quote_ident(STATE_SCHEMA)}.load_state"
+    tbl_q = f"{quote_ident(schema)}.{quote_ident(table)}"
+    size, mtime = _file_signature(csv_path)
+    started = time.time()
+
+    with conn.cursor() as cur:
+        ensure_state_table(cur)
+        cur.execute(f"""SELECT file_size, file_mtime, columns, chunk_rows, chunks_done, rows_loaded, status
+                        FROM {state_q} WHERE schema_name = %s AND table_name = %s""", (schema, table))
+        state = cur.fetchone()
+    conn.commit()
+
+    same_file = state is not None and state[0] == size and state[1] == mtime and state[3] == chunk_rows
+    if same_file and state[6] == "done":
+        print(f"[SKIP] {table}: unchanged since last load ({state[5]} rows)")
+        return {"file": str(csv_path), "table": f"{schema}.{table}", "rows": 0,
+                "skipped": True, "seconds": 0.0, "rows_per_sec": 0.0, "mb_per_sec": 0.0}
+
+    if same_file:
+        columns = json.loads(state[2])
+        chunks_done, rows_loaded = state[4], state[5]
+        print(f"[RESUME] {table}: from chunk {chunks_done} ({rows_loaded} rows committed)")
+    else:
+        columns = infer_columns(csv_path)
+        chunks_done, rows_loaded = 0, 0
+        with conn.cursor() as cur:
+            create_table(cur, schema, table, columns, replace=True, with_pk=with_pk)
+            cur.execute(f"""
+                INSERT INTO {state_q} (schema_name, table_name, file_path, file_size, file_mtime,
+                                       columns, chunk_rows, chunks_done, rows_loaded, status, loaded_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, 0, 0, 'loading', NULL)
+                ON CONFLICT (schema_name, table_name) DO UPDATE SET
+                    file_path = EXCLUDED.file_path, file_size = EXCLUDED.file_size,
+                    file_mtime = EXCLUDED.file_mtime, columns = EXCLUDED.columns,
+                    chunk_rows = EXCLUDED.chunk_rows, chunks_done = 0, rows_loaded = 0,
+                    status = 'loading', loaded_at = NULL
+            """, (schema, table, str(csv_path), size, mtime, json.dumps(columns), chunk_rows))
+        conn.commit()
+
+    col_sql = ", ".join(quote_ident(n) for n, _ in columns)
+    copy_sql = f"COPY {tbl_q} ({col_sql}) FROM STDIN WITH (FORMAT csv)"
+    new_rows = 0
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # header
+        # 跳過已提交的 chunk
+        for _ in islice(reader, chunks_done * chunk_rows):
+            pass
+        while True:
+            chunk = list(islice(reader, chunk_rows))
+            if not chunk:
+                break
+            buf = io.StringIO()
+            csv.writer(buf).writerows(chunk)
+            buf.seek(0)
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_sql, buf)
+                cur.execute(f"""UPDATE {state_q} SET chunks_done = chunks_done + 1, rows_loaded = rows_loaded + %s
+                                WHERE schema_name = %s AND table_name = %s""", (len(chunk), schema, table))
+            conn.commit()
+            chunks_done += 1
+            new_rows += len(chunk)
+            elapsed = max(time.time() - started, 1e-6)
+            print(f"  - {table}: chunk {chunks_done} committed ({rows_loaded + new_rows} rows, "
+                  f"{new_rows / elapsed:.0f} rows/s)")
+
+    with conn.cursor() as cur:
+        cur.execute(f"""UPDATE {state_q} SET status = 'done', loaded_at = now()
+                        WHERE schema_name = %s AND table_name = %s""", (schema, table))
+    conn.commit()
+
+    elapsed = max(time.time() - started, 1e-6)
+    return {
+        "file": str(csv_path),
+        "table": f"{schema}.{table}",
+        "rows": new_rows,
+        "total_rows": rows_loaded + new_rows,
+        "resumed_from_chunk": state[4] if same_file else 0,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(new_rows / elapsed, 1),
+        "mb_per_sec": round(size / 2**20 / elapsed, 2),
+    }
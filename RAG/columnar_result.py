@@ -0,0 +1,104 @@
+# columnar_result.py — 以 pyarrow 欄式儲存的查詢結果
+# 取代 List[Dict] 的逐列後處理：Decimal→float 與 YYYYMMDD→日期字串皆以向量化運算完成，
+# 同時提供 list 相容介面（len / 切片 / 迭代），可直接放進 PipelineContext.processed_data。
+# pip install pyarrow
+
+from typing import Iterator, List, Dict, Any, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class ColumnarResult:
+    """pyarrow.Table 包裝；切片與迭代回傳 dict 列以相容既有代理"""
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    # ---------- 建構 ----------
+    @classmethod
+    def from_columns(cls, names: List[str], columns: List[List[Any]]) -> "ColumnarResult":
+        arrays = []
+        for values in columns:
+            try:
+                arrays.append(pa.array(values))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # 混合型別的欄位退回字串
+                arrays.append(pa.array([None if v is None else str(v) for v in values], type=pa.string()))
+        return cls(pa.Table.from_arrays(arrays, names=list(names)))
+
+    @classmethod
+    def from_result(cls, result, max_rows: Optional[int] = None) -> "ColumnarResult":
+        """由 SQLAlchemy Result 建立；以 tuple 取列再轉置，避免逐列建立 dict"""
+        names = list(result.keys())
+        rows = result.fetchmany(max_rows) if max_rows is not None else result.fetchall()
+        columns = [list(col) for col in zip(*rows)] if rows else [[] for _ in names]
+        return cls.from_columns(names, columns)
+
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, Any]]) -> "ColumnarResult":
+        return cls(pa.Table.from_pylist(rows))
+
+    # ---------- 向量化後處理 ----------
+    def post_process(self) -> "ColumnarResult":
+        """Decimal 欄位轉 float64；名稱含 date 的 8 位數整數欄位加上 *_formatted (YYYY-MM-DD)"""
+        table = self.table
+        for i, field in enumerate(table.schema):
+            if pa.types.is_decimal(field.type):
+                table = table.set_column(i, field.name, pc.cast(table.column(i), pa.float64()))
+
+        for field in list(table.schema):
+            if "date" not in field.name.lower() or not pa.types.is_integer(field.type):
+                continue
+            col = table.column(field.name)
+            is_ymd = pc.and_(pc.greater_equal(col, 10000000), pc.less_equal(col, 99999999))
+            s = pc.cast(col, pa.string())
+            formatted = pc.binary_join_element_wise(
+                pc.utf8_slice_codeunits(s, 0, 4),
+                pc.utf8_slice_codeunits(s, 4, 6),
+                pc.utf8_slice_codeunits(s, 6, 8),
+                "-",
+            )
+            formatted = pc.if_else(is_ymd, formatted, pa.scalar(None, pa.string()))
+            if formatted.null_count < len(formatted):
+                pos = table.schema.get_field_index(field.name) + 1
+                table = table.add_column(pos, f"{field.name}_formatted", formatted)
+        return ColumnarResult(table)
+
+    def to_dates(self, column: str) -> pa.Array:
+        """將 YYYYMMDD 整數欄位轉成 date32 陣列"""
+        s = pc.cast(self.table.column(column), pa.string())
+        return pc.cast(pc.strptime(s, format="%Y%m%d", unit="s"), pa.date32())
+
+    # ---------- 預覽與相容介面 ----------
+    def preview(self, n: int = 50) -> List[Dict[str, Any]]:
+        return self.table.slice(0, n).to_pylist()
+
+    def to_pandas(self):
+        return self.table.to_pandas()
+
+    @property
+    def columns(self) -> List[str]:
+        return self.table.column_names
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __bool__(self) -> bool:
+        return self.table.num_rows > 0
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.table.num_rows)
+            if step != 1:
+                return self.table.to_pylist()[idx]
+            return self.table.slice(start, max(0, stop - start)).to_pylist()
+        if idx < 0:
+            idx += self.table.num_rows
+        return self.table.slice(idx, 1).to_pylist()[0]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for batch in self.table.to_batches(max_chunksize=1024):
+            yield from batch.to_pylist()
+
+    def __repr__(self) -> str:
+        return f"ColumnarResult(rows={self.table.num_rows}, columns={self.table.column_names})"
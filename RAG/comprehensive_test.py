@@ -4,7 +4,7 @@
 import sys
 import os
 import time
-from ask import ask
+from ask import ask, llm_cache
 
 def test_question(question_id: int, question: str):
     """測試單個分析問題"""
@@ -130,6 +130,9 @@ def main():
     print(f"成功率: {success_count/len(analysis_questions)*100:.1f}%")
     print(f"數據返回率: {data_count/success_count*100:.1f}%" if success_count > 0 else "數據返回率: 0%")
     print(f"平均執行時間: {total_time/success_count:.2f} 秒" if success_count > 0 else "平均執行時間: N/A")
+    if llm_cache is not None:
+        st = llm_cache.stats()
+        print(f"LLM 快取命中率: {st['hit_rate']*100:.1f}% (hits={st['hits']}, semantic={st['semantic_hits']}, misses={st['misses']})")
     
     print("\n📋 詳細結果:")
     print("-"*80)
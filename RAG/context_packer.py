@@ -0,0 +1,126 @@
+# context_packer.py — 以 tiktoken 計算的 prompt 內容打包器
+# 各段落（references / schema / samples / history）各有 token 預算；
+# 段落內每個項目帶一個價值分數，超出預算時先丟價值最低的項目，輸出時保留原本順序。
+# 所有代理的 prompt 都經由這裡組裝，寬 schema 時不會再整包 dump db_overview。
+# pip install tiktoken
+
+import os, re, json
+from typing import List, Dict, Any, Optional, Iterable
+
+import tiktoken
+
+PROMPT_ENCODING = os.getenv("PROMPT_ENCODING", "")   # 空值 = 依 OPENAI_CHAT_MODEL 自動選擇
+DEFAULT_BUDGETS = {
+    "references": int(os.getenv("PROMPT_BUDGET_REFERENCES", "1500")),
+    "schema": int(os.getenv("PROMPT_BUDGET_SCHEMA", "1500")),
+    "samples": int(os.getenv("PROMPT_BUDGET_SAMPLES", "800")),
+    "history": int(os.getenv("PROMPT_BUDGET_HISTORY", "300")),
+}
+
+_enc = None
+
+
+def get_encoding():
+    global _enc
+    if _enc is None:
+        if PROMPT_ENCODING:
+            _enc = tiktoken.get_encoding(PROMPT_ENCODING)
+        else:
+            try:
+                _enc = tiktoken.encoding_for_model(os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini"))
+            except KeyError:
+                _enc = tiktoken.get_encoding("cl100k_base")
+    return _enc
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    toks = get_encoding().encode(text)
+    return text if len(toks) <= max_tokens else get_encoding().decode(toks[:max_tokens])
+
+
+class ContextPacker:
+    """分段 token 預算；select() 依 priority 由高到低裝箱，回傳保留原順序的項目"""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None):
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.items: Dict[str, List[Dict[str, Any]]] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def add(self, section: str, text: str, priority: float = 0.0, obj: Any = None):
+        """obj：select() 回傳的原始物件（例如資料列）；未提供時回傳 text"""
+        items = self.items.setdefault(section, [])
+        items.append({"order": len(items), "priority": priority, "text": text,
+                      "obj": text if obj is None else obj, "truncatable": obj is None})
+        return self
+
+    def select(self, section: str) -> List[Any]:
+        budget = self.budgets.get(section, 0)
+        items = self.items.get(section, [])
+        kept, used = [], 0
+        for it in sorted(items, key=lambda x: (-x["priority"], x["order"])):
+            n = count_tokens(it["text"])
+            if used + n <= budget:
+                kept.append((it["order"], it["obj"])); used += n
+            elif not kept and it["truncatable"] and budget > 0:
+                # 價值最高的項目本身就超過預算：截斷而非整段丟棄
+                kept.append((it["order"], truncate_tokens(it["text"], budget))); used = budget
+        self.stats[section] = {"tokens": used, "kept": len(kept), "dropped": len(items) - len(kept),
+                               "budget": budget}
+        return [obj for _, obj in sorted(kept, key=lambda x: x[0])]
+
+    def render(self, section: str, sep: str = "\n") -> str:
+        return sep.join(str(x) for x in self.select(section))
+
+
+# ---------- 各段落的項目產生器 ----------
+def pack_references(cards: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> str:
+    """檢索到的 card → 參考資料段落；依檢索排名決定價值"""
+    packer = ContextPacker({"references": max_tokens} if max_tokens else None)
+    for rank, d in enumerate(cards):
+        block = f"# {d.get('title','')}\n[type={d.get('type','')}] score={round(float(d.get('score',0)),4)}\n{d.get('text','')}\n"
+        packer.add("references", block, priority=-rank)
+    return packer.render("references", sep="\n---\n")
+
+
+_IDENT = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+
+
+def table_relevance(table: Dict[str, Any], query_text: str) -> float:
+    """表名/欄位名出現在查詢（含改寫結果、計畫）中的程度；表名命中權重較高"""
+    words = {w.lower() for w in _IDENT.findall(query_text or "")}
+    score = 3.0 if table["name"].lower() in words else 0.0
+    score += sum(1.0 for c in table.get("columns", []) if c["name"].lower() in words)
+    return score
+
+
+def add_schema(packer: ContextPacker, db_overview: Optional[Dict[str, Any]], query_text: str,
+               with_types: bool = False, pinned: Iterable[str] = ()):
+    """每張表一個項目：Table(col, ...)；pinned 的表（例如計畫中選定的表）優先保留"""
+    pinned = set(pinned)
+    for t in (db_overview or {}).get("tables", []):
+        cols = [f"{c['name']} {c.get('type','')}".strip() if with_types else c["name"]
+                for c in t.get("columns", [])]
+        line = f"{t['name']}({', '.join(cols)})"
+        if with_types and t.get("total_rows") is not None:
+            line += f" -- ~{t['total_rows']} rows"
+        priority = table_relevance(t, query_text) + (100.0 if t["name"] in pinned else 0.0)
+        packer.add("schema", line, priority=priority)
+    return packer
+
+
+def add_samples(packer: ContextPacker, db_overview: Optional[Dict[str, Any]], query_text: str,
+                rows_per_table: int = 2, pinned: Iterable[str] = ()):
+    """每張表的少量樣本列；與 schema 同樣依相關度排序"""
+    pinned = set(pinned)
+    for t in (db_overview or {}).get("tables", []):
+        sample = (t.get("sample") or [])[:rows_per_table]
+        if not sample:
+            continue
+        text = f"{t['name']}: {json.dumps(sample, ensure_ascii=False, default=str)}"
+        priority = table_relevance(t, query_text) + (100.0 if t["name"] in pinned else 0.0)
+        packer.add("samples", text, priority=priority)
+    return packer
@@ -0,0 +1,217 @@
+# duckdb_backend.py — 內嵌 DuckDB + Parquet 的執行後端（DB_BACKEND=duckdb）
+# data/tables 下的 CSV 轉成 zstd Parquet（檔案較新時才重轉），在 DuckDB 中以 public."表名" view 掛上；
+# 介面與 DbAgent 相同（scan_schema / execute_query / execute_query_columnar / execute_query_stream /
+# get_table_stats），協調器與各代理不需修改，也可離線測試整條流程。
+# 代理產生的是 PostgreSQL 語法，執行前以 sqlglot 轉譯為 DuckDB 方言（轉譯失敗時原樣執行）。
+# pip install duckdb pyarrow sqlglot
+
+import os, re, time, json, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, TYPE_CHECKING
+
+import duckdb
+import sqlglot
+from sqlglot.errors import SqlglotError
+
+from result_stream import consume
+
+if TYPE_CHECKING:
+    from columnar_result import ColumnarResult
+    from index_advisor import WorkloadLog
+
+DUCKDB_DATA_DIR = os.getenv("DUCKDB_DATA_DIR", os.getenv("DATA_DIR", "data/tables"))
+DUCKDB_PARQUET_DIR = os.getenv("DUCKDB_PARQUET_DIR", ".cache/parquet")
+DUCKDB_PATH = os.getenv("DUCKDB_PATH", ":memory:")
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "0"))   # 0 = DuckDB 預設（CPU 核心數）
+STREAM_PREVIEW_ROWS = int(os.getenv("STREAM_PREVIEW_ROWS", "50"))
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def convert_csvs(data_dir: str = DUCKDB_DATA_DIR, parquet_dir: str = DUCKDB_PARQUET_DIR,
+                 con: Optional["duckdb.DuckDBPyConnection"] = None) -> List[Path]:
+    """CSV → Parquet（以檔名為表名）；Parquet 比 CSV 新時略過"""
+    out_dir = Path(parquet_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    con = con or duckdb.connect()
+    outputs = []
+    for csv_path in sorted(Path(data_dir).glob("*.csv")):
+        target = out_dir / f"{csv_path.stem}.parquet"
+        if not target.exists() or target.stat().st_mtime < csv_path.stat().st_mtime:
+            started = time.time()
+            tmp = target.with_suffix(".tmp")
+            con.execute(f"COPY (SELECT * FROM read_csv_auto({_sql_literal(str(csv_path))}, sample_size=-1)) "
+                        f"TO {_sql_literal(str(tmp))} (FORMAT PARQUET, COMPRESSION ZSTD)")
+            os.replace(tmp, target)
+            print(f"[PARQUET] {csv_path.name} -> {target} in {time.time() - started:.1f}s")
+        outputs.append(target)
+    return outputs
+
+
+class DuckDbAgent:
+    """與 DbAgent 相同介面的 DuckDB 版本；每個執行緒使用各自的 cursor"""
+
+    def __init__(self, data_dir: str = DUCKDB_DATA_DIR, parquet_dir: str = DUCKDB_PARQUET_DIR,
+                 database: str = DUCKDB_PATH, workload_log: Optional["WorkloadLog"] = None):
+        self.name = "DbAgent"
+        self.data_dir = data_dir
+        self.parquet_dir = parquet_dir
+        # 與 Postgres 版 DbAgent 相同的屬性；快取與 EXPLAIN 檢查只適用於 Postgres
+        self.catalog = None
+        self.result_cache = None
+        self.preflight = None
+        self.workload_log = workload_log
+        self._con = duckdb.connect(database)
+        if DUCKDB_THREADS > 0:
+            self._con.execute(f"SET threads = {DUCKDB_THREADS}")
+        self._con.execute("CREATE SCHEMA IF NOT EXISTS public")
+        self._lock = threading.Lock()
+        self._overview: Optional[Dict[str, Any]] = None
+        self._sample_rows = 0
+        self.attach()
+
+    def attach(self):
+        """轉檔並為每個 Parquet 建立 view；cursor 不繼承 SET schema，故 main 與 public 各建一份"""
+        with self._lock:
+            for path in convert_csvs(self.data_dir, self.parquet_dir, self._con):
+                for schema in ("main", "public"):
+                    self._con.execute(f"CREATE OR REPLACE VIEW {schema}.{_quote(path.stem)} AS "
+                                      f"SELECT * FROM read_parquet({_sql_literal(str(path))})")
+            self._overview = None
+
+    def _cursor(self):
+        return self._con.cursor()
+
+    @staticmethod
+    def to_duckdb(sql: str) -> str:
+        try:
+            return sqlglot.transpile(sql, read="postgres", write="duckdb")[0]
+        except (SqlglotError, IndexError):
+            return sql
+
+    def _record(self, sql: str, started: float, rows: Optional[int] = None, error: str = "", mode: str = "buffered"):
+        if self.workload_log is not None:
+            self.workload_log.record(sql, (time.perf_counter() - started) * 1000, rows=rows, error=error,
+                                     mode=f"duckdb-{mode}")
+
+    # ---------- schema ----------
+    def scan_schema(self, sample_rows: int = 5, refresh: bool = False) -> Dict[str, Any]:
+        """schema 概覽（與 SchemaCatalog.get 相同格式）；列數取自 Parquet metadata"""
+        with self._lock:
+            if self._overview is not None and not refresh and sample_rows <= self._sample_rows:
+                return self._overview
+            cur = self._cursor()
+            tables = []
+            names = [r[0] for r in cur.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' ORDER BY 1"
+            ).fetchall()]
+            for name in names:
+                cols = cur.execute(
+                    "SELECT column_name, data_type FROM information_schema.columns "
+                    "WHERE table_schema = 'public' AND table_name = ? ORDER BY ordinal_position", [name]
+                ).fetchall()
+                res = cur.execute(f"SELECT * FROM public.{_quote(name)} LIMIT {int(sample_rows)}")
+                keys = [d[0] for d in res.description]
+                sample = json.loads(json.dumps([dict(zip(keys, r)) for r in res.fetchall()],
+                                               ensure_ascii=False, default=str))
+                total = cur.execute(f"SELECT COUNT(*) FROM public.{_quote(name)}").fetchone()[0]
+                tables.append({"name": name, "columns": [{"name": c, "type": t} for c, t in cols],
+                               "sample": sample, "total_rows": int(total)})
+            self._overview = {"tables": tables, "scan_timestamp": int(time.time() * 1000),
+                              "total_tables": len(tables)}
+            self._sample_rows = sample_rows
+            return self._overview
+
+    # ---------- 查詢 ----------
+    def execute_query(self, sql: str, max_rows: int = 20000) -> Tuple[List[Dict[str, Any]], str]:
+        """安全執行 SQL 查詢"""
+        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
+            return [], "Refused: not a SELECT/WITH statement."
+        started = time.perf_counter()
+        try:
+            res = self._cursor().execute(self.to_duckdb(sql))
+            keys = [d[0] for d in res.description]
+            rows = [dict(zip(keys, r)) for r in res.fetchmany(max_rows)]
+            self._record(sql, started, rows=len(rows))
+            return rows, ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error)
+            return [], error
+
+    def execute_query_columnar(self, sql: str, max_rows: int = 20000) -> Tuple[Optional["ColumnarResult"], str]:
+        """結果直接以 Arrow 取出，不經 Python 物件"""
+        from columnar_result import ColumnarResult
+        import pyarrow as pa
+        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
+            return None, "Refused: not a SELECT/WITH statement."
+        started = time.perf_counter()
+        try:
+            reader = self._cursor().execute(self.to_duckdb(sql)).fetch_record_batch(max_rows)
+            batches, n = [], 0
+            for batch in reader:
+                batches.append(batch.slice(0, max_rows - n))
+                n += batches[-1].num_rows
+                if n >= max_rows:
+                    break
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            self._record(sql, started, rows=table.num_rows, mode="columnar")
+            return ColumnarResult(table), ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error, mode="columnar")
+            return None, error
+
+    def execute_query_stream(self, sql: str, row_pipeline=None, preview_rows: int = STREAM_PREVIEW_ROWS,
+                             max_rows: Optional[int] = None,
+                             batch_size: int = 2000) -> Tuple[List[Dict[str, Any]], Dict[str, Any], str]:
+        """逐批 fetchmany，只保留預覽列並計算累計統計"""
+        if not re.match(r"^(with|select)\b", sql.strip(), re.IGNORECASE):
+            return [], {}, "Refused: not a SELECT/WITH statement."
+        started = time.perf_counter()
+        try:
+            res = self._cursor().execute(self.to_duckdb(sql))
+            keys = [d[0] for d in res.description]
+
+            def iter_rows():
+                n = 0
+                while True:
+                    part = res.fetchmany(batch_size)
+                    if not part:
+                        return
+                    for r in part:
+                        if max_rows is not None and n >= max_rows:
+                            return
+                        n += 1
+                        yield dict(zip(keys, r))
+
+            rows = iter_rows()
+            if row_pipeline is not None:
+                rows = row_pipeline(rows)
+            preview, summary = consume(rows, preview_rows=preview_rows)
+            self._record(sql, started, rows=summary.get("row_count"), mode="stream")
+            return preview, summary, ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self._record(sql, started, error=error, mode="stream")
+            return [], {}, error
+
+    def get_table_stats(self, table_name: str) -> Dict[str, Any]:
+        """取得特定資料表的統計資訊"""
+        try:
+            cur = self._cursor()
+            stats = {"row_count": cur.execute(f"SELECT COUNT(*) FROM public.{_quote(table_name)}").fetchone()[0]}
+            cols = cur.execute(
+                "SELECT column_name, data_type, is_nullable FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = ?", [table_name]
+            ).fetchall()
+            stats["columns"] = [{"column_name": c, "data_type": t, "is_nullable": n} for c, t, n in cols]
+            return stats
+        except Exception as e:
+            return {"error": str(e)}
@@ -0,0 +1,110 @@
+# embedding_service.py — 全程序共用的 embedding 模型與批次編碼服務
+# 模型於第一次使用時才載入（每個 process 一份），
+# 並把多個呼叫端同時送來的短文字合併成一次 encode 呼叫（micro-batching）。
+# pip install sentence-transformers
+
+import os, threading, queue
+from concurrent.futures import Future
+from typing import List, Optional
+
+# 384 維 MiniLM，務必 cosine + normalize（Mongo 向量索引依此建立）
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """延遲載入 SentenceTransformer；同一 process 只載入一次"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBED_MODEL_NAME)
+    return _model
+
+
+class EmbeddingService:
+    """把並行呼叫端的文字合併成一次 model.encode 的批次編碼服務"""
+
+    def __init__(self, max_batch: int = EMBED_MAX_BATCH, max_wait_ms: float = EMBED_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """回傳正規化後的向量（list of float）"""
+        if not texts:
+            return []
+        # 大批量（例如 ingest）直接編碼，不進佇列
+        if len(texts) >= self.max_batch:
+            return _encode_now(texts, self.max_batch)
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((list(texts), fut))
+        return fut.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            # 在 max_wait 內收集更多請求，湊成一批
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            texts = [t for batch, _ in pending for t in batch]
+            try:
+                vecs = _encode_now(texts, self.max_batch)
+            except Exception as e:
+                for _, fut in pending:
+                    fut.set_exception(e)
+                continue
+            i = 0
+            for batch, fut in pending:
+                fut.set_result(vecs[i:i + len(batch)])
+                i += len(batch)
+
+
+def _encode_now(texts: List[str], batch_size: int) -> List[List[float]]:
+    return get_model().encode(texts, batch_size=batch_size, normalize_embeddings=True).tolist()
+
+
+_service: Optional[EmbeddingService] = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService()
+    return _service
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """批次編碼多段文字"""
+    return get_embedding_service().encode(texts)
+
+
+def embed_query(query: str) -> List[float]:
+    """編碼單一查詢字串"""
+    return get_embedding_service().encode([query])[0]
@@ -0,0 +1,121 @@
+# hybrid_search.py — BM25 + 向量的混合檢索（reciprocal-rank fusion）
+# schema card 內含 VipLV、LoginDate 等精確欄位名，MiniLM 向量對這類字串比對不佳；
+# 以倒排 BM25 索引補上精確詞比對，再與向量結果做 RRF 融合。
+# type 過濾（schema / doc）在評分前套用，兩路都只在符合的 card 中排名。
+# 語料來源為 vector_index 的本地 card（同一份 text/type），索引隨其同步重建；
+# 每次查詢只取一次索引快照，向量、BM25 與回傳的 card 都來自同一份，與並行的同步互不干擾。
+
+import re, math, threading
+from collections import Counter, defaultdict
+from typing import List, Dict, Any, Optional, Tuple
+
+from vector_index import get_local_index, LocalVectorIndex, IndexSnapshot
+
+RRF_K = 60
+
+_WORD = re.compile(r"[A-Za-z][A-Za-z0-9_]*|\d+|[一-鿿]+")
+_CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z]|\d|$)|[A-Z]?[a-z]+|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """英數識別字保留整體（viplv）並拆 camelCase（vip, lv）；中文以單字 + 雙字詞切分"""
+    out: List[str] = []
+    for w in _WORD.findall(text or ""):
+        if "一" <= w[0] <= "鿿":
+            out.extend(w)
+            out.extend(w[i:i + 2] for i in range(len(w) - 1))
+            continue
+        lw = w.lower()
+        out.append(lw)
+        parts = [p.lower() for p in _CAMEL.findall(w.replace("_", " "))]
+        if len(parts) > 1:
+            out.extend(parts)
+    return out
+
+
+class BM25Index:
+    """倒排 BM25：term -> [(doc_idx, tf)]；查詢只走訪 query term 的 posting list"""
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_len: List[int] = []
+        for i, t in enumerate(texts):
+            tf = Counter(tokenize(t))
+            self.doc_len.append(sum(tf.values()))
+            for term, n in tf.items():
+                self.postings[term].append((i, n))
+        self.n_docs = len(texts)
+        self.avgdl = (sum(self.doc_len) / self.n_docs) if self.n_docs else 0.0
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int, allowed=None) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf(term)
+            for i, tf in plist:
+                if allowed is not None and not allowed[i]:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[i] / (self.avgdl or 1))
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: -x[1])[:k]
+
+
+class HybridSearcher:
+    """在本地向量索引之上加一層 BM25，索引快照替換時重建"""
+
+    def __init__(self, index: LocalVectorIndex):
+        self.index = index
+        self._bm25: Optional[BM25Index] = None
+        self._built_for: Optional[IndexSnapshot] = None
+        self._lock = threading.Lock()
+
+    def bm25(self, snap: Optional[IndexSnapshot] = None) -> BM25Index:
+        """snap 對應的 BM25 索引（預設為目前快照）"""
+        snap = snap or self.index.snapshot()
+        with self._lock:
+            if self._built_for is not snap:
+                self._bm25 = BM25Index([f"{d.get('title','')}\n{d.get('text','')}" for d in snap.docs])
+                self._built_for = snap
+            return self._bm25
+
+    def search(self, query: str, query_vec, k: int = 6, card_type: Optional[str] = None,
+               candidates: Optional[int] = None, rrf_k: int = RRF_K) -> List[Dict[str, Any]]:
+        snap = self.index.snapshot()
+        docs, ids = snap.docs, snap.ids
+        if not docs:
+            return []
+        candidates = candidates or max(k * 4, 20)
+        allowed = None
+        if card_type is not None:
+            allowed = [d.get("type") == card_type for d in docs]
+
+        pos = {cid: i for i, cid in enumerate(ids)}
+        vec_ranked = [pos[c["_id"]] for c in self.index.search(query_vec, candidates, card_type, snapshot=snap)]
+        bm25_ranked = [i for i, _ in self.bm25(snap).search(query, candidates, allowed)]
+
+        fused: Dict[int, float] = defaultdict(float)
+        ranks: Dict[int, Dict[str, int]] = defaultdict(dict)
+        for name, ranked in (("vector", vec_ranked), ("bm25", bm25_ranked)):
+            for r, i in enumerate(ranked, 1):
+                fused[i] += 1.0 / (rrf_k + r)
+                ranks[i][f"{name}_rank"] = r
+
+        top = sorted(fused.items(), key=lambda x: -x[1])[:k]
+        return [{**docs[i], "_id": ids[i], "score": s, **ranks[i]} for i, s in top]
+
+
+_searcher: Optional[HybridSearcher] = None
+
+
+def get_hybrid_searcher() -> HybridSearcher:
+    global _searcher
+    if _searcher is None:
+        _searcher = HybridSearcher(get_local_index())
+    return _searcher
@@ -0,0 +1,363 @@
+# index_advisor.py — 以實際 SQL 工作負載驅動的索引建議
+# 1) WorkloadLog：DbAgent 每次實際送到資料庫的 SQL 與耗時（JSON lines）
+# 2) mine_workload：以 sqlglot 解析每筆 SQL，依子句歸類欄位用途（等值/範圍過濾、JOIN、GROUP BY），
+#    以執行時間加權
+# 3) IndexAdvisor.propose：
+#    - 等值欄位在前、範圍欄位在後的複合 B-tree（Country, VipLV, LoginDate）
+#    - 只有日期範圍且欄位與實體順序高度相關（pg_stats.correlation）時用 BRIN，體積極小
+#    - JOIN 欄位（UDID）單欄 B-tree；已被既有索引前綴涵蓋、或表太小者略過
+# 4) apply：以 EXPLAIN ANALYZE 量測熱門查詢 → CREATE INDEX CONCURRENTLY → 再量測，輸出加速報告
+#
+# 用法：python index_advisor.py            # 只列出建議
+#       python index_advisor.py --apply    # 建立索引並輸出前後耗時報告
+
+import os, re, sys, json, time, threading
+from collections import defaultdict
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.scope import traverse_scope
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+WORKLOAD_LOG_ENABLED = os.getenv("WORKLOAD_LOG", "1") != "0"
+WORKLOAD_LOG_PATH = os.getenv("WORKLOAD_LOG_PATH", ".cache/workload.jsonl")
+ADVISOR_MIN_ROWS = int(os.getenv("ADVISOR_MIN_ROWS", "100000"))        # 小於此列數的表不建議索引
+ADVISOR_MAX_INDEXES = int(os.getenv("ADVISOR_MAX_INDEXES", "5"))
+ADVISOR_BRIN_CORRELATION = float(os.getenv("ADVISOR_BRIN_CORRELATION", "0.9"))
+ADVISOR_BENCH_QUERIES = int(os.getenv("ADVISOR_BENCH_QUERIES", "10"))
+ADVISOR_REPORT_PATH = os.getenv("ADVISOR_REPORT_PATH", ".cache/index_advisor_report.md")
+
+_RANGE_OPS = (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between)
+
+
+# ---------- 1) 工作負載紀錄 ----------
+class WorkloadLog:
+    def __init__(self, path: str = WORKLOAD_LOG_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, ms: float, rows: Optional[int] = None, error: str = "", mode: str = "buffered"):
+        entry = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "sql": sql, "ms": round(ms, 2),
+                 "rows": rows, "error": error[:200], "mode": mode}
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def entries(self, include_errors: bool = False) -> List[Dict[str, Any]]:
+        if not self.path.exists():
+            return []
+        out = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                if include_errors or not e.get("error"):
+                    out.append(e)
+        return out
+
+
+# ---------- 2) 欄位用途探勘 ----------
+def _ident(node: exp.Identifier) -> str:
+    return node.this if node.quoted else node.this.lower()
+
+
+def _usage(col: exp.Column) -> Optional[str]:
+    """欄位在 WHERE / JOIN ON / GROUP BY 中的用途：eq、range、join、group；其他位置回傳 None"""
+    clause = col.find_ancestor(exp.Where, exp.Join, exp.Group, exp.Select)
+    if isinstance(clause, exp.Group):
+        return "group"
+    if not isinstance(clause, (exp.Where, exp.Join)):
+        return None
+    node = col
+    while isinstance(node.parent, (exp.Paren, exp.Cast)):
+        node = node.parent
+    p = node.parent
+    if isinstance(p, exp.EQ):
+        other = p.expression if p.this is node else p.this
+        return "join" if isinstance(other, exp.Column) else "eq"
+    if isinstance(p, exp.In) and p.this is node:
+        return "eq"
+    if isinstance(p, _RANGE_OPS) and (p.this is node or not isinstance(p, exp.Between)):
+        return "range"
+    return None
+
+
+def mine_sql(sql: str, columns: Dict[str, Set[str]]) -> Dict[str, Dict[str, Set[str]]]:
+    """單筆 SQL → {table: {"eq": {...}, "range": {...}, "join": {...}, "group": {...}}}"""
+    usage: Dict[str, Dict[str, Set[str]]] = defaultdict(lambda: defaultdict(set))
+    try:
+        scopes = traverse_scope(sqlglot.parse_one(sql, read="postgres"))
+    except SqlglotError:
+        return {}
+    for scope in scopes:
+        tables = {alias: _ident(src.this) for alias, src in scope.sources.items()
+                  if isinstance(src, exp.Table) and isinstance(src.this, exp.Identifier)}
+        for col in scope.columns:
+            if not isinstance(col.this, exp.Identifier) or col.find_ancestor(exp.Query) is not scope.expression:
+                continue
+            name = _ident(col.this)
+            if col.table:
+                table = tables.get(col.table)
+            else:
+                owners = [t for t in tables.values() if name in columns.get(t, ())]
+                table = owners[0] if len(owners) == 1 else None
+            if table is None or name not in columns.get(table, ()):
+                continue
+            kind = _usage(col)
+            if kind:
+                usage[table][kind].add(name)
+    return {t: dict(k) for t, k in usage.items()}
+
+
+def mine_workload(entries: List[Dict[str, Any]], columns: Dict[str, Set[str]]) -> Dict[str, Any]:
+    """彙總整個工作負載：欄位層級的加權統計 + 每個 (表, 等值欄位, 範圍欄位) 組合的權重"""
+    column_stats: Dict[Tuple[str, str, str], Dict[str, float]] = defaultdict(lambda: {"count": 0, "ms": 0.0})
+    patterns: Dict[Tuple[str, Tuple[str, ...], Tuple[str, ...]], Dict[str, float]] = \
+        defaultdict(lambda: {"count": 0, "ms": 0.0})
+    for e in entries:
+        for table, kinds in mine_sql(e["sql"], columns).items():
+            for kind, cols in kinds.items():
+                for c in cols:
+                    st = column_stats[(table, c, kind)]
+                    st["count"] += 1
+                    st["ms"] += e["ms"]
+            if kinds.get("eq") or kinds.get("range"):
+                key = (table, tuple(sorted(kinds.get("eq", ()))), tuple(sorted(kinds.get("range", ()))))
+                patterns[key]["count"] += 1
+                patterns[key]["ms"] += e["ms"]
+    return {"columns": dict(column_stats), "patterns": dict(patterns)}
+
+
+# ---------- 3) 建議與套用 ----------
+class IndexAdvisor:
+    def __init__(self, engine: Engine, schema: str = "public", log: Optional[WorkloadLog] = None):
+        self.engine = engine
+        self.schema = schema
+        self.log = log or WorkloadLog()
+
+    def _catalog(self) -> Tuple[Dict[str, Set[str]], Dict[str, int], Dict[Tuple[str, str], float], Dict[str, List[Tuple[str, List[str]]]]]:
+        """欄位、估計列數、欄位與實體順序的相關係數、既有索引 (method, 欄位清單)"""
+        with self.engine.connect() as conn:
+            columns: Dict[str, Set[str]] = defaultdict(set)
+            for t, c in conn.execute(text("""
+                SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = :s
+            """), {"s": self.schema}):
+                columns[t].add(c)
+            rows = {r[0]: int(r[1] or 0) for r in conn.execute(text("""
+                SELECT c.relname, GREATEST(c.reltuples, 0)::bigint FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = :s AND c.relkind IN ('r', 'p')
+            """), {"s": self.schema})}
+            corr = {(r[0], r[1]): float(r[2]) for r in conn.execute(text("""
+                SELECT tablename, attname, correlation FROM pg_stats
+                WHERE schemaname = :s AND correlation IS NOT NULL
+            """), {"s": self.schema})}
+            existing: Dict[str, List[Tuple[str, List[str]]]] = defaultdict(list)
+            for t, method, cols in conn.execute(text("""
+                SELECT t.relname, am.amname,
+                       ARRAY(SELECT a.attname FROM unnest(ix.indkey) WITH ORDINALITY k(attnum, ord)
+                             JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+                             ORDER BY k.ord)
+                FROM pg_index ix
+                JOIN pg_class t ON t.oid = ix.indrelid
+                JOIN pg_class i ON i.oid = ix.indexrelid
+                JOIN pg_am am ON am.oid = i.relam
+                JOIN pg_namespace n ON n.oid = t.relnamespace
+                WHERE n.nspname = :s AND ix.indisvalid
+            """), {"s": self.schema}):
+                # INVALID 索引（CONCURRENTLY 建立失敗的殘留）不算已存在，apply 時會刪除重建
+                existing[t].append((method, list(cols)))
+        return dict(columns), rows, corr, dict(existing)
+
+    @staticmethod
+    def _covered(method: str, cols: List[str], existing: List[Tuple[str, List[str]]]) -> bool:
+        for m, ex in existing:
+            if m == method and ex[:len(cols)] == cols:
+                return True
+            # BRIN 建議的欄位已是某個 B-tree 的第一欄時也不必再建
+            if method == "brin" and m == "btree" and ex[:1] == cols:
+                return True
+        return False
+
+    def _entries(self) -> List[Dict[str, Any]]:
+        """只取 Postgres 的執行紀錄；DuckDB 後端（mode 為 duckdb-*）的耗時與 Postgres 索引無關"""
+        return [e for e in self.log.entries() if not str(e.get("mode", "")).startswith("duckdb")]
+
+    def propose(self, entries: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        entries = self._entries() if entries is None else entries
+        columns, rows, corr, existing = self._catalog()
+        mined = mine_workload(entries, columns)
+
+        freq: Dict[Tuple[str, str], float] = defaultdict(float)
+        for (table, col, kind), st in mined["columns"].items():
+            if kind in ("eq", "range"):
+                freq[(table, col)] += st["ms"]
+
+        candidates: Dict[Tuple[str, str, Tuple[str, ...]], Dict[str, Any]] = {}
+
+        def add(table: str, method: str, cols: List[str], reason: str, st: Dict[str, float]):
+            key = (table, method, tuple(cols))
+            c = candidates.setdefault(key, {"table": table, "method": method, "columns": cols,
+                                            "reason": reason, "queries": 0, "ms": 0.0})
+            c["queries"] += st["count"]
+            c["ms"] += st["ms"]
+
+        # 過濾條件：等值欄位（依權重排序，最多 2 個）在前，第一個範圍欄位在後
+        for (table, eq, rng), st in mined["patterns"].items():
+            eq_cols = sorted(eq, key=lambda c: -freq[(table, c)])[:2]
+            rng_cols = sorted(rng, key=lambda c: -freq[(table, c)])[:1]
+            if not eq_cols and rng_cols and abs(corr.get((table, rng_cols[0]), 0.0)) >= ADVISOR_BRIN_CORRELATION:
+                add(table, "brin", rng_cols, f"range filter on {rng_cols[0]} (physically ordered)", st)
+            else:
+                add(table, "btree", eq_cols + rng_cols,
+                    "filter " + ", ".join([f"{c} =" for c in eq_cols] + [f"{c} range" for c in rng_cols]), st)
+
+        # JOIN 欄位
+        for (table, col, kind), st in mined["columns"].items():
+            if kind == "join":
+                add(table, "btree", [col], f"join key {col}", st)
+
+        proposals = []
+        for c in sorted(candidates.values(), key=lambda x: -x["ms"]):
+            if rows.get(c["table"], 0) < ADVISOR_MIN_ROWS:
+                continue
+            if self._covered(c["method"], c["columns"], existing.get(c["table"], [])):
+                continue
+            # 已被同表另一個建議（較多欄位、同前綴）涵蓋
+            if any(p["table"] == c["table"] and p["method"] == c["method"]
+                   and p["columns"][:len(c["columns"])] == c["columns"] for p in proposals):
+                continue
+            name = f"ix_{c['table'].lstrip('_')}_{'_'.join(c['columns'])}_{c['method']}"[:63]
+            cols_q = ", ".join(f'"{col}"' for col in c["columns"])
+            c["name"] = name
+            c["ddl"] = (f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{self.schema}"."{c["table"]}" '
+                        f'USING {c["method"]} ({cols_q})')
+            c["ms"] = round(c["ms"], 1)
+            proposals.append(c)
+            if len(proposals) >= ADVISOR_MAX_INDEXES:
+                break
+        return proposals
+
+    # ---------- 量測 ----------
+    def _hot_queries(self, entries: List[Dict[str, Any]], tables: Set[str]) -> List[str]:
+        """涉及建議表的查詢，依累計耗時排序（相同 SQL 只取一次）"""
+        total: Dict[str, float] = defaultdict(float)
+        for e in entries:
+            total[re.sub(r"\s+", " ", e["sql"]).strip()] += e["ms"]
+        hot = []
+        for sql, _ in sorted(total.items(), key=lambda x: -x[1]):
+            if any(f'"{t}"' in sql or re.search(rf"\b{re.escape(t)}\b", sql) for t in tables):
+                hot.append(sql)
+            if len(hot) >= ADVISOR_BENCH_QUERIES:
+                break
+        return hot
+
+    def measure(self, sql: str) -> Optional[float]:
+        """EXPLAIN ANALYZE 的 Execution Time（毫秒），兩次取較小值以降低快取冷熱影響"""
+        best = None
+        try:
+            with self.engine.begin() as conn:
+                for _ in range(2):
+                    raw = conn.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}")).scalar()
+                    doc = json.loads(raw) if isinstance(raw, str) else raw
+                    ms = float(doc[0]["Execution Time"])
+                    best = ms if best is None else min(best, ms)
+        except Exception as e:
+            print(f"[warn] measure failed: {type(e).__name__}: {e}")
+        return best
+
+    def apply(self, proposals: List[Dict[str, Any]], entries: Optional[List[Dict[str, Any]]] = None,
+              report_path: str = ADVISOR_REPORT_PATH) -> str:
+        entries = self._entries() if entries is None else entries
+        hot = self._hot_queries(entries, {p["table"] for p in proposals})
+        before = {sql: self.measure(sql) for sql in hot}
+
+        # CREATE INDEX CONCURRENTLY 不能在交易中執行；單一索引失敗只記入報告，不影響其他索引
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for p in proposals:
+                idx_q = f'"{self.schema}"."{p["name"]}"'
+                started = time.time()
+                try:
+                    if self._index_valid(conn, p["name"]) is False:
+                        # 先前失敗留下的 INVALID 索引：IF NOT EXISTS 會把它當成已存在
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {idx_q}"))
+                    conn.execute(text(p["ddl"]))
+                    p["build_seconds"] = round(time.time() - started, 2)
+                    print(f"[INDEX] {p['name']} built in {p['build_seconds']}s")
+                except Exception as e:
+                    p["error"] = f"{type(e).__name__}: {str(e).splitlines()[0]}"
+                    print(f"[FAIL] {p['name']}: {p['error']}")
+                    try:
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {idx_q}"))
+                    except Exception as drop_error:
+                        print(f"[warn] could not drop {p['name']}: {drop_error}")
+            for t in sorted({p["table"] for p in proposals if "build_seconds" in p}):
+                conn.execute(text(f'ANALYZE "{self.schema}"."{t}"'))
+
+        after = {sql: self.measure(sql) for sql in hot}
+        report = self.report(proposals, before, after)
+        path = Path(report_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(report, encoding="utf-8")
+        return report
+
+    def _index_valid(self, conn, name: str) -> Optional[bool]:
+        """None = 索引不存在；否則回傳 pg_index.indisvalid"""
+        row = conn.execute(text("""
+            SELECT ix.indisvalid FROM pg_index ix
+            JOIN pg_class i ON i.oid = ix.indexrelid
+            JOIN pg_namespace n ON n.oid = i.relnamespace
+            WHERE n.nspname = :s AND i.relname = :i
+        """), {"s": self.schema, "i": name}).fetchone()
+        return None if row is None else bool(row[0])
+
+    @staticmethod
+    def report(proposals: List[Dict[str, Any]], before: Optional[Dict[str, Optional[float]]] = None,
+               after: Optional[Dict[str, Optional[float]]] = None) -> str:
+        lines = ["# Index advisor report", "",
+                 "| index | method | columns | queries | workload ms | reason | status |",
+                 "|---|---|---|---|---|---|---|"]
+        for p in proposals:
+            if p.get("error"):
+                status = f"failed: {p['error']}"
+            elif "build_seconds" in p:
+                status = f"built in {p['build_seconds']}s"
+            else:
+                status = "proposed"
+            lines.append(f"| {p['name']} | {p['method']} | {', '.join(p['columns'])} | {p['queries']} "
+                         f"| {p['ms']} | {p['reason']} | {status.replace('|', '/')} |")
+        if before:
+            lines += ["", "| query | before ms | after ms | speedup |", "|---|---|---|---|"]
+            for sql, b in before.items():
+                a = (after or {}).get(sql)
+                speedup = f"{b / a:.1f}x" if a and b else "-"
+                short = sql if len(sql) <= 120 else sql[:117] + "..."
+                lines.append(f"| `{short}` | {b if b is not None else '-'} | {a if a is not None else '-'} | {speedup} |")
+        return "\n".join(lines) + "\n"
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    engine = create_engine(os.getenv("PG_URI"), pool_pre_ping=True)
+    advisor = IndexAdvisor(engine, schema=os.getenv("PG_SCHEMA", "public"))
+    proposals = advisor.propose()
+    if not proposals:
+        print("No index proposals (workload empty, tables small, or already indexed).")
+        return
+    if "--apply" in sys.argv[1:]:
+        print(advisor.apply(proposals))
+    else:
+        print(advisor.report(proposals))
+        for p in proposals:
+            print(p["ddl"] + ";")
+
+
+if __name__ == "__main__":
+    main()
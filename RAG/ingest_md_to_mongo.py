@@ -1,103 +1,113 @@
 import os, time, hashlib
 from pathlib import Path
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from sentence_transformers import SentenceTransformer
-from markdown import markdown
-from bs4 import BeautifulSoup
-import certifi
+from embedding_service import embed_texts
+from md_chunker import chunk_markdown
+from pymongo import UpdateOne, DeleteMany
+from mongo_pool import get_collection
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")  
 
-client = MongoClient(
-    MONGO_URI,
-    tls=True,                      # 或 ssl=True（pymongo 新版用 tls）
-    tlsCAFile=certifi.where(),     # 關鍵：指定可信 CA
-    serverSelectionTimeoutMS=30000 # 30s
-)
-db = client["ragdb"]
-col = db["cards"]
-
-# 384 維 MiniLM，務必 cosine + normalize
-emb = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+def cards_col():
+    """共用連線池（TLS + certifi CA、30s server selection 由 mongo_pool 設定）；
+    延遲取得，讓 parser worker process 匯入本模組時不會建立 Mongo 連線"""
+    return get_collection("ragdb", "cards", uri=MONGO_URI)
 
 def sha256(s: str) -> str:
     import hashlib
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 def md_to_chunks(md_text: str, doc_title: str):
-    html = markdown(md_text)
-    soup = BeautifulSoup(html, "html.parser")
-    chunks, buff, cur = [], [], doc_title
-
-    def flush():
-        if buff:
-            text = "\n\n".join(buff).strip()
-            if text:
-                chunks.append({"title": cur, "text": text})
-        buff.clear()
-
-    for el in soup.recursiveChildGenerator():
-        if el.name in ("h1", "h2"):
-            flush(); cur = el.get_text().strip()
-        elif el.name in ("p", "li"):
-            t = el.get_text(" ", strip=True)
-            if t: buff.append(t)
-    flush()
-
-    # 粗略長度控制（可換 token-based）
-    MAXC, MINC = 1200, 200
-    final = []
-    for c in chunks:
-        t = c["text"]
-        if len(t) > 3*MAXC:
-            for i in range(0, len(t), MAXC):
-                final.append({"title": c["title"], "text": t[i:i+MAXC]})
-        else:
-            final.append(c)
-    # 合併太短片段
-    merged = []
-    for c in final:
-        if merged and len(c["text"]) < MINC:
-            merged[-1]["text"] += "\n\n" + c["text"]
-        else:
-            merged.append(c)
-    return merged
+    """以 md_chunker 切塊：直接走訪 markdown token 串流，依 tiktoken 長度裝箱並保留標題路徑
+    回傳 [{"title", "text", "heading_path", "tokens"}]"""
+    return chunk_markdown(md_text, doc_title)
 
-def upsert_card(doc):
-    col.update_one(
-        {
-            "type": doc["type"],
-            "title": doc["title"],
-            "source_path": doc["source_path"],
-            "content_hash": doc["content_hash"]
-        },
-        {"$set": doc},
-        upsert=True
-    )
+def card_filter(doc):
+    """card 的唯一鍵：同一來源檔的同一個 chunk 標題（content_hash 不在 key 內，內容變更時覆寫而非新增）"""
+    return {"type": doc["type"], "title": doc["title"], "source_path": doc["source_path"]}
 
-def ingest_one(md_path: Path, card_type="doc"):
+def build_cards(md_path: Path, card_type="doc"):
+    """解析 md 檔為 card 文件（尚未含 embedding）"""
     md = md_path.read_text(encoding="utf-8")
     base_title = md_path.stem
     chunks = md_to_chunks(md, base_title)
-    vecs = emb.encode([c["text"] for c in chunks], normalize_embeddings=True).tolist()
-
+    docs = []
     for i, c in enumerate(chunks):
         content = f"# {c['title']}\n\n{c['text']}"
-        doc = {
+        docs.append({
             "type": card_type,
             "title": f"{base_title}::chunk_{i:03d}",
             "text": content,
-            "meta": {"doc": base_title, "chunk_id": i, "tags": ["betting","metrics"]},
+            "meta": {"doc": base_title, "chunk_id": i, "tags": ["betting","metrics"],
+                     "heading_path": c["heading_path"], "tokens": c["tokens"]},
             "source_path": str(md_path),
             "content_hash": sha256(content),
-            "embedding": vecs[i],
-            "updatedAt": time.time()
-        }
-        upsert_card(doc)
-    print(f"Ingested {md_path.name}: {len(chunks)} chunks")
+            "_embed_text": c["text"],
+        })
+    return docs
+
+def plan_sync(docs, existing):
+    """以 content_hash 比對新 chunk 與已存 card（與位置無關）：回傳 (需 embed 的 doc, 移位的 card, 需刪除的 _id)
+    existing: [{_id, title, content_hash, meta}]
+    - 內容相同的 card 沿用原本的文件與 embedding；只有標題/metadata 因前面插入或刪除 chunk 而改變時列為移位
+    - 找不到相同內容的 chunk 才需要 embed；沒被沿用的既有 card 視為過期"""
+    pool = {}
+    for e in existing:
+        pool.setdefault(e.get("content_hash"), []).append(e)
+    changed, moved = [], []
+    for d in docs:
+        same = pool.get(d["content_hash"])
+        if not same:
+            changed.append(d)
+            continue
+        # 同內容有多張時優先沿用標題相同的那張
+        e = next((x for x in same if x.get("title") == d["title"]), same[0])
+        same.remove(e)
+        if e.get("title") != d["title"] or e.get("meta") != d["meta"]:
+            moved.append((e["_id"], d))
+    stale_ids = [e["_id"] for rest in pool.values() for e in rest]
+    return changed, moved, stale_ids
+
+def build_ops(changed, vecs, stale_ids, moved=()):
+    """組出 bulk_write 操作：先刪除過期 card，再更新移位 card 的標題/metadata（保留 embedding），
+    最後 upsert 新增/變更的 card"""
+    ops = []
+    if stale_ids:
+        ops.append(DeleteMany({"_id": {"$in": stale_ids}}))
+    now = time.time()
+    for _id, d in moved:
+        doc = {k: val for k, val in d.items() if k != "_embed_text"}
+        doc["updatedAt"] = now
+        ops.append(UpdateOne({"_id": _id}, {"$set": doc}))
+    for d, v in zip(changed, vecs):
+        doc = {k: val for k, val in d.items() if k != "_embed_text"}
+        doc["embedding"] = v
+        doc["updatedAt"] = now
+        ops.append(UpdateOne(card_filter(doc), {"$set": doc}, upsert=True))
+    return ops
+
+def ingest_one(md_path: Path, card_type="doc"):
+    docs = build_cards(md_path, card_type)
+
+    # 一次查回此來源檔已存在的 card（只取比對所需欄位）
+    existing = list(cards_col().find({"type": card_type, "source_path": str(md_path)},
+                             {"_id": 1, "title": 1, "content_hash": 1, "meta": 1}))
+    changed, moved, stale_ids = plan_sync(docs, existing)
+
+    # 只對新增或內容變更的 chunk 計算 embedding
+    vecs = embed_texts([d["_embed_text"] for d in changed]) if changed else []
+
+    ops = build_ops(changed, vecs, stale_ids, moved)
+    if ops:
+        # 依序執行：先刪過期文件、再改移位 card 的標題，最後 upsert，避免同標題重複
+        cards_col().bulk_write(ops, ordered=True)
+
+    print(f"Ingested {md_path.name}: {len(docs)} chunks "
+          f"({len(changed)} embedded, {len(moved)} moved, {len(docs) - len(changed) - len(moved)} unchanged, "
+          f"{len(stale_ids)} removed)")
+    return {"chunks": len(docs), "embedded": len(changed), "moved": len(moved), "removed": len(stale_ids)}
 
 if __name__ == "__main__":
     # 你附件的 md 檔（改成你的實際路徑）
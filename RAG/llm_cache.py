@@ -0,0 +1,163 @@
+# llm_cache.py — chat() 的持久化回應快取
+# 1) 精確比對層：以 (model, messages, temperature, max_tokens) 的 hash 為 key
+# 2) 語意相似層（選用）：呼叫端以 semantic_key 指出 prompt 中的使用者問題；
+#    只 embed 這段問題（不含 reference / schema 等附帶內容），
+#    且 prompt 其餘部分（含 system prompt）必須完全相同，問題的 cosine 相似度 >= 門檻才視為命中。
+#    未提供 semantic_key 的呼叫只做精確比對。
+# 儲存於 SQLite，超過上限時依最後存取時間做 LRU 淘汰，並統計 hit/miss。
+
+import os, json, time, hashlib, sqlite3, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+# 0 表示停用語意層；SQL 生成等對細節敏感的 prompt 建議維持停用或設很高的門檻（如 0.98）
+LLM_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("LLM_CACHE_SEMANTIC_THRESHOLD", "0"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key         TEXT PRIMARY KEY,
+    scope       TEXT NOT NULL,
+    response    TEXT NOT NULL,
+    embedding   TEXT,
+    created_at  REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS llm_cache_scope ON llm_cache(scope);
+CREATE INDEX IF NOT EXISTS llm_cache_access ON llm_cache(last_access);
+"""
+
+
+def _hash(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """以 SQLite 儲存的 LLM 回應快取（精確 + 選用語意相似層）"""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 semantic_threshold: float = LLM_CACHE_SEMANTIC_THRESHOLD):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.semantic_threshold = semantic_threshold
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    # ---------- keys ----------
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+        return _hash({"model": model, "messages": messages,
+                      "temperature": temperature, "max_tokens": max_tokens})
+
+    @staticmethod
+    def _scope(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+               question: str) -> str:
+        """語意層只在相同 model/參數、且遮掉問題後 prompt 完全相同的項目之間比較"""
+        masked = [{**m, "content": m.get("content", "").replace(question, "\x00question\x00")} for m in messages]
+        return _hash({"model": model, "messages": masked,
+                      "temperature": temperature, "max_tokens": max_tokens})
+
+    # ---------- lookup ----------
+    def get(self, model: str, messages: List[Dict[str, str]],
+            temperature: float, max_tokens: int, semantic_key: Optional[str] = None) -> Optional[str]:
+        key = self.make_key(model, messages, temperature, max_tokens)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+                self._db.commit()
+                self.hits += 1
+                return row[0]
+
+        if self.semantic_threshold > 0 and semantic_key:
+            hit = self._semantic_get(model, messages, temperature, max_tokens, semantic_key)
+            if hit is not None:
+                return hit
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _semantic_get(self, model, messages, temperature, max_tokens, question: str) -> Optional[str]:
+        import numpy as np
+        from embedding_service import embed_query
+
+        scope = self._scope(model, messages, temperature, max_tokens, question)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, response, embedding FROM llm_cache WHERE scope = ? AND embedding IS NOT NULL",
+                (scope,)
+            ).fetchall()
+        if not rows:
+            return None
+
+        qv = np.asarray(embed_query(question), dtype=np.float32)
+        mat = np.asarray([json.loads(r[2]) for r in rows], dtype=np.float32)
+        scores = mat @ qv  # 向量皆已正規化，內積即 cosine
+        best = int(np.argmax(scores))
+        if float(scores[best]) < self.semantic_threshold:
+            return None
+
+        with self._lock:
+            self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), rows[best][0]))
+            self._db.commit()
+            self.semantic_hits += 1
+        return rows[best][1]
+
+    # ---------- store ----------
+    def put(self, model: str, messages: List[Dict[str, str]],
+            temperature: float, max_tokens: int, response: str, semantic_key: Optional[str] = None):
+        key = self.make_key(model, messages, temperature, max_tokens)
+        # 沒有 semantic_key 時不遮罩（空字串 replace 會在每個字元間插入標記），只供精確比對
+        scope = self._scope(model, messages, temperature, max_tokens, semantic_key) if semantic_key else key
+        embedding = None
+        if self.semantic_threshold > 0 and semantic_key:
+            from embedding_service import embed_query
+            embedding = json.dumps(embed_query(semantic_key))
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, scope, response, embedding, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, response, embedding, now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """超過上限時刪除最久未存取的項目（LRU）"""
+        n = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if n > self.max_entries:
+            self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (n - self.max_entries,)
+            )
+
+    # ---------- maintenance ----------
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            hits, semantic_hits, misses = self.hits, self.semantic_hits, self.misses
+        total = hits + semantic_hits + misses
+        return {
+            "entries": size,
+            "hits": hits,
+            "semantic_hits": semantic_hits,
+            "misses": misses,
+            "hit_rate": round((hits + semantic_hits) / total, 4) if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM llm_cache")
+            self._db.commit()
+            self.hits = self.semantic_hits = self.misses = 0
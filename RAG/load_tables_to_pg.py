@@ -1,149 +1,242 @@
 # load_tables_to_pg.py
 # pip3 install pandas sqlalchemy psycopg2-binary python-dotenv
-import os
-import pandas as pd
+import os, sys, csv, json, time
+import psycopg2
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
+from bulk_loader import load_csv_resumable, pg_dsn
+from rollups import RollupManager, ROLLUPS_ENABLED
 
 load_dotenv()
 
 PG_URI   = os.getenv("PG_URI")                 # postgresql://...sslmode=require
 SCHEMA   = os.getenv("PG_SCHEMA", "public")    # 預設 public
 DATA_DIR = os.getenv("DATA_DIR", "data/tables")
-CHUNK_SIZE = int(os.getenv("CSV_CHUNK_SIZE", "10000"))  # 每塊10000列，可依機器調大/調小
+CHUNK_SIZE = int(os.getenv("CSV_CHUNK_SIZE", "10000"))  # 每塊10000列，可依機器調大/調小（每塊各自提交，可續傳）
+LOAD_MANIFEST = os.getenv("LOAD_MANIFEST")             # 選用：檔案/資料表清單
+LOAD_PROCESSES = int(os.getenv("LOAD_PROCESSES", str(os.cpu_count() or 4)))
+LOAD_METRICS_PATH = os.getenv("LOAD_METRICS_PATH", ".cache/load_metrics.jsonl")
 
 
 engine = create_engine(PG_URI, pool_pre_ping=True)
 
-def ensure_pk(conn, schema: str, table: str, pk_name: str = None):
+_ALREADY_EXISTS = ("42710", "42P07")   # duplicate_object / duplicate_table
+
+def ensure_pk(engine, schema: str, table: str, pk_name: str = None):
     """
-    若表沒有主鍵：
-    1) 確保存在 id 欄位
-    2) 回填 id（僅補 NULL）
-    3) 建立序列，設定預設值
-    4) 加上 PRIMARY KEY (id)
+    新載入的表在建表時已帶 id IDENTITY PRIMARY KEY（見 bulk_loader.create_table），這裡直接略過。
+    舊表若沒有主鍵：
+    1) 沒有 id 欄位：ADD COLUMN ... GENERATED BY DEFAULT AS IDENTITY（單次填值，不做 ctid 自我 JOIN）
+    2) 已有 id 欄位：只以序列補 NULL，再轉成 IDENTITY 欄位（CSV 自帶的 id 不是整數型別時警告並略過）
+    3) CREATE UNIQUE INDEX CONCURRENTLY 後以 USING INDEX 加上 PRIMARY KEY；
+       先前失敗留下的 INVALID 索引會先刪除重建，建索引失敗（如 id 重複）時清掉殘留索引並警告
     """
     if pk_name is None:
         pk_name = f"{table}_pk"
 
     # fully-quoted identifiers
     tbl_q = f'"{schema}"."{table}"'
-    seq_name = f'{table}_id_seq'
-    seq_q = f'"{schema}"."{seq_name}"'
-
-    # 已有主鍵就跳過
-    has_pk = conn.execute(text("""
-        SELECT 1
-        FROM information_schema.table_constraints
-        WHERE table_schema = :s AND table_name = :t AND constraint_type='PRIMARY KEY'
-        LIMIT 1
-    """), {"s": schema, "t": table}).fetchone()
-    if has_pk:
-        return
-
-    # 1) 確保有 id 欄位（先不設 identity，避免舊資料 NULL 影響加 PK）
-    conn.execute(text(f'''
-        ALTER TABLE {tbl_q}
-        ADD COLUMN IF NOT EXISTS id BIGINT
-    '''))
-
-    # 2) 回填 id（對 NULL 的列補唯一序號）
-    conn.execute(text(f'''
-        WITH seq AS (
-          SELECT ctid, ROW_NUMBER() OVER () AS rn
-          FROM {tbl_q}
-        )
-        UPDATE {tbl_q} t
-        SET id = s.rn
-        FROM seq s
-        WHERE t.ctid = s.ctid AND t.id IS NULL
-    '''))
-
-    # 3) 建立序列（若不存在），並把 id 預設綁到序列上（後續 INSERT 自動遞增）
-    conn.execute(text(f'''
-        DO $$
-        BEGIN
-          IF NOT EXISTS (
-            SELECT 1 FROM pg_class c
-            JOIN pg_namespace n ON n.oid = c.relnamespace
-            WHERE c.relkind='S' AND c.relname = :seq_name AND n.nspname = :schema
-          ) THEN
-            EXECUTE 'CREATE SEQUENCE {seq_q} OWNED BY {tbl_q}.id';
-          END IF;
-        END $$;
-    '''), {"seq_name": seq_name, "schema": schema})
-
-    # 將序列設到目前最大 id 後
-    conn.execute(text(f'''
-        SELECT setval('{seq_q}', COALESCE((SELECT MAX(id) FROM {tbl_q}), 0))
-    '''))
-
-    # 設定 id 預設值為 nextval(seq)
-    conn.execute(text(f'''
-        ALTER TABLE {tbl_q}
-        ALTER COLUMN id SET DEFAULT nextval('{seq_q}')
-    '''))
-
-    # 4) 加主鍵（若約束已存在會丟錯，包 try 以避免重複加）
+
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行，整段使用 autocommit
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # 已有主鍵就跳過
+        has_pk = conn.execute(text("""
+            SELECT 1
+            FROM information_schema.table_constraints
+            WHERE table_schema = :s AND table_name = :t AND constraint_type='PRIMARY KEY'
+            LIMIT 1
+        """), {"s": schema, "t": table}).fetchone()
+        if has_pk:
+            return
+
+        id_col = conn.execute(text("""
+            SELECT is_identity, data_type
+            FROM information_schema.columns
+            WHERE table_schema = :s AND table_name = :t AND column_name = 'id'
+        """), {"s": schema, "t": table}).fetchone()
+
+        if id_col is None:
+            # 1) 新增 identity 欄位，既有列在同一次 ALTER 中取得序號
+            conn.execute(text(f'''
+                ALTER TABLE {tbl_q}
+                ADD COLUMN id BIGINT GENERATED BY DEFAULT AS IDENTITY
+            '''))
+        elif id_col[1] not in ("smallint", "integer", "bigint"):
+            # CSV 自帶的 id 欄位保留推斷型別（text / double precision…），無法轉成 identity
+            print(f"[warn] {schema}.{table}: id column is {id_col[1]}, primary key not added")
+            return
+        elif id_col[0] != "YES":
+            # 2) 舊的 id 欄位：以暫時序列只補 NULL 列，再轉成 identity
+            seq_q = f'"{schema}"."{table}_id_backfill_seq"'
+            start = conn.execute(text(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {tbl_q}')).scalar()
+            conn.execute(text(f'CREATE SEQUENCE IF NOT EXISTS {seq_q} START {int(start)}'))
+            conn.execute(text(f"UPDATE {tbl_q} SET id = nextval('{seq_q}') WHERE id IS NULL"))
+            conn.execute(text(f'ALTER TABLE {tbl_q} ALTER COLUMN id DROP DEFAULT'))
+            conn.execute(text(f'DROP SEQUENCE {seq_q}'))
+            conn.execute(text(f'ALTER TABLE {tbl_q} ALTER COLUMN id SET NOT NULL'))
+            conn.execute(text(f'ALTER TABLE {tbl_q} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY'))
+            # 將 identity 序列設到目前最大 id 後
+            conn.execute(text(f'''
+                SELECT setval(pg_get_serial_sequence('{tbl_q}', 'id'),
+                              COALESCE((SELECT MAX(id) FROM {tbl_q}), 0) + 1, false)
+            '''))
+
+        # 3) 以 CONCURRENTLY 建唯一索引（不阻擋寫入），再升級為主鍵
+        idx_q = f'"{schema}"."{pk_name}"'
+        if _index_valid(conn, schema, pk_name) is False:
+            # CONCURRENTLY 失敗會留下 INVALID 索引，IF NOT EXISTS 會把它當成已存在
+            print(f"[warn] {schema}.{table}: dropping invalid index {pk_name} and rebuilding")
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {idx_q}'))
+        try:
+            conn.execute(text(f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "{pk_name}" ON {tbl_q} (id)'))
+        except Exception as e:
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {idx_q}'))
+            print(f"[warn] {schema}.{table}: unique index on id failed, primary key not added: {e}")
+            return
+        try:
+            conn.execute(text(f'''
+                ALTER TABLE {tbl_q}
+                ADD CONSTRAINT "{pk_name}" PRIMARY KEY USING INDEX "{pk_name}"
+            '''))
+        except Exception as e:
+            # 只有「約束已存在」（例如另一個程序剛加上）可以略過
+            if getattr(getattr(e, "orig", None), "pgcode", None) not in _ALREADY_EXISTS:
+                print(f"[warn] {schema}.{table}: add primary key failed: {e}")
+
+
+def _index_valid(conn, schema: str, index: str):
+    """None = 索引不存在；否則回傳 pg_index.indisvalid"""
+    row = conn.execute(text("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :s AND c.relname = :i
+    """), {"s": schema, "i": index}).fetchone()
+    return None if row is None else bool(row[0])
+
+
+# ---------- 多檔載入 driver（manifest + process pool + 續傳） ----------
+def read_manifest(path: Path) -> List[Dict[str, str]]:
+    """讀取載入清單：JSON [{"file":..., "table":..., "schema":...}] 或含 file,table[,schema] 欄位的 CSV"""
+    if path.suffix.lower() == ".json":
+        entries = json.loads(path.read_text(encoding="utf-8"))
+    else:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            entries = list(csv.DictReader(f))
+    jobs = []
+    for e in entries:
+        p = Path(e["file"])
+        if not p.is_absolute() and not p.exists():
+            p = path.parent / p
+        jobs.append({"file": str(p), "table": e.get("table") or p.stem, "schema": e.get("schema") or SCHEMA})
+    return jobs
+
+
+def default_manifest(data_dir: Path) -> List[Dict[str, str]]:
+    """未提供 manifest 時：載入 data_dir 下所有 CSV，以檔名為表名"""
+    return [{"file": str(p), "table": p.stem, "schema": SCHEMA} for p in sorted(data_dir.glob("*.csv"))]
+
+
+_worker_conn = None
+
+def _init_worker(dsn: str):
+    """每個 worker process 一條 DB 連線；連線失敗不可讓 initializer 拋錯（會使整個 pool 失效），
+    留待 _load_job 重新連線"""
+    global _worker_conn
     try:
-        conn.execute(text(f'''
-            ALTER TABLE {tbl_q}
-            ADD CONSTRAINT "{pk_name}" PRIMARY KEY (id)
-        '''))
-    except Exception:
-        # 可能已經有同名約束或其他情況，略過即可
-        pass
-
-def load_one_csv(csv_path: Path):
-    table = csv_path.stem  # 以檔名為表名
-    print(f"[LOAD] {csv_path.name} -> {SCHEMA}.{table}")
-
-    # 串流讀取大檔：每塊 CHUNK_SIZE 列
-    first = True
-    total_rows = 0
-    for i, df in enumerate(pd.read_csv(
-        csv_path,
-        chunksize=CHUNK_SIZE,
-        low_memory=False,           # 降低型別猜測的記憶體抖動
-        dtype_backend="pyarrow" if hasattr(pd, "options") else None  # 新版 pandas 可更省記憶體（可忽略）
-    ), start=1):
-        total_rows += len(df)
-        df.to_sql(
-            table,
-            engine,
-            schema=SCHEMA,
-            if_exists="replace" if first else "append",
-            index=False,
-            method="multi",         # 批量 insert，速度較快
-            chunksize=5000,         # 傳給 SQL 的批大小
-        )
-        print(f"  - chunk {i} inserted: {len(df)} rows (cumulative: {total_rows})")
-        first = False
-
-    # 若檔案可能是空的，total_rows==0 時跳過後續步驟
-    if total_rows == 0:
-        print(f"[SKIP] {table}: file is empty.")
-        return
-
-    # 加主鍵（若沒有）
-    with engine.begin() as conn:
-        ensure_pk(conn, SCHEMA, table)
+        _worker_conn = psycopg2.connect(dsn)
+    except Exception as e:
+        print(f"[warn] worker {os.getpid()} connect failed, will retry per job: {e}")
+        _worker_conn = None
 
-    print(f"[OK]   {table}: {total_rows} rows")
+
+def _load_job(job: Dict[str, str]) -> Dict[str, Any]:
+    global _worker_conn
+    if _worker_conn is None or _worker_conn.closed:
+        _worker_conn = psycopg2.connect(pg_dsn(PG_URI))
+    try:
+        print(f"[LOAD] {Path(job['file']).name} -> {job['schema']}.{job['table']} (pid {os.getpid()})")
+        return load_csv_resumable(_worker_conn, Path(job["file"]), job["schema"], job["table"],
+                                  chunk_rows=CHUNK_SIZE)
+    except Exception as e:
+        try:
+            _worker_conn.rollback()
+        except Exception:
+            # 連線已中斷：關閉並清掉，下一個工作重新連線
+            try:
+                _worker_conn.close()
+            except Exception:
+                pass
+            _worker_conn = None
+        return {"file": job["file"], "table": f"{job['schema']}.{job['table']}", "error": f"{type(e).__name__}: {e}"}
+
+
+def run_jobs(jobs: List[Dict[str, str]], workers: int = LOAD_PROCESSES) -> List[Dict[str, Any]]:
+    """以 process pool 並行載入；每個檔案的吞吐量寫入 LOAD_METRICS_PATH（JSON lines）"""
+    if not jobs:
+        return []
+    workers = max(1, min(workers, len(jobs)))
+    metrics_path = Path(LOAD_METRICS_PATH)
+    metrics_path.parent.mkdir(parents=True, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(pg_dsn(PG_URI),)) as ex, \
+            open(metrics_path, "a", encoding="utf-8") as mf:
+        futures = {ex.submit(_load_job, job): job for job in jobs}
+        for fut in as_completed(futures):
+            try:
+                r = fut.result()
+            except Exception as e:
+                # worker process 異常結束（BrokenProcessPool 等）：記為單檔錯誤，不中斷整批
+                job = futures[fut]
+                r = {"file": job["file"], "table": f"{job['schema']}.{job['table']}",
+                     "error": f"{type(e).__name__}: {e}"}
+            r["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            mf.write(json.dumps(r, ensure_ascii=False) + "\n")
+            mf.flush()
+            if r.get("error"):
+                print(f"[FAIL] {r['table']}: {r['error']}")
+            elif not r.get("skipped"):
+                print(f"[OK]   {r['table']}: {r['rows']} rows in {r['seconds']}s ({r['rows_per_sec']:.0f} rows/s)")
+            results.append(r)
+    return results
 
 
 def main():
-    data_dir = Path(DATA_DIR)
-    csv_files = sorted(data_dir.glob("*.csv"))
-    if not csv_files:
-        print(f"No CSV files found in {data_dir.resolve()}")
-        return
-
-    for p in csv_files:
-        # 更改這邊的檔名可以選擇要載入的檔案
-        if "SessionLength" in p.name:
-            load_one_csv(p)
+    # 用法：python load_tables_to_pg.py [manifest.json|manifest.csv]
+    manifest = sys.argv[1] if len(sys.argv) > 1 else LOAD_MANIFEST
+    if manifest:
+        jobs = read_manifest(Path(manifest))
+    else:
+        data_dir = Path(DATA_DIR)
+        jobs = default_manifest(data_dir)
+        if not jobs:
+            print(f"No CSV files found in {data_dir.resolve()}")
+            return
+
+    started = time.time()
+    results = run_jobs(jobs, workers=LOAD_PROCESSES)
+
+    # 加主鍵（若沒有；新建的表已帶 identity 主鍵，會直接略過）
+    for r in results:
+        if r.get("error") or not r.get("rows"):
+            continue
+        schema, table = r["table"].split(".", 1)
+        ensure_pk(engine, schema, table)
+
+    elapsed = max(time.time() - started, 1e-6)
+    total_rows = sum(r.get("rows", 0) for r in results)
+    failed = [r for r in results if r.get("error")]
+    print(f"loaded {total_rows} rows from {len(results)} file(s) in {elapsed:.1f}s "
+          f"({total_rows / elapsed:.0f} rows/s), failed: {len(failed)}; metrics -> {LOAD_METRICS_PATH}")
+
+    # 每日彙總表：只重算新載入列涉及的日期（沒有新資料的來源會直接略過）
+    if ROLLUPS_ENABLED:
+        RollupManager(engine, schema=SCHEMA).refresh_all()
 
     # 驗證
     with engine.begin() as conn:
@@ -0,0 +1,216 @@
+# md_chunker.py — 以 token 計數切塊的 Markdown chunker
+# 直接走訪 markdown-it 的 token 串流（不經 HTML 轉換與 BeautifulSoup 重新解析），
+# 以 tiktoken 計算長度、可設定重疊，並把標題路徑保留為 metadata。
+# 每個區塊只編碼一次，chunk 以 token list 累積、最後才 decode/join，整體為線性時間。
+# 在區塊中間切開時（超長區塊、重疊）切點一律移到字元邊界，不會把中文等多位元組字元切成兩半。
+# pip install markdown-it-py tiktoken
+
+import os
+from typing import List, Dict, Any, Tuple
+import tiktoken
+from markdown_it import MarkdownIt
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))     # MiniLM 輸入上限約 256 word pieces
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "48"))
+CHUNK_SPLIT_LEVEL = int(os.getenv("CHUNK_SPLIT_LEVEL", "2"))      # h1/h2 開新段落（與舊版相同）
+CHUNK_ENCODING = os.getenv("CHUNK_ENCODING", "cl100k_base")
+
+_md = MarkdownIt("commonmark").enable("table")
+_enc = None
+
+
+def get_encoding():
+    global _enc
+    if _enc is None:
+        _enc = tiktoken.get_encoding(CHUNK_ENCODING)
+    return _enc
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def _is_char_start(enc, token: int) -> bool:
+    """token 的第一個 byte 不是 UTF-8 延續位元組（0x80–0xBF），即從字元開頭開始"""
+    return not 0x80 <= enc.decode_single_token_bytes(token)[0] < 0xC0
+
+
+def _tail(enc, tokens: List[int], n: int) -> List[int]:
+    """最後約 n 個 token（重疊用），起點往後移到字元邊界"""
+    if n <= 0:
+        return []
+    k = max(0, len(tokens) - n)
+    while k < len(tokens) and not _is_char_start(enc, tokens[k]):
+        k += 1
+    return tokens[k:]
+
+
+def _windows(enc, tokens: List[int], size: int, overlap: int) -> List[Tuple[int, int]]:
+    """把超長區塊切成帶重疊的 token 視窗 [(start, end)]；每個視窗的起訖都落在字元邊界"""
+    out, n, start = [], len(tokens), 0
+    while True:
+        end = min(start + size, n)
+        while start + 1 < end < n and not _is_char_start(enc, tokens[end]):
+            end -= 1
+        out.append((start, end))
+        if end >= n:
+            return out
+        nxt = max(end - overlap, start + 1)
+        while nxt < end and not _is_char_start(enc, tokens[nxt]):
+            nxt += 1
+        start = nxt
+
+
+# ---------- token 串流 → 區塊 ----------
+def iter_blocks(md_text: str, doc_title: str) -> List[Tuple[List[Tuple[int, str]], str]]:
+    """回傳 [(heading_path, block_text)]；heading_path 為 [(層級, 標題)]，文件標題為層級 0。
+    段落、清單項目、程式碼、表格列各為一個區塊"""
+    path: List[Tuple[int, str]] = []
+    blocks: List[Tuple[List[Tuple[int, str]], str]] = []
+    heading_level = 0
+    list_depth = 0
+    in_cell = False
+    row: List[str] = []
+
+    def heading_path() -> List[Tuple[int, str]]:
+        return [(0, doc_title)] + path
+
+    for tok in _md.parse(md_text):
+        t = tok.type
+        if t == "heading_open":
+            heading_level = int(tok.tag[1])
+        elif t == "heading_close":
+            heading_level = 0
+        elif t in ("bullet_list_open", "ordered_list_open"):
+            list_depth += 1
+        elif t in ("bullet_list_close", "ordered_list_close"):
+            list_depth -= 1
+        elif t == "tr_open":
+            row = []
+        elif t == "tr_close":
+            if any(row):
+                blocks.append((heading_path(), " | ".join(row)))
+        elif t in ("th_open", "td_open"):
+            in_cell = True
+        elif t in ("th_close", "td_close"):
+            in_cell = False
+        elif t in ("fence", "code_block"):
+            code = tok.content.strip()
+            if code:
+                blocks.append((heading_path(), code))
+        elif t == "inline":
+            text = " ".join(tok.content.split())
+            if in_cell:
+                row.append(text)
+            elif not text:
+                continue
+            elif heading_level:
+                while path and path[-1][0] >= heading_level:
+                    path.pop()
+                path.append((heading_level, text))
+            elif list_depth:
+                blocks.append((heading_path(), "  " * (list_depth - 1) + "- " + text))
+            else:
+                blocks.append((heading_path(), text))
+    return blocks
+
+
+# ---------- 區塊 → chunk ----------
+def chunk_markdown(md_text: str, doc_title: str,
+                   max_tokens: int = CHUNK_MAX_TOKENS,
+                   overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                   min_tokens: int = CHUNK_MIN_TOKENS,
+                   split_level: int = CHUNK_SPLIT_LEVEL) -> List[Dict[str, Any]]:
+    """回傳 [{"title", "text", "heading_path", "tokens"}]
+    - 標題層級 <= split_level 變動時開新 chunk（不跨段落重疊），依實際的 h 層級而非路徑深度
+    - 同段落內的區塊依 token 數貪婪裝箱，相鄰 chunk 重疊 overlap_tokens；
+      重疊 + 下一個區塊放不下時縮短或捨棄重疊，任何 chunk（含合併後）都不超過 max_tokens
+    - 單一區塊超過 max_tokens 時以 token 視窗切開（切點在字元邊界）
+    - chunk 的標題路徑為其中各區塊路徑的共同前綴"""
+    enc = get_encoding()
+    overlap_tokens = max(0, min(overlap_tokens, max_tokens // 2))
+    sep = enc.encode("\n\n")
+
+    chunks: List[Dict[str, Any]] = []
+    buf: List[int] = []      # 目前 chunk 的 token（含開頭的重疊部分）
+    fresh = 0                # buf 中非重疊的 token 數
+    lead = 0                 # buf 開頭屬於上一個 chunk 的重疊 token 數（含分隔符）
+    key = None
+    path: List[str] = []     # 目前 chunk 的標題路徑
+
+    def common(a: List[str], b: List[str]) -> List[str]:
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        return a[:n]
+
+    def emit(tokens: List[int], lead: int):
+        chunks.append({
+            "title": path[-1],
+            "text": enc.decode(tokens).strip(),
+            "heading_path": list(path),
+            "tokens": len(tokens),
+            "_key": key,
+            "_new": tokens[lead:],    # 去掉重疊後的內容，合併時只接這段
+        })
+
+    def flush(keep_overlap: bool):
+        nonlocal buf, fresh
+        if fresh:
+            emit(buf, lead)
+        buf = _tail(enc, buf, overlap_tokens) if keep_overlap and fresh else []
+        fresh = 0
+
+    for levels, text in iter_blocks(md_text, doc_title):
+        section = tuple(h for h in levels if h[0] <= split_level)
+        if section != key:
+            flush(keep_overlap=False)
+            key = section
+        block_path = [t for _, t in levels]
+
+        toks = enc.encode(text)
+        if len(toks) > max_tokens:
+            # 超長區塊：先送出目前 chunk，再以帶重疊的視窗切開
+            flush(keep_overlap=False)
+            path = block_path
+            prev_end = 0
+            for start, end in _windows(enc, toks, max_tokens, overlap_tokens):
+                emit(toks[start:end], max(0, prev_end - start))
+                prev_end = end
+            buf = _tail(enc, toks, overlap_tokens)
+            continue
+
+        if fresh and len(buf) + len(sep) + len(toks) > max_tokens:
+            flush(keep_overlap=True)
+        if not fresh and buf and len(buf) + len(sep) + len(toks) > max_tokens:
+            # 只剩重疊部分仍放不下：縮短到剩餘空間（不足時整段捨棄）
+            buf = _tail(enc, buf, max_tokens - len(sep) - len(toks))
+        path = common(path, block_path) if fresh else block_path
+        if fresh:
+            buf.extend(sep)
+        else:
+            if buf:
+                buf.extend(sep)
+            lead = len(buf)
+        buf.extend(toks)
+        fresh += len(toks)
+    flush(keep_overlap=False)
+
+    # 合併同段落中太短的 chunk
+    merged: List[Dict[str, Any]] = []
+    for c in chunks:
+        prev = merged[-1] if merged else None
+        if (prev is not None and c["tokens"] < min_tokens and prev["_key"] == c["_key"]
+                and prev["tokens"] + len(sep) + len(c["_new"]) <= max_tokens):
+            # c 開頭的重疊本來就在 prev 結尾，只接上新內容
+            prev["text"] = prev["text"] + "\n\n" + enc.decode(c["_new"]).strip()
+            prev["tokens"] += len(sep) + len(c["_new"])
+            prev["heading_path"] = common(prev["heading_path"], c["heading_path"])
+            prev["title"] = prev["heading_path"][-1]
+        else:
+            merged.append(c)
+    for c in merged:
+        c.pop("_key", None)
+        c.pop("_new", None)
+    return merged
@@ -0,0 +1,238 @@
+# md_pipeline.py — 整個目錄的 Markdown 串流攝取管線
+# 檔案探索 → md 解析 (process pool) → 跨檔批次 embedding → 批次 Mongo bulk_write
+# 各階段之間以有界佇列串接，下游較慢時上游會被擋住（backpressure），記憶體用量固定。
+# 任一階段出錯即設定中止旗標：其他階段不再阻塞在佇列上並各自收尾，run() 再拋出第一個錯誤。
+# 與 ingest_md_to_mongo.ingest_one 相同的增量語意：只 embed 新增/變更的 chunk，並刪除過期 card。
+# 用法：python md_pipeline.py data/md [more_dirs...]
+
+import os, sys, time, queue, threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterable, Optional
+
+from embedding_service import embed_texts
+from ingest_md_to_mongo import build_cards, plan_sync, build_ops, cards_col
+
+MD_PARSE_WORKERS = int(os.getenv("MD_PARSE_WORKERS", str(os.cpu_count() or 4)))
+MD_QUEUE_SIZE = int(os.getenv("MD_QUEUE_SIZE", "64"))          # 每個階段佇列上限
+MD_EMBED_BATCH = int(os.getenv("MD_EMBED_BATCH", "256"))       # 每批 embedding 的 chunk 數
+MD_WRITE_BATCH = int(os.getenv("MD_WRITE_BATCH", "500"))       # 每次 bulk_write 的操作數
+
+_DONE = object()
+_POLL_SECONDS = 0.2
+
+
+class PipelineStats:
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.failed = 0
+        self.chunks = 0
+        self.embedded = 0
+        self.removed = 0
+        self.writes = 0
+
+    def add(self, **kw):
+        with self.lock:
+            for k, v in kw.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def report(self) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started, 1e-6)
+        return {
+            "files": self.files, "failed": self.failed, "chunks": self.chunks,
+            "embedded": self.embedded, "removed": self.removed, "bulk_writes": self.writes,
+            "seconds": round(elapsed, 2),
+            "docs_per_sec": round(self.files / elapsed, 2),
+            "chunks_per_sec": round(self.chunks / elapsed, 2),
+        }
+
+
+def discover(roots: Iterable[Path], pattern: str = "*.md") -> Iterable[Path]:
+    for root in roots:
+        if root.is_file():
+            yield root
+        else:
+            yield from sorted(root.rglob(pattern))
+
+
+def _parse(path_str: str, card_type: str):
+    """在 worker process 中執行：解析單一檔案為 card 文件"""
+    return path_str, build_cards(Path(path_str), card_type)
+
+
+class MarkdownPipeline:
+    """四階段串流管線；每個階段一條執行緒，解析階段再交給 process pool"""
+
+    def __init__(self, card_type: str = "doc", parse_workers: int = MD_PARSE_WORKERS,
+                 queue_size: int = MD_QUEUE_SIZE, embed_batch: int = MD_EMBED_BATCH,
+                 write_batch: int = MD_WRITE_BATCH):
+        self.card_type = card_type
+        self.parse_workers = parse_workers
+        self.embed_batch = embed_batch
+        self.write_batch = write_batch
+        self.q_files: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.q_docs: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.q_ops: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.stats = PipelineStats()
+        self._abort = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    # ---------- 佇列存取（中止時不再阻塞） ----------
+    def _fail(self, stage: str, e: BaseException):
+        with self.stats.lock:
+            if self._error is None:
+                self._error = e
+        print(f"[warn] {stage} stage failed: {type(e).__name__}: {e}")
+        self._abort.set()
+
+    def _put(self, q: "queue.Queue", item) -> bool:
+        """有界佇列 put；管線已中止時放棄並回傳 False"""
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: "queue.Queue"):
+        """佇列 get；管線已中止時回傳 _DONE"""
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def run(self, roots: List[Path]) -> Dict[str, Any]:
+        stages = [
+            threading.Thread(target=self._discover_stage, args=(roots,), name="md-discover"),
+            threading.Thread(target=self._parse_stage, name="md-parse"),
+            threading.Thread(target=self._embed_stage, name="md-embed"),
+            threading.Thread(target=self._write_stage, name="md-write"),
+        ]
+        for t in stages:
+            t.start()
+        for t in stages:
+            t.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats.report()
+
+    # ---------- stage 1: 檔案探索 ----------
+    def _discover_stage(self, roots: List[Path]):
+        try:
+            for p in discover(roots):
+                if not self._put(self.q_files, str(p)):
+                    break
+        except Exception as e:
+            self._fail("discover", e)
+        finally:
+            self._put(self.q_files, _DONE)
+
+    # ---------- stage 2: 解析（process pool，限制同時在途的檔案數） ----------
+    def _parse_stage(self):
+        inflight = threading.Semaphore(self.parse_workers * 2)
+
+        def on_done(fut):
+            inflight.release()
+            try:
+                path, docs = fut.result()
+            except Exception as e:
+                self.stats.add(failed=1)
+                print(f"[warn] parse failed: {e}")
+                return
+            self._put(self.q_docs, (path, docs))
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.parse_workers) as ex:
+                while True:
+                    item = self._get(self.q_files)
+                    if item is _DONE:
+                        break
+                    inflight.acquire()
+                    ex.submit(_parse, item, self.card_type).add_done_callback(on_done)
+        except Exception as e:
+            self._fail("parse", e)
+        finally:
+            self._put(self.q_docs, _DONE)
+
+    # ---------- stage 3: 跨檔比對 + 批次 embedding ----------
+    def _embed_stage(self):
+        batch: List[tuple] = []
+        n_chunks = 0
+        try:
+            while True:
+                item = self._get(self.q_docs)
+                if item is _DONE:
+                    break
+                batch.append(item)
+                n_chunks += len(item[1])
+                if n_chunks >= self.embed_batch:
+                    self._embed_batch(batch)
+                    batch, n_chunks = [], 0
+            if batch and not self._abort.is_set():
+                self._embed_batch(batch)
+        except Exception as e:
+            self._fail("embed", e)
+        finally:
+            self._put(self.q_ops, _DONE)
+
+    def _embed_batch(self, batch: List[tuple]):
+        # 一次查回這批檔案已存在的 card
+        paths = [p for p, _ in batch]
+        existing: Dict[str, List[Dict[str, Any]]] = {p: [] for p in paths}
+        for e in cards_col().find({"type": self.card_type, "source_path": {"$in": paths}},
+                                  {"_id": 1, "title": 1, "content_hash": 1, "meta": 1, "source_path": 1}):
+            existing.setdefault(e["source_path"], []).append(e)
+
+        changed_all, moved_all, stale_all = [], [], []
+        for path, docs in batch:
+            changed, moved, stale_ids = plan_sync(docs, existing.get(path, []))
+            changed_all.extend(changed)
+            moved_all.extend(moved)
+            stale_all.extend(stale_ids)
+            self.stats.add(files=1, chunks=len(docs))
+
+        vecs = embed_texts([d["_embed_text"] for d in changed_all]) if changed_all else []
+        self.stats.add(embedded=len(changed_all), removed=len(stale_all))
+        for op in build_ops(changed_all, vecs, stale_all, moved_all):
+            if not self._put(self.q_ops, op):
+                return
+
+    # ---------- stage 4: 批次寫入 ----------
+    def _write_stage(self):
+        ops = []
+        try:
+            while True:
+                op = self._get(self.q_ops)
+                if op is _DONE:
+                    break
+                ops.append(op)
+                if len(ops) >= self.write_batch:
+                    self._flush(ops)
+                    ops = []
+            if ops and not self._abort.is_set():
+                self._flush(ops)
+        except Exception as e:
+            self._fail("write", e)
+
+    def _flush(self, ops):
+        # 刪除操作排在同批 upsert 之前（build_ops 的順序），ordered=True 保留此順序
+        cards_col().bulk_write(ops, ordered=True)
+        self.stats.add(writes=1)
+        r = self.stats.report()
+        print(f"  - {r['files']} docs, {r['chunks']} chunks "
+              f"({r['docs_per_sec']} docs/s, {r['chunks_per_sec']} chunks/s)")
+
+
+def ingest_dirs(roots: List[Path], card_type: str = "doc") -> Dict[str, Any]:
+    return MarkdownPipeline(card_type=card_type).run(roots)
+
+
+if __name__ == "__main__":
+    roots = [Path(a) for a in sys.argv[1:]] or [Path("data/md")]
+    report = ingest_dirs(roots)
+    print(f"Done: {report}")
@@ -0,0 +1,66 @@
+# mongo_pool.py — 共用的 MongoDB client 註冊表
+# MongoClient 本身就是執行緒安全的連線池；每個 URI 只建立一次，
+# 避免每次查詢都重新 TLS 握手與 server selection。
+# pip install pymongo[srv] certifi python-dotenv
+
+import os, atexit, threading
+from typing import Dict, Optional
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.collection import Collection
+import certifi
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB  = os.getenv("MONGO_DB", "ragdb")
+MONGO_COL = os.getenv("MONGO_COL", "cards")
+MONGO_MAX_POOL = int(os.getenv("MONGO_MAX_POOL", "20"))
+MONGO_MIN_POOL = int(os.getenv("MONGO_MIN_POOL", "0"))
+MONGO_SERVER_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_TIMEOUT_MS", "30000"))
+
+_clients: Dict[str, MongoClient] = {}
+_lock = threading.Lock()
+
+
+def get_client(uri: Optional[str] = None) -> Optional[MongoClient]:
+    """取得（必要時建立）指定 URI 的共用 client；未設定 URI 時回傳 None"""
+    uri = uri or MONGO_URI
+    if not uri:
+        return None
+    client = _clients.get(uri)
+    if client is None:
+        with _lock:
+            client = _clients.get(uri)
+            if client is None:
+                client = MongoClient(
+                    uri,
+                    tls=True,
+                    tlsCAFile=certifi.where(),
+                    maxPoolSize=MONGO_MAX_POOL,
+                    minPoolSize=MONGO_MIN_POOL,
+                    serverSelectionTimeoutMS=MONGO_SERVER_TIMEOUT_MS,
+                )
+                _clients[uri] = client
+    return client
+
+
+def get_collection(db: str = MONGO_DB, col: str = MONGO_COL, uri: Optional[str] = None) -> Optional[Collection]:
+    client = get_client(uri)
+    if client is None:
+        return None
+    return client[db][col]
+
+
+def close_clients():
+    """關閉所有共用 client（process 結束時自動呼叫）"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+atexit.register(close_clients)
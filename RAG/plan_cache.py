@@ -0,0 +1,279 @@
+# plan_cache.py — 參數化查詢計畫快取
+# 同一類分析問題只差日期區間 / 國別 / VIP 等級時（例如 2024-10 TW vs US），
+# 不必再走 rewrite → decide → compose 三次 LLM 呼叫：
+# 1) 問題正規化為「模板 + 參數」：日期 (YYYY-MM-DD)、月份 (YYYY-MM / YYYY 年 MM 月)、ISO-2 國別、VIP 等級
+# 2) 執行成功的 SQL 與 table_plan / rewritten_query 以模板為 key 存入 SQLite
+#    （只有每個參數都以字面值出現在 SQL 中、且 SQL 中每個日期字面值都來自參數時才快取，確保可重新綁定；
+#     例如「後續 7 日」算出的 20241008 不屬於任何參數，換日期後會過期，這類計畫不快取）
+# 3) 命中時把舊參數的 SQL 字面值一次性替換為新參數值；執行失敗則刪除並回到完整流程
+
+import os, re, json, time, hashlib, calendar, sqlite3, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH", ".cache/plan_cache.sqlite")
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "1000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plan_cache (
+    key         TEXT PRIMARY KEY,
+    template    TEXT NOT NULL,
+    params      TEXT NOT NULL,
+    sql         TEXT NOT NULL,
+    table_plan  TEXT NOT NULL,
+    rewritten   TEXT,
+    hits        INTEGER NOT NULL DEFAULT 0,
+    created_at  REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plan_cache_access ON plan_cache(last_access);
+"""
+
+COUNTRY_NAMES = {
+    "台灣": "TW", "臺灣": "TW", "美國": "US", "日本": "JP", "韓國": "KR", "香港": "HK",
+    "新加坡": "SG", "馬來西亞": "MY", "泰國": "TH", "越南": "VN", "印尼": "ID",
+    "菲律賓": "PH", "中國": "CN", "澳門": "MO", "英國": "GB", "加拿大": "CA", "澳洲": "AU",
+}
+# 單獨出現的大寫代碼視為國別；ID / IN / IT 容易與一般英文字混淆，只接受中文國名
+ISO2 = (set(COUNTRY_NAMES.values()) | {"DE", "FR", "BR", "MX", "RU", "ES", "NZ"}) - {"ID", "IN", "IT"}
+
+_DATE = re.compile(r"(?<!\d)(20\d{2})[-/.](\d{1,2})[-/.](\d{1,2})(?!\d)|(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)")
+_MONTH = re.compile(r"(?<!\d)(20\d{2})\s*(?:[-/.]|年\s*)(\d{1,2})(?:\s*月)?(?![\d/.-])")
+_COUNTRY = re.compile("|".join(map(re.escape, sorted(COUNTRY_NAMES, key=len, reverse=True)))
+                      + r"|(?<![A-Za-z])(?:" + "|".join(sorted(ISO2)) + r")(?![A-Za-z])")
+_VIP = re.compile(r"(vip\s*(?:lv|等級|level)?\s*(?:=|>=|<=|>|<|為|是)?\s*)(\d{1,2})(?!\d)", re.IGNORECASE)
+
+
+# ---------- 問題 → 模板 + 參數 ----------
+def normalize(question: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """回傳 (template, params)；params 依出現順序，每個為 {"kind", "value"}"""
+    found: List[Tuple[int, int, str, Any, str]] = []   # (start, end, kind, value, placeholder text)
+    taken = []
+
+    def free(a, b):
+        return all(b <= s or a >= e for s, e in taken)
+
+    for m in _DATE.finditer(question):
+        y, mo, d = (m.group(1), m.group(2), m.group(3)) if m.group(1) else (m.group(4), m.group(5), m.group(6))
+        if 1 <= int(mo) <= 12 and 1 <= int(d) <= 31:
+            found.append((m.start(), m.end(), "date", int(f"{y}{int(mo):02d}{int(d):02d}"), "{date}"))
+            taken.append((m.start(), m.end()))
+    for m in _MONTH.finditer(question):
+        if free(m.start(), m.end()) and 1 <= int(m.group(2)) <= 12:
+            found.append((m.start(), m.end(), "month", int(f"{m.group(1)}{int(m.group(2)):02d}"), "{month}"))
+            taken.append((m.start(), m.end()))
+    for m in _COUNTRY.finditer(question):
+        if free(m.start(), m.end()):
+            code = COUNTRY_NAMES.get(m.group(0), m.group(0))
+            found.append((m.start(), m.end(), "country", code, "{country}"))
+            taken.append((m.start(), m.end()))
+    for m in _VIP.finditer(question):
+        s = m.start(2)
+        if free(s, m.end(2)):
+            found.append((s, m.end(2), "vip", int(m.group(2)), "{vip}"))
+            taken.append((s, m.end(2)))
+
+    found.sort()
+    parts, last = [], 0
+    for s, e, _, _, ph in found:
+        parts.append(question[last:s]); parts.append(ph); last = e
+    parts.append(question[last:])
+    template = re.sub(r"\s+", " ", "".join(parts)).strip().lower()
+    return template, [{"kind": k, "value": v} for _, _, k, v, _ in found]
+
+
+# ---------- 參數的 SQL 字面值 ----------
+def _month_bounds(yyyymm: int) -> Tuple[int, int, int]:
+    y, m = divmod(yyyymm, 100)
+    last = calendar.monthrange(y, m)[1]
+    ny, nm = (y + 1, 1) if m == 12 else (y, m + 1)
+    return y * 10000 + m * 100 + 1, y * 10000 + m * 100 + last, ny * 10000 + nm * 100 + 1
+
+
+def _iso(d: int) -> str:
+    return f"{d // 10000:04d}-{d // 100 % 100:02d}-{d % 100:02d}"
+
+
+def literal_forms(kind: str, value: Any) -> List[Tuple[str, str]]:
+    """回傳 [(regex, 代換字串)]；同一參數的各種 SQL 寫法依固定順序排列，新舊參數逐項對應"""
+    if kind == "date":
+        return [(rf"(?<!\d){value}(?!\d)", str(value)), (rf"'{_iso(value)}'", f"'{_iso(value)}'")]
+    if kind == "month":
+        start, end, nxt = _month_bounds(value)
+        forms = []
+        for d in (start, end, nxt):
+            forms.append((rf"(?<!\d){d}(?!\d)", str(d)))
+            forms.append((rf"'{_iso(d)}'", f"'{_iso(d)}'"))
+        forms.append((rf"(?<!\d){value}(?!\d)", str(value)))
+        return forms
+    if kind == "country":
+        return [(rf"'{value}'", f"'{value}'")]
+    if kind == "vip":
+        return [(rf"(\"?vip\w*\"?\s*(?:=|>=|<=|>|<|<>|!=)\s*){value}(?!\d)", str(value))]
+    return []
+
+
+def rebind_sql(sql: str, old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> Optional[str]:
+    """以單一 regex 一次替換所有舊字面值（避免 A→B 後又被 B→C 連鎖替換）；無法安全替換時回傳 None"""
+    if unbound_dates(sql, old):
+        return None      # 由參數推導出的日期（如 +7 天）不會跟著換，結果會是錯的
+    mapping: Dict[str, Tuple[str, str]] = {}
+    for o, n in zip(old, new):
+        for (pat, _), (_, rep) in zip(literal_forms(o["kind"], o["value"]), literal_forms(n["kind"], n["value"])):
+            if pat in mapping and mapping[pat][1] != rep:
+                return None      # 同一個舊字面值對應到不同新值（例如兩個參數原本相同、現在不同）
+            mapping[pat] = (pat, rep)
+    if not mapping:
+        return sql
+    pats = list(mapping)
+    combined = re.compile("|".join(f"(?P<p{i}>{p})" for i, p in enumerate(pats)), re.IGNORECASE)
+
+    def sub(m):
+        i = int(m.lastgroup[1:])
+        pat, rep = mapping[pats[i]]
+        # vip 形式帶有前綴群組：保留欄位/運算子部分，只換數字
+        inner = re.match(pat, m.group(0), re.IGNORECASE)
+        if inner and inner.groups():
+            return inner.group(1) + rep
+        return rep
+
+    return combined.sub(sub, sql)
+
+
+_SQL_DATE = re.compile(r"(?<![\d.])20\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])(?![\d.])"
+                       r"|'20\d{2}-\d{2}-\d{2}'")
+
+
+def unbound_dates(sql: str, params: List[Dict[str, Any]]) -> List[str]:
+    """SQL 中不屬於任何參數字面值的日期（YYYYMMDD 整數或 'YYYY-MM-DD'）；這些值無法隨參數重新綁定"""
+    forms = [re.compile(p, re.IGNORECASE) for x in params for p, _ in literal_forms(x["kind"], x["value"])]
+    return [m.group(0) for m in _SQL_DATE.finditer(sql) if not any(f.fullmatch(m.group(0)) for f in forms)]
+
+
+def params_bound(sql: str, params: List[Dict[str, Any]]) -> bool:
+    """每個參數至少有一種字面值出現在 SQL 中"""
+    return all(any(re.search(p, sql, re.IGNORECASE) for p, _ in literal_forms(x["kind"], x["value"]))
+               for x in params)
+
+
+def _value_maps(old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> Tuple[Dict[Any, Any], Dict[int, int]]:
+    values: Dict[Any, Any] = {}
+    vips: Dict[int, int] = {}
+    for o, n in zip(old, new):
+        if o["kind"] == "month":
+            for a, b in zip(_month_bounds(o["value"]), _month_bounds(n["value"])):
+                values[a] = b
+                values[_iso(a)] = _iso(b)
+            values[o["value"]] = n["value"]
+        elif o["kind"] == "date":
+            values[o["value"]] = n["value"]
+            values[_iso(o["value"])] = _iso(n["value"])
+        elif o["kind"] == "country":
+            values[o["value"]] = n["value"]
+        elif o["kind"] == "vip":
+            vips[o["value"]] = n["value"]
+    return values, vips
+
+
+def _rebind_obj(obj: Any, values: Dict[Any, Any], vips: Dict[int, int], key: str = "") -> Any:
+    """table_plan / rewritten_query 內的參數值（整數日期、國別字串、VIP 欄位值）同步替換"""
+    if isinstance(obj, dict):
+        return {k: _rebind_obj(v, values, vips, str(k)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_rebind_obj(v, values, vips, key) for v in obj]
+    if isinstance(obj, bool) or not isinstance(obj, (int, str)):
+        return obj
+    if "vip" in key.lower() and obj in vips:
+        return vips[obj]
+    return values.get(obj, obj)
+
+
+# ---------- 快取 ----------
+class PlanCache:
+    """以問題模板為 key 的 SQL/計畫快取（SQLite，LRU 淘汰）"""
+
+    def __init__(self, path: str = PLAN_CACHE_PATH, max_entries: int = PLAN_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(template: str, params: List[Dict[str, Any]]) -> str:
+        kinds = [p["kind"] for p in params]
+        return hashlib.sha256(json.dumps([template, kinds], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def lookup(self, question: str) -> Optional[Dict[str, Any]]:
+        """命中時回傳已重新綁定參數的 {"sql", "table_plan", "rewritten_query", "template"}"""
+        template, params = normalize(question)
+        key = self.make_key(template, params)
+        with self._lock:
+            row = self._db.execute("SELECT params, sql, table_plan, rewritten FROM plan_cache WHERE key = ?",
+                                   (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        old = json.loads(row[0])
+        sql = rebind_sql(row[1], old, params)
+        if sql is None:
+            self.misses += 1
+            return None
+        with self._lock:
+            self._db.execute("UPDATE plan_cache SET hits = hits + 1, last_access = ? WHERE key = ?",
+                             (time.time(), key))
+            self._db.commit()
+        self.hits += 1
+        values, vips = _value_maps(old, params)
+        return {
+            "key": key,
+            "template": template,
+            "sql": sql,
+            "table_plan": _rebind_obj(json.loads(row[2]), values, vips),
+            "rewritten_query": _rebind_obj(json.loads(row[3]), values, vips) if row[3] else None,
+        }
+
+    def store(self, question: str, sql: str, table_plan: Dict[str, Any],
+              rewritten_query: Optional[Dict[str, Any]] = None) -> bool:
+        """只快取每個參數都能在 SQL 中找到字面值、且沒有其他日期字面值的計畫；回傳是否已存入"""
+        template, params = normalize(question)
+        if not params_bound(sql, params) or unbound_dates(sql, params):
+            return False
+        key = self.make_key(template, params)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO plan_cache (key, template, params, sql, table_plan, rewritten, hits, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (key, template, json.dumps(params), sql, json.dumps(table_plan or {}, ensure_ascii=False, default=str),
+                 json.dumps(rewritten_query, ensure_ascii=False, default=str) if rewritten_query else None, now, now))
+            self._evict()
+            self._db.commit()
+        return True
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM plan_cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _evict(self):
+        n = self._db.execute("SELECT COUNT(*) FROM plan_cache").fetchone()[0]
+        if n > self.max_entries:
+            self._db.execute("DELETE FROM plan_cache WHERE key IN "
+                             "(SELECT key FROM plan_cache ORDER BY last_access ASC LIMIT ?)",
+                             (n - self.max_entries,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM plan_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {"entries": entries, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM plan_cache")
+            self._db.commit()
@@ -0,0 +1,239 @@
+# result_cache.py — 查詢結果快取（Parquet + LRU 容量上限）
+# 相同（正規化後）的 SQL 重複執行時直接讀回 Parquet，不再觸碰 Postgres：
+#   - key：去註解、壓縮空白、引號外轉小寫後的 SQL + max_rows
+#   - 失效：每張被引用資料表（sqlglot 解析，排除 CTE）的變動標記 = pg_stat_user_tables 的 n_tup_ins/upd/del
+#     + load_tables_to_pg 寫入的 etl.load_state.loaded_at；標記在 process 內快取
+#     RESULT_CACHE_MARKER_TTL 秒，TTL 內的命中完全不連資料庫
+#   - 儲存：每筆結果一個 zstd 壓縮的 Parquet 檔，索引存 SQLite，超過容量時依最後存取時間淘汰
+#   無法解析、引用其他 schema 或無法追蹤變動（如 view）的 SQL 一律不快取
+# pip install pyarrow sqlglot
+
+import os, re, json, time, hashlib, sqlite3, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", ".cache/results")
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+RESULT_CACHE_MARKER_TTL = float(os.getenv("RESULT_CACHE_MARKER_TTL", "30"))  # 秒
+ETL_STATE_SCHEMA = os.getenv("ETL_STATE_SCHEMA", "etl")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_cache (
+    key         TEXT PRIMARY KEY,
+    sql         TEXT NOT NULL,
+    tables      TEXT NOT NULL,
+    markers     TEXT NOT NULL,
+    bytes       INTEGER NOT NULL,
+    rows        INTEGER NOT NULL,
+    created_at  REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_cache_access ON result_cache(last_access);
+"""
+
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+_MARKER_SQL = """
+    SELECT relname AS name, n_tup_ins + n_tup_upd + n_tup_del AS n_mod
+    FROM pg_stat_user_tables
+    WHERE schemaname = :schema AND relname = ANY(:tables)
+"""
+
+
+def normalize_sql(sql: str) -> str:
+    """去除註解、壓縮空白；引號外的關鍵字/識別字轉小寫，字串常值與帶引號識別字維持原樣"""
+    parts = _QUOTED.split(sql.strip().rstrip(";"))
+    out = []
+    for i, p in enumerate(parts):
+        if i % 2:
+            out.append(p)
+        else:
+            p = re.sub(r"--[^\n]*", " ", p)
+            p = re.sub(r"/\*.*?\*/", " ", p, flags=re.S)
+            out.append(re.sub(r"\s+", " ", p).lower())
+    return "".join(out).strip()
+
+
+def _fold(node: exp.Identifier) -> str:
+    """PostgreSQL 的識別字折疊：加引號保留大小寫，未加引號轉小寫"""
+    return node.this if node.quoted else node.this.lower()
+
+
+def referenced_tables(sql: str, schema: str = "public") -> Optional[List[str]]:
+    """SQL 中引用的所有資料表（逗號 join、子查詢皆含，排除 CTE 名稱）；
+    無法解析或引用其他 schema 時回傳 None"""
+    try:
+        trees = [t for t in sqlglot.parse(sql, read="postgres") if t is not None]
+    except SqlglotError:
+        return None
+    if len(trees) != 1:
+        return None
+    ctes = {_fold(c.args["alias"].this) for c in trees[0].find_all(exp.CTE)
+            if isinstance(c.args.get("alias"), exp.TableAlias) and isinstance(c.args["alias"].this, exp.Identifier)}
+    names: List[str] = []
+    for t in trees[0].find_all(exp.Table):
+        if not isinstance(t.this, exp.Identifier):
+            continue     # 表函式（generate_series 等）沒有可追蹤的資料
+        db = t.args.get("db")
+        if db is not None and (not isinstance(db, exp.Identifier) or _fold(db) != schema):
+            return None
+        name = _fold(t.this)
+        if db is None and name in ctes:
+            continue
+        if name not in names:
+            names.append(name)
+    return names
+
+
+class ResultCache:
+    """以正規化 SQL 為 key 的 Parquet 結果快取"""
+
+    def __init__(self, engine: Engine, cache_dir: str = RESULT_CACHE_DIR,
+                 max_mb: float = RESULT_CACHE_MAX_MB, marker_ttl: float = RESULT_CACHE_MARKER_TTL,
+                 schema: str = "public"):
+        self.engine = engine
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_mb * 2**20)
+        self.marker_ttl = marker_ttl
+        self.schema = schema
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.dir / "index.sqlite"), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._markers: Dict[str, Tuple[float, str]] = {}   # table -> (checked_at, marker)
+        self.hits = 0
+        self.misses = 0
+
+    # ---------- 變動標記 ----------
+    def markers(self, tables: List[str]) -> Dict[str, str]:
+        """回傳 {table: marker}；TTL 內用 process 快取，不在 pg_stat 中的名稱略過"""
+        now = time.time()
+        stale = [t for t in tables if t not in self._markers or now - self._markers[t][0] > self.marker_ttl]
+        if stale:
+            fresh = {t: "" for t in stale}
+            with self.engine.connect() as conn:
+                for r in conn.execute(text(_MARKER_SQL), {"schema": self.schema, "tables": stale}).mappings():
+                    fresh[r["name"]] = f"m{int(r['n_mod'] or 0)}"
+                has_state = conn.execute(text("SELECT to_regclass(:t)"),
+                                         {"t": f"{ETL_STATE_SCHEMA}.load_state"}).scalar()
+                if has_state:
+                    for r in conn.execute(text(f"""
+                        SELECT table_name, loaded_at FROM "{ETL_STATE_SCHEMA}".load_state
+                        WHERE schema_name = :schema AND table_name = ANY(:tables)
+                    """), {"schema": self.schema, "tables": stale}).mappings():
+                        if fresh.get(r["table_name"]):
+                            fresh[r["table_name"]] += f"@{r['loaded_at']}"
+            for t, m in fresh.items():
+                self._markers[t] = (now, m)
+        return {t: self._markers[t][1] for t in tables if self._markers[t][1]}
+
+    # ---------- 查詢 / 寫入 ----------
+    @staticmethod
+    def make_key(normalized_sql: str, max_rows: Optional[int]) -> str:
+        return hashlib.sha256(f"{max_rows}|{normalized_sql}".encode("utf-8")).hexdigest()
+
+    def lookup(self, sql: str, max_rows: Optional[int] = None) -> Tuple[Optional[pa.Table], Optional[Dict[str, Any]]]:
+        """回傳 (命中的 pyarrow.Table 或 None, 寫入時使用的 token)；無法追蹤變動的 SQL 回傳 (None, None)"""
+        norm = normalize_sql(sql)
+        tables = referenced_tables(sql, self.schema)
+        if not tables:
+            return None, None
+        try:
+            markers = self.markers(tables)
+        except Exception as e:
+            print(f"[warn] result cache markers unavailable: {e}")
+            return None, None
+        if len(markers) != len(tables):
+            return None, None    # 有引用的關聯不在 pg_stat_user_tables（view 等），無法判斷失效
+        key = self.make_key(norm, max_rows)
+        token = {"key": key, "sql": norm, "markers": markers}
+
+        with self._lock:
+            row = self._db.execute("SELECT markers FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None and json.loads(row[0]) == markers:
+            try:
+                table = pq.read_table(self.dir / f"{key}.parquet")
+                with self._lock:
+                    self._db.execute("UPDATE result_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                self.hits += 1
+                return table, token
+            except (OSError, pa.ArrowException) as e:
+                print(f"[warn] result cache entry unreadable, dropping: {e}")
+                self._drop(key)
+        self.misses += 1
+        return None, token
+
+    def store(self, token: Optional[Dict[str, Any]], table: pa.Table):
+        """token 來自執行前的 lookup()；標記在執行前取得，執行期間有寫入時下次查詢會自然失效"""
+        if token is None:
+            return
+        key = token["key"]
+        path = self.dir / f"{key}.parquet"
+        tmp = path.with_suffix(".tmp")
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+        size = path.stat().st_size
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO result_cache (key, sql, tables, markers, bytes, rows, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, token["sql"], json.dumps(sorted(token["markers"])), json.dumps(token["markers"]),
+                 size, table.num_rows, now, now))
+            self._evict()
+            self._db.commit()
+
+    def store_rows(self, token: Optional[Dict[str, Any]], rows: List[Dict[str, Any]]):
+        if token is None:
+            return
+        try:
+            self.store(token, pa.Table.from_pylist(rows))
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            print(f"[warn] result not cached (mixed column types): {e}")
+
+    # ---------- 失效與淘汰 ----------
+    def invalidate(self, table: Optional[str] = None):
+        """清除引用某資料表（或全部）的結果；也清掉 process 內的標記快取"""
+        with self._lock:
+            if table is None:
+                keys = [r[0] for r in self._db.execute("SELECT key FROM result_cache")]
+                self._markers.clear()
+            else:
+                keys = [r[0] for r in self._db.execute("SELECT key, tables FROM result_cache")
+                        if table in json.loads(r[1])]
+                self._markers.pop(table, None)
+        for k in keys:
+            self._drop(k)
+
+    def _drop(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            self._db.commit()
+        (self.dir / f"{key}.parquet").unlink(missing_ok=True)
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM result_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, bytes FROM result_cache ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            (self.dir / f"{key}.parquet").unlink(missing_ok=True)
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM result_cache").fetchone()
+        total = self.hits + self.misses
+        return {"entries": entries, "mb": round(size / 2**20, 2), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -0,0 +1,71 @@
+# result_stream.py — 串流查詢結果的 generator 管線
+# server-side cursor 逐批取列 → 逐列後處理 → 保留有限筆預覽 + 累計統計，
+# 不必把整個結果集放進記憶體（峰值記憶體與結果列數無關）。
+
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Dict, Any, Optional, Tuple
+
+
+class RunningStats:
+    """逐列更新的欄位統計：筆數、null 數、min/max，數值欄位另計 sum/mean"""
+
+    def __init__(self):
+        self.row_count = 0
+        self.columns: Dict[str, Dict[str, Any]] = {}
+
+    def update(self, row: Dict[str, Any]):
+        self.row_count += 1
+        for key, value in row.items():
+            st = self.columns.get(key)
+            if st is None:
+                st = self.columns[key] = {"nulls": 0, "min": None, "max": None, "sum": None, "numeric": True}
+            if value is None:
+                st["nulls"] += 1
+                continue
+            is_num = isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+            if is_num and st["numeric"]:
+                st["sum"] = (st["sum"] or 0) + float(value)
+            else:
+                st["numeric"] = False
+                st["sum"] = None
+            try:
+                if st["min"] is None or value < st["min"]:
+                    st["min"] = value
+                if st["max"] is None or value > st["max"]:
+                    st["max"] = value
+            except TypeError:
+                # 混合型別無法比較，放棄 min/max
+                st["min"] = st["max"] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        cols = {}
+        for key, st in self.columns.items():
+            out = {"nulls": st["nulls"], "min": st["min"], "max": st["max"]}
+            if st["numeric"] and st["sum"] is not None:
+                non_null = self.row_count - st["nulls"]
+                out["sum"] = round(st["sum"], 6)
+                out["mean"] = round(st["sum"] / non_null, 6) if non_null else None
+            cols[key] = out
+        return {"row_count": self.row_count, "columns": cols}
+
+
+def iter_result(result, batch_size: int = 2000, max_rows: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """從 SQLAlchemy Result 逐批取出 dict 列"""
+    n = 0
+    for part in result.mappings().partitions(batch_size):
+        for r in part:
+            if max_rows is not None and n >= max_rows:
+                return
+            n += 1
+            yield dict(r)
+
+
+def consume(rows: Iterable[Dict[str, Any]], preview_rows: int = 50) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """消耗整個列串流，只保留前 preview_rows 筆，並回傳累計統計"""
+    preview: List[Dict[str, Any]] = []
+    stats = RunningStats()
+    for row in rows:
+        stats.update(row)
+        if len(preview) < preview_rows:
+            preview.append(row)
+    return preview, stats.to_dict()
@@ -0,0 +1,249 @@
+# rollups.py — 熱門分析維度的每日彙總表（rollup）
+# 大多數問題都是把 SessionActive / SessionLength / _p_GameConsume 依日期 + Country / VipLV / Channel / SysType 彙總；
+# 這裡在每次 load_tables_to_pg 之後建立並增量維護預先彙總的每日表：
+#   rollup_<table>_daily(日期, 維度..., row_count, user_count, <數值欄>_sum)
+# - 定義依實際欄位解析：不存在的維度/日期欄位自動略過，數值量測欄位預設自動偵測
+# - 增量：新增列（id > 上次處理到的 id）涉及的日期整天重算（DELETE + INSERT），distinct 計數仍正確
+# - 來源被 UPDATE/DELETE/TRUNCATE（pg_stat 計數或 relfilenode 改變）或定義改變時整表重建
+# - 定義與進度記錄在 etl.rollups；schema catalog 讀取後在表資訊附上 "rollup"，供 SQL 代理優先使用
+#
+# 用法：python rollups.py [--full] [table ...]
+
+import os, sys, json, time
+from typing import List, Dict, Any, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+ROLLUPS_ENABLED = os.getenv("ROLLUPS", "1") != "0"
+ROLLUP_SPEC_PATH = os.getenv("ROLLUP_SPEC_PATH")   # 選用：JSON 覆寫預設定義
+STATE_SCHEMA = os.getenv("ETL_STATE_SCHEMA", "etl")
+
+_DIMENSIONS = ["Country", "VipLV", "Channel", "SysType"]
+_DATE_CANDIDATES = ["LoginDate", "CreateDate", "PlayDate"]
+
+# 每張來源表：日期欄位候選（取第一個存在者）、維度、distinct 計數欄位、加總欄位（None = 自動偵測數值欄位）
+DEFAULT_SPECS: Dict[str, Dict[str, Any]] = {
+    "SessionActive": {"date": ["LoginDate"], "dimensions": _DIMENSIONS, "distinct": "UDID", "sums": []},
+    "SessionLength": {"date": _DATE_CANDIDATES, "dimensions": _DIMENSIONS, "distinct": "UDID", "sums": None},
+    "_p_GameConsume": {"date": ["CreateDate"], "dimensions": _DIMENSIONS, "distinct": "UDID", "sums": None},
+}
+
+_NUMERIC_TYPES = {"smallint", "integer", "bigint", "numeric", "real", "double precision"}
+_INT_DATE_TYPES = {"integer", "bigint"}
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def load_specs(path: Optional[str] = ROLLUP_SPEC_PATH) -> Dict[str, Dict[str, Any]]:
+    if not path:
+        return DEFAULT_SPECS
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def rollup_name(source: str) -> str:
+    return f"rollup_{source.lstrip('_')}_daily"
+
+
+def _is_measure(col: str, dims: List[str]) -> bool:
+    """自動偵測的加總欄位：排除鍵值、日期/時間、維度與 VipLV* 這類等級欄位"""
+    c = col.lower()
+    if c == "id" or c.endswith(("id", "key", "code")) or "date" in c or "time" in c:
+        return False
+    return not any(c == d.lower() or c.startswith(d.lower()) for d in dims)
+
+
+def ensure_registry(conn):
+    conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {quote_ident(STATE_SCHEMA)}"))
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {quote_ident(STATE_SCHEMA)}.rollups (
+            schema_name    TEXT NOT NULL,
+            rollup_name    TEXT NOT NULL,
+            source_table   TEXT NOT NULL,
+            definition     TEXT NOT NULL,
+            source_max_id  BIGINT,
+            source_state   TEXT,
+            refreshed_at   TIMESTAMPTZ,
+            PRIMARY KEY (schema_name, rollup_name)
+        )
+    """))
+
+
+def read_registry(engine: Engine, schema: str = "public") -> Dict[str, Dict[str, Any]]:
+    """{rollup 表名: 定義}；registry 不存在時回傳空 dict（schema catalog 使用）"""
+    with engine.connect() as conn:
+        if not conn.execute(text("SELECT to_regclass(:t)"), {"t": f"{STATE_SCHEMA}.rollups"}).scalar():
+            return {}
+        rows = conn.execute(text(f"""
+            SELECT rollup_name, definition, refreshed_at FROM {quote_ident(STATE_SCHEMA)}.rollups
+            WHERE schema_name = :s
+        """), {"s": schema}).mappings().all()
+    return {r["rollup_name"]: {**json.loads(r["definition"]), "refreshed_at": str(r["refreshed_at"])}
+            for r in rows}
+
+
+class RollupManager:
+    def __init__(self, engine: Engine, schema: str = "public",
+                 specs: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.engine = engine
+        self.schema = schema
+        self.specs = specs if specs is not None else load_specs()
+
+    # ---------- 定義解析 ----------
+    def resolve(self, conn, source: str) -> Optional[Dict[str, Any]]:
+        """依來源表實際欄位解析 rollup 定義；缺少可用日期欄位時回傳 None"""
+        spec = self.specs[source]
+        types = {r[0]: r[1] for r in conn.execute(text("""
+            SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = :s AND table_name = :t ORDER BY ordinal_position
+        """), {"s": self.schema, "t": source})}
+        if not types:
+            return None
+
+        date_col = next((c for c in spec["date"] if c in types), None)
+        if date_col is None:
+            return None
+        # YYYYMMDD 整數維持原值（與來源表相同的 BETWEEN 寫法）；timestamp / 文字日期轉為 date
+        if types[date_col] in _INT_DATE_TYPES:
+            date_expr, date_type = quote_ident(date_col), "int YYYYMMDD"
+        elif types[date_col] == "date":
+            date_expr, date_type = quote_ident(date_col), "date"
+        elif types[date_col].startswith("timestamp"):
+            date_expr, date_type = f"{quote_ident(date_col)}::date", "date"
+        elif types[date_col] == "text":
+            date_expr, date_type = f"{quote_ident(date_col)}::timestamp::date", "date"
+        else:
+            print(f"[warn] rollup {source}: {date_col} has type {types[date_col]}, skipped")
+            return None
+
+        dims = [d for d in spec["dimensions"] if d in types and d != date_col]
+        distinct = spec.get("distinct") if spec.get("distinct") in types else None
+        sums = spec.get("sums")
+        if sums is None:
+            sums = [c for c, t in types.items() if t in _NUMERIC_TYPES and _is_measure(c, dims)]
+        sums = [c for c in sums if c in types and types[c] in _NUMERIC_TYPES]
+
+        measures = {"row_count": "COUNT(*)"}
+        if distinct:
+            measures["user_count"] = f"COUNT(DISTINCT {quote_ident(distinct)})"
+        for c in sums:
+            measures[f"{c}_sum"] = f"SUM({quote_ident(c)})"
+        return {"name": rollup_name(source), "source": source, "grain": "day",
+                "date_column": date_col, "date_expr": date_expr, "date_type": date_type, "dimensions": dims,
+                "distinct": distinct, "measures": measures, "has_id": "id" in types}
+
+    def _select_sql(self, d: Dict[str, Any], where: str = "") -> str:
+        """彙總查詢；日期為 NULL 的列不屬於任何一天，完整重建與增量重算都一律排除"""
+        cond = f"{d['date_expr']} IS NOT NULL" + (f" AND {where}" if where else "")
+        cols = [f"{d['date_expr']} AS {quote_ident(d['date_column'])}"]
+        cols += [quote_ident(c) for c in d["dimensions"]]
+        cols += [f"{expr} AS {quote_ident(name)}" for name, expr in d["measures"].items()]
+        group = ", ".join(str(i) for i in range(1, len(d["dimensions"]) + 2))
+        src = f"{quote_ident(self.schema)}.{quote_ident(d['source'])}"
+        return f"SELECT {', '.join(cols)} FROM {src} WHERE {cond} GROUP BY {group}"
+
+    def _source_state(self, conn, source: str) -> str:
+        """relfilenode（TRUNCATE / 重建會改變）+ 累計 UPDATE/DELETE 數；任一改變代表既有列被改動"""
+        r = conn.execute(text("""
+            SELECT pg_relation_filenode(c.oid) AS filenode, s.n_tup_upd + s.n_tup_del AS n_changed
+            FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE s.schemaname = :s AND s.relname = :t
+        """), {"s": self.schema, "t": source}).mappings().first()
+        return f"{r['filenode']}:{r['n_changed']}" if r else ""
+
+    # ---------- 建立 / 增量維護 ----------
+    def refresh(self, source: str, full: bool = False) -> Optional[Dict[str, Any]]:
+        started = time.time()
+        with self.engine.begin() as conn:
+            ensure_registry(conn)
+            d = self.resolve(conn, source)
+            if d is None:
+                return None
+            # version 2：排除 NULL 日期；定義變更會觸發完整重建，舊版含 NULL 組的 rollup 會被更新
+            name = d["name"]
+            definition = json.dumps({**{k: v for k, v in d.items() if k != "has_id"}, "version": 2}, sort_keys=True)
+            tbl_q = f"{quote_ident(self.schema)}.{quote_ident(name)}"
+            src_q = f"{quote_ident(self.schema)}.{quote_ident(source)}"
+            reg = conn.execute(text(f"""
+                SELECT definition, source_max_id, source_state FROM {quote_ident(STATE_SCHEMA)}.rollups
+                WHERE schema_name = :s AND rollup_name = :n
+            """), {"s": self.schema, "n": name}).mappings().first()
+            state = self._source_state(conn, source)
+            max_id = conn.execute(text(f"SELECT MAX(id) FROM {src_q}")).scalar() if d["has_id"] else None
+            exists = conn.execute(text("SELECT to_regclass(:t)"), {"t": tbl_q}).scalar()
+
+            full = (full or reg is None or not exists or not d["has_id"]
+                    or reg["definition"] != definition or reg["source_state"] != state
+                    or reg["source_max_id"] is None or (max_id or 0) < reg["source_max_id"])
+            days = None
+            if full:
+                conn.execute(text(f"DROP TABLE IF EXISTS {tbl_q}"))
+                conn.execute(text(f"CREATE TABLE {tbl_q} AS {self._select_sql(d)}"))
+                conn.execute(text(f'CREATE INDEX ON {tbl_q} ({quote_ident(d["date_column"])})'))
+            elif (max_id or 0) > reg["source_max_id"]:
+                # 新增列涉及的日期整天重算
+                days = [r[0] for r in conn.execute(text(
+                    f"SELECT DISTINCT {d['date_expr']} FROM {src_q} "
+                    f"WHERE id > :lo AND id <= :hi AND {d['date_expr']} IS NOT NULL"),
+                    {"lo": reg["source_max_id"], "hi": max_id})]
+                date_q = quote_ident(d["date_column"])
+                where = f"{d['date_expr']} = ANY(:days)"
+                conn.execute(text(f"DELETE FROM {tbl_q} WHERE {date_q} = ANY(:days)"), {"days": days})
+                conn.execute(text(f"INSERT INTO {tbl_q} {self._select_sql(d, where)}"), {"days": days})
+            else:
+                return {"rollup": name, "mode": "unchanged", "seconds": round(time.time() - started, 3)}
+
+            conn.execute(text(f"""
+                INSERT INTO {quote_ident(STATE_SCHEMA)}.rollups
+                    (schema_name, rollup_name, source_table, definition, source_max_id, source_state, refreshed_at)
+                VALUES (:s, :n, :src, :def, :max_id, :state, now())
+                ON CONFLICT (schema_name, rollup_name) DO UPDATE SET
+                    source_table = EXCLUDED.source_table, definition = EXCLUDED.definition,
+                    source_max_id = EXCLUDED.source_max_id, source_state = EXCLUDED.source_state,
+                    refreshed_at = EXCLUDED.refreshed_at
+            """), {"s": self.schema, "n": name, "src": source, "def": definition,
+                   "max_id": max_id, "state": state})
+            rows = conn.execute(text(f"SELECT COUNT(*) FROM {tbl_q}")).scalar()
+
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"ANALYZE {tbl_q}"))
+        return {"rollup": name, "mode": "full" if full else "incremental",
+                "days": None if days is None else len(days), "rows": rows,
+                "seconds": round(time.time() - started, 3)}
+
+    def refresh_all(self, tables: Optional[List[str]] = None, full: bool = False) -> List[Dict[str, Any]]:
+        """只處理有定義的來源表；單一 rollup 失敗不影響其他"""
+        results = []
+        for source in self.specs:
+            if tables is not None and source not in tables:
+                continue
+            try:
+                r = self.refresh(source, full=full)
+            except Exception as e:
+                r = {"rollup": rollup_name(source), "error": f"{type(e).__name__}: {e}"}
+            if r is None:
+                continue
+            if r.get("error"):
+                print(f"[FAIL] {r['rollup']}: {r['error']}")
+            else:
+                print(f"[ROLLUP] {r['rollup']}: {r['mode']}"
+                      + (f", {r['rows']} rows" if "rows" in r else "") + f" in {r['seconds']}s")
+            results.append(r)
+        return results
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    args = sys.argv[1:]
+    full = "--full" in args
+    tables = [a for a in args if a != "--full"] or None
+    engine = create_engine(os.getenv("PG_URI"), pool_pre_ping=True)
+    RollupManager(engine, schema=os.getenv("PG_SCHEMA", "public")).refresh_all(tables, full=full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# schema_catalog.py — 持久化 schema 目錄
+# 取代每次 ask() 都逐表 get_columns + SELECT * + COUNT(*) 的完整掃描：
+#   - 欄位定義、樣本資料、估計列數 (pg_class.reltuples) 快取在記憶體與磁碟
+#   - TTL 內直接回傳；TTL 到期後只查 pg_stat_user_tables 變動簽章
+#   - 只有簽章改變的資料表才重新掃描（增量刷新）
+
+import os, json, time, hashlib, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+from sqlalchemy import text, inspect
+from sqlalchemy.engine import Engine
+from rollups import read_registry
+
+SCHEMA_CACHE_PATH = os.getenv("SCHEMA_CACHE_PATH", ".cache/schema_catalog.json")
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "300"))  # 秒
+
+# 每張表的變動簽章：DML 計數 + 欄位數（ALTER TABLE 不會動到 n_tup_*）
+_SIGNATURE_SQL = """
+    SELECT s.relname AS name,
+           s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+           (SELECT COUNT(*) FROM pg_attribute a
+             WHERE a.attrelid = s.relid AND a.attnum > 0 AND NOT a.attisdropped) AS n_cols
+    FROM pg_stat_user_tables s
+    WHERE s.schemaname = :schema
+"""
+
+_ESTIMATE_SQL = """
+    SELECT c.relname AS name, c.reltuples::bigint AS reltuples, s.n_live_tup
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+"""
+
+
+def _engine_key(engine: Engine) -> str:
+    """以連線目標（不含密碼）區分不同資料庫的快取檔"""
+    url = engine.url
+    target = f"{url.drivername}://{url.username}@{url.host}:{url.port}/{url.database}"
+    return hashlib.sha256(target.encode("utf-8")).hexdigest()[:16]
+
+
+class SchemaCatalog:
+    """可增量刷新的 schema 目錄，輸出格式與 DbAgent.scan_schema 相同"""
+
+    def __init__(self, engine: Engine, schema: str = "public",
+                 cache_path: Optional[str] = SCHEMA_CACHE_PATH,
+                 ttl: float = SCHEMA_CACHE_TTL, sample_rows: int = 5):
+        self.engine = engine
+        self.schema = schema
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.ttl = ttl
+        self.sample_rows = sample_rows
+        self._lock = threading.Lock()
+        self._key = _engine_key(engine)
+        self._tables: Dict[str, Dict[str, Any]] = {}
+        self._signatures: Dict[str, List[int]] = {}
+        self._checked_at = 0.0
+        self._load_from_disk()
+
+    # ---------- public API ----------
+    def get(self, sample_rows: Optional[int] = None, force: bool = False) -> Dict[str, Any]:
+        """取得 schema 概覽；必要時才觸碰資料庫"""
+        with self._lock:
+            if sample_rows is not None and sample_rows > self.sample_rows:
+                # 要求的樣本數超過快取內容，需重新取樣
+                self.sample_rows = sample_rows
+                force = True
+            if force:
+                self._refresh(full=True)
+            elif not self._tables or time.time() - self._checked_at > self.ttl:
+                self._refresh(full=False)
+            return self._overview(sample_rows if sample_rows is not None else self.sample_rows)
+
+    def invalidate(self, table: Optional[str] = None):
+        """標記快取失效；下次 get() 時重新檢查"""
+        with self._lock:
+            if table is None:
+                self._signatures.clear()
+            else:
+                self._signatures.pop(table, None)
+            self._checked_at = 0.0
+
+    def table_names(self) -> List[str]:
+        return [t["name"] for t in self.get()["tables"]]
+
+    # ---------- refresh ----------
+    def _refresh(self, full: bool):
+        with self.engine.connect() as conn:
+            signatures = {
+                r["name"]: [int(r["n_tup_ins"] or 0), int(r["n_tup_upd"] or 0),
+                            int(r["n_tup_del"] or 0), int(r["n_cols"] or 0)]
+                for r in conn.execute(text(_SIGNATURE_SQL), {"schema": self.schema}).mappings()
+            }
+
+        if full:
+            changed = list(signatures)
+        else:
+            changed = [t for t, sig in signatures.items()
+                       if self._signatures.get(t) != sig or t not in self._tables]
+        removed = [t for t in self._tables if t not in signatures]
+
+        for t in removed:
+            self._tables.pop(t, None)
+            self._signatures.pop(t, None)
+
+        if changed:
+            estimates = self._row_estimates()
+            insp = inspect(self.engine)
+            for t in changed:
+                self._tables[t] = self._scan_table(insp, t, estimates.get(t, 0))
+                self._signatures[t] = signatures[t]
+            self._attach_rollups()
+
+        self._checked_at = time.time()
+        if changed or removed or full:
+            print(f"[catalog] refreshed {len(changed)} table(s), removed {len(removed)}")
+        self._save_to_disk()
+
+    def _row_estimates(self) -> Dict[str, int]:
+        """以 pg_class.reltuples 估計列數；尚未 ANALYZE (-1) 時退回 n_live_tup"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(_ESTIMATE_SQL), {"schema": self.schema}).mappings().all()
+        est = {}
+        for r in rows:
+            n = int(r["reltuples"] or 0)
+            if n <= 0:
+                n = int(r["n_live_tup"] or 0)
+            est[r["name"]] = n
+        return est
+
+    def _scan_table(self, insp, table: str, row_estimate: int) -> Dict[str, Any]:
+        cols = insp.get_columns(table, schema=self.schema)
+        col_defs = [{"name": c["name"], "type": str(c["type"])} for c in cols]
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text(f'SELECT * FROM "{self.schema}"."{table}" LIMIT :n'),
+                    {"n": self.sample_rows}
+                ).mappings().all()
+            # 透過 JSON 往返，讓記憶體與磁碟快取內容一致（Decimal/date 轉字串）
+            sample = json.loads(json.dumps([dict(r) for r in rows], ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"[warn] sample rows for {table} failed: {e}")
+            sample = []
+        return {"name": table, "columns": col_defs, "sample": sample, "total_rows": row_estimate}
+
+    def _attach_rollups(self):
+        """rollup 表附上定義（來源表、日期欄位、維度、量測），讓代理知道可用它取代掃描來源表"""
+        try:
+            registry = read_registry(self.engine, self.schema)
+        except Exception as e:
+            print(f"[warn] rollup registry unavailable: {e}")
+            return
+        for name, t in self._tables.items():
+            d = registry.get(name)
+            if d:
+                t["rollup"] = {k: d[k] for k in ("source", "grain", "date_column", "date_type", "dimensions", "measures",
+                                                 "refreshed_at") if k in d}
+            else:
+                t.pop("rollup", None)
+
+    def _overview(self, sample_rows: int) -> Dict[str, Any]:
+        tables = []
+        for name in sorted(self._tables):
+            t = self._tables[name]
+            tables.append({**t, "sample": t["sample"][:sample_rows]})
+        return {
+            "tables": tables,
+            "scan_timestamp": int(self._checked_at * 1000),
+            "total_tables": len(tables),
+        }
+
+    # ---------- persistence ----------
+    def _load_from_disk(self):
+        if not self.cache_path or not self.cache_path.exists():
+            return
+        try:
+            data = json.loads(self.cache_path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"[warn] schema catalog cache unreadable: {e}")
+            return
+        entry = data.get(self._key)
+        if not entry or entry.get("schema") != self.schema:
+            return
+        self._tables = {t["name"]: t for t in entry.get("tables", [])}
+        self._signatures = entry.get("signatures", {})
+        self._checked_at = float(entry.get("checked_at", 0.0))
+        self.sample_rows = max(self.sample_rows, int(entry.get("sample_rows", 0)))
+
+    def _save_to_disk(self):
+        if not self.cache_path:
+            return
+        try:
+            data = {}
+            if self.cache_path.exists():
+                data = json.loads(self.cache_path.read_text(encoding="utf-8"))
+            data[self._key] = {
+                "schema": self.schema,
+                "checked_at": self._checked_at,
+                "sample_rows": self.sample_rows,
+                "signatures": self._signatures,
+                "tables": list(self._tables.values()),
+            }
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.cache_path)
+        except Exception as e:
+            print(f"[warn] schema catalog cache not saved: {e}")
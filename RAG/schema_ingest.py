@@ -0,0 +1,231 @@
+# schema_ingest.py — 統一的 schema card 攝取引擎
+# 取代 ingest_all_schemas / ingest_schema_csv_to_mongo 各自的解析與逐表 embed + update_one：
+# 1) 維度表只讀表頭與前 SCHEMA_SAMPLE_ROWS 列推斷型別（不再整檔 pd.read_csv）
+# 2) 多檔以 process pool 並行解析
+# 3) 一次查回既有 content_hash，未變更者略過；變更的 card 一次批次 embed
+# 4) 以單一 bulk_write 寫入
+# pip install pymongo pandas sentence-transformers
+
+import os, csv, time, hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable
+
+SCHEMA_DIR = os.getenv("SCHEMA_DIR", "data/schema_csv")
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", "50"))
+SCHEMA_PARSE_WORKERS = int(os.getenv("SCHEMA_PARSE_WORKERS", str(os.cpu_count() or 4)))
+
+# 手動定義的特殊 schema（原始 CSV 格式不規則，無法自動解析）
+SPECIAL_SCHEMAS = {
+    "SessionActive": [
+        {"name": "ProDate", "data_type": "int", "description": "資料傳送日期,轉檔日期, 格式: yyyyMMdd (UTC+8) Taiwan Zone"},
+        {"name": "LoginDate", "data_type": "int", "description": "登入日期,帳號登入日期,取Client連線登入遊戲時間格式: yyyyMMdd"},
+        {"name": "SessionID", "data_type": "varchar(50)", "description": "SessionID"},
+        {"name": "UserID", "data_type": "int", "description": "玩家自動ID(帳號)"},
+        {"name": "LoginTime", "data_type": "bigint", "description": "登入時間,帳號登入日期, Unix timestamp (單位:1000000分之一秒)"},
+        {"name": "UDID", "data_type": "nvarchar(36)", "description": "設備識別ID,記錄設備的唯一識別ID"},
+        {"name": "SysType", "data_type": "int", "description": "操作系統"},
+        {"name": "Country", "data_type": "char(2)", "description": "所在地區(國別),ISO 3166-1 alpha-2"},
+        {"name": "Region", "data_type": "nvarchar(20)", "description": "所在地區(省市)"},
+        {"name": "Channel", "data_type": "int", "description": "上架平台/渠道,用戶下載遊戲的來源平台代碼"},
+        {"name": "PublishVer", "data_type": "varchar(20)", "description": "遊戲版本,遊戲發行的版本代碼或編號"},
+        {"name": "DEV", "data_type": "nvarchar(100)", "description": "機型"},
+        {"name": "SysVer", "data_type": "nvarchar(20)", "description": "操作系統版本"},
+        {"name": "Resolution", "data_type": "varchar(20)", "description": "解析度/分辨率"},
+        {"name": "Network", "data_type": "int", "description": "聯網方式"},
+        {"name": "LV", "data_type": "int", "description": "目前等級,玩家等級"},
+        {"name": "VipLV", "data_type": "int", "description": "目前VIP等級,玩家等級代碼"},
+        {"name": "LoginTimeTs", "data_type": "int", "description": "登入時間 10位數,帳號登入日期, Unix timestamp"},
+        {"name": "IP", "data_type": "varchar(50)", "description": "IP"},
+        {"name": "IDFA", "data_type": "varchar(40)", "description": "IDFA,iOS裝置識別"},
+        {"name": "IDFV", "data_type": "varchar(40)", "description": "IDFV,iOS 裝置Vindor標示符"},
+        {"name": "IMEI", "data_type": "varchar(16)", "description": "IMEI,Android裝置識別"},
+        {"name": "AAID", "data_type": "varchar(36)", "description": "AAID,Google Advertising ID"},
+        {"name": "AndroidID", "data_type": "varchar(16)", "description": "AndroidID,Google Android ID"},
+        {"name": "GtDeviceID", "data_type": "nvarchar(128)", "description": "GT裝置識別碼,線上(GT)共用的裝置識別碼"},
+        {"name": "OpenType", "data_type": "int", "description": "第三方驗證者,第三方綁定"},
+        {"name": "OpenID", "data_type": "varchar(30)", "description": "第三方驗證使用者ID"}
+    ]
+}
+
+
+def table_name_for(csvp: Path) -> str:
+    return csvp.stem.replace(" ", "").strip()
+
+
+def to_text(table: str, columns_info: List[Dict[str, str]]) -> str:
+    lines = [f"# Table: {table}", "## Columns", ""]
+    for c in columns_info:
+        lines.append(f"- {c.get('name', '')} ({c.get('data_type', '')}) – {c.get('description', '')}")
+    return "\n".join(lines)
+
+
+# ---------- 格式偵測與解析（只讀表頭/少量樣本） ----------
+def _head(csvp: Path, n: int = 2) -> List[List[str]]:
+    rows = []
+    with open(csvp, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            rows.append([c.strip() for c in row])
+            if len(rows) >= n:
+                break
+    return rows
+
+
+def detect_format(csvp: Path) -> str:
+    """schema_description：第一行表名、第二行為 name/data type 標題
+    column_list：表頭含 column_name（每列描述一個欄位）
+    dimension：一般資料表，欄位即表頭"""
+    try:
+        head = _head(csvp)
+    except (OSError, UnicodeDecodeError, csv.Error):
+        return "dimension"
+    first = [h.lower() for h in head[0]] if head else []
+    second = " ".join(head[1]).lower() if len(head) > 1 else ""
+    if "column_name" in first:
+        return "column_list"
+    if "name" in second and "data type" in second:
+        return "schema_description"
+    return "dimension"
+
+
+def parse_schema_description(csvp: Path) -> List[Dict[str, str]]:
+    """每一列描述一個欄位；此類檔案很小，直接以 csv.reader 逐列讀取（正確處理引號內逗號）"""
+    with open(csvp, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)                       # 表名列
+        headers = [h.strip().lower() for h in next(reader, [])]
+
+        def find(pred) -> int:
+            return next((i for i, h in enumerate(headers) if pred(h)), -1)
+
+        name_idx = find(lambda h: h == "name")
+        if name_idx == -1:
+            name_idx = find(lambda h: "name" in h)
+        dtype_idx = find(lambda h: ("data type" in h or "datatype" in h) and "mssql" in h)
+        if dtype_idx == -1:
+            dtype_idx = find(lambda h: "data type" in h or "datatype" in h)
+        desc_idx = find(lambda h: "details" in h or "description" in h)
+        if name_idx == -1:
+            return []
+
+        def cell(row, idx):
+            return row[idx].strip().strip('"') if 0 <= idx < len(row) else ""
+
+        columns_info = []
+        for row in reader:
+            name = cell(row, name_idx)
+            if not name or name.lower() == "name":
+                continue
+            columns_info.append({"name": name, "data_type": cell(row, dtype_idx),
+                                 "description": cell(row, desc_idx)})
+        return columns_info
+
+
+def parse_column_list(csvp: Path) -> List[Dict[str, str]]:
+    with open(csvp, "r", encoding="utf-8-sig", newline="") as f:
+        return [{"name": (r.get("column_name") or "").strip(),
+                 "data_type": (r.get("data_type") or "").strip(),
+                 "description": (r.get("description") or "").strip()}
+                for r in csv.DictReader(f) if (r.get("column_name") or "").strip()]
+
+
+def parse_dimension(csvp: Path, sample_rows: int = SCHEMA_SAMPLE_ROWS) -> List[Dict[str, str]]:
+    """維度表：只讀表頭與前 sample_rows 列推斷型別"""
+    import pandas as pd
+    df = pd.read_csv(csvp, nrows=sample_rows)
+    columns_info = []
+    for col in df.columns:
+        data_type = "int" if pd.api.types.is_numeric_dtype(df[col]) else "varchar"
+        desc = f"{col} 欄位"
+        if "key" in col.lower() or "id" in col.lower():
+            desc = f"{col} 識別碼"
+        elif "name" in col.lower():
+            desc = f"{col} 名稱"
+        columns_info.append({"name": col, "data_type": data_type, "description": desc})
+    return columns_info
+
+
+def build_schema_card(table: str, columns_info: List[Dict[str, str]], source_path: str) -> Dict[str, Any]:
+    """schema card 文件（尚未含 embedding）"""
+    text = to_text(table, columns_info)
+    return {
+        "type": "schema",
+        "title": f"schema::{table}",
+        "text": text,
+        "meta": {"table": table, "columns": [c["name"] for c in columns_info]},
+        "source_path": source_path,
+        "content_hash": hashlib.sha256(text.encode()).hexdigest(),
+    }
+
+
+def parse_file(path_str: str) -> Optional[Dict[str, Any]]:
+    """在 worker process 中執行：單一 CSV → schema card；無法解析時回傳 None"""
+    csvp = Path(path_str)
+    table = table_name_for(csvp)
+    try:
+        if table in SPECIAL_SCHEMAS:
+            columns_info = SPECIAL_SCHEMAS[table]
+        else:
+            fmt = detect_format(csvp)
+            if fmt == "schema_description":
+                columns_info = parse_schema_description(csvp)
+            elif fmt == "column_list":
+                columns_info = parse_column_list(csvp)
+            else:
+                columns_info = parse_dimension(csvp)
+    except Exception as e:
+        print(f"[warn] parse failed for {csvp}: {e}")
+        return None
+    if not columns_info:
+        return None
+    return build_schema_card(table, columns_info, str(csvp))
+
+
+# ---------- 批次同步 ----------
+def sync_schema_cards(cards: List[Dict[str, Any]], col=None, force: bool = False) -> Dict[str, int]:
+    """一次查回既有 content_hash → 只 embed 變更的 card（單一批次）→ 單一 bulk_write"""
+    from pymongo import UpdateOne
+    from embedding_service import embed_texts
+    if col is None:
+        from mongo_pool import get_collection
+        col = get_collection(os.getenv("MONGO_DB", "ragdb"), os.getenv("MONGO_COL", "cards"))
+
+    # 同一表名重複時以最後一個為準
+    cards = list({c["title"]: c for c in cards}.values())
+    existing = {}
+    if not force and cards:
+        for e in col.find({"type": "schema", "title": {"$in": [c["title"] for c in cards]}},
+                          {"title": 1, "content_hash": 1}):
+            existing[e["title"]] = e.get("content_hash")
+    changed = [c for c in cards if force or existing.get(c["title"]) != c["content_hash"]]
+
+    if changed:
+        vecs = embed_texts([c["text"] for c in changed])
+        now = time.time()
+        ops = [UpdateOne({"type": c["type"], "title": c["title"]},
+                         {"$set": {**c, "embedding": v, "updatedAt": now}}, upsert=True)
+               for c, v in zip(changed, vecs)]
+        col.bulk_write(ops, ordered=False)
+    return {"cards": len(cards), "changed": len(changed), "unchanged": len(cards) - len(changed)}
+
+
+def ingest_schema_files(paths: Iterable[Path], workers: int = SCHEMA_PARSE_WORKERS,
+                        col=None, force: bool = False) -> Dict[str, Any]:
+    paths = [str(p) for p in paths]
+    started = time.time()
+    cards, failed = [], []
+    if paths:
+        workers = max(1, min(workers, len(paths)))
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for p, card in zip(paths, ex.map(parse_file, paths)):
+                if card is None:
+                    failed.append(p)
+                else:
+                    cards.append(card)
+    stats = sync_schema_cards(cards, col=col, force=force)
+    stats.update({"files": len(paths), "failed": failed, "seconds": round(time.time() - started, 2)})
+    return stats
+
+
+def ingest_schema_dir(schema_dir: Path = Path(SCHEMA_DIR), **kw) -> Dict[str, Any]:
+    return ingest_schema_files(sorted(Path(schema_dir).glob("*.csv")), **kw)
@@ -0,0 +1,169 @@
+# schema_linker.py — schema linking：只把與查詢相關的表/欄位交給代理
+# 評分來源：
+# 1) schema card embedding（本地向量索引中 type=schema 的 card；索引中沒有的表即時 embed 並快取）
+# 2) 欄位名/表名模糊比對（camelCase 拆詞 + difflib），以及 card 內中文欄位說明的詞重疊
+# 3) 關聯提示：共用的 *ID / *Key 欄位、DimX ↔ X/XKey 命名慣例，把維度表帶進來
+# 輸出與 db_overview 相同格式（tables 只含 top-N 表與其相關欄位），另附 join_hints。
+
+import os, re, difflib
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+import numpy as np
+
+from embedding_service import embed_query, embed_texts
+from hybrid_search import tokenize
+from vector_index import get_local_index, LocalVectorIndex
+
+SCHEMA_LINK_TOP_N = int(os.getenv("SCHEMA_LINK_TOP_N", "8"))
+SCHEMA_LINK_MAX_COLUMNS = int(os.getenv("SCHEMA_LINK_MAX_COLUMNS", "30"))
+
+_DESC_LINE = re.compile(r"^-\s*(\S+)\s*\(.*?\)\s*[–-]\s*(.*)$")
+_KEY_SUFFIXES = ("id", "key", "code")
+
+
+def _is_key(col: str) -> bool:
+    c = col.lower()
+    return c != "id" and c.endswith(_KEY_SUFFIXES)
+
+
+def _is_time(col: str) -> bool:
+    c = col.lower()
+    return "date" in c or "time" in c
+
+
+class SchemaLinker:
+    def __init__(self, index: Optional[LocalVectorIndex] = None,
+                 collection_fn: Optional[Callable[[], Any]] = None,
+                 top_n: int = SCHEMA_LINK_TOP_N, max_columns: int = SCHEMA_LINK_MAX_COLUMNS):
+        self.index = index
+        self.collection_fn = collection_fn
+        self.top_n = top_n
+        self.max_columns = max_columns
+        self._table_vecs: Dict[Tuple[str, int], np.ndarray] = {}
+
+    # ---------- 1) embedding 相似度 ----------
+    def _card_scores(self, qv: np.ndarray) -> Tuple[Dict[str, float], Dict[str, Dict[str, str]]]:
+        """回傳 ({table: cosine}, {table: {column: 說明}})，來源為本地索引中的 schema card"""
+        index = self.index or get_local_index()
+        if self.collection_fn is not None:
+            index.maybe_sync(self.collection_fn())
+        scores, descs = {}, {}
+        for card in index.search(qv, k=max(len(index), 1), card_type="schema"):
+            table = (card.get("meta") or {}).get("table")
+            if not table:
+                continue
+            scores[table] = max(scores.get(table, -1.0), float(card["score"]))
+            cols = {}
+            for line in (card.get("text") or "").splitlines():
+                m = _DESC_LINE.match(line.strip())
+                if m:
+                    cols[m.group(1)] = m.group(2)
+            descs[table] = cols
+        return scores, descs
+
+    def _fallback_scores(self, qv: np.ndarray, tables: List[Dict[str, Any]]) -> Dict[str, float]:
+        """索引中沒有 schema card 的表：以 表名 + 欄位名 即時 embed（每個 process 快取）"""
+        missing = [t for t in tables if (t["name"], len(t["columns"])) not in self._table_vecs]
+        if missing:
+            texts = [f"Table: {t['name']}\nColumns: {', '.join(c['name'] for c in t['columns'])}" for t in missing]
+            for t, v in zip(missing, embed_texts(texts)):
+                self._table_vecs[(t["name"], len(t["columns"]))] = np.asarray(v, dtype=np.float32)
+        return {t["name"]: float(self._table_vecs[(t["name"], len(t["columns"]))] @ qv) for t in tables}
+
+    # ---------- 2) 模糊比對 ----------
+    @staticmethod
+    def _column_score(col: str, desc: str, q_tokens: set, q_idents: set) -> float:
+        name = col.lower()
+        if name in q_idents:
+            return 1.0
+        parts = set(tokenize(col))
+        score = 0.0
+        if parts & q_tokens:
+            score = 0.5 * len(parts & q_tokens) / len(parts)
+        for w in q_idents:
+            if len(w) >= 4 and difflib.SequenceMatcher(None, name, w).ratio() >= 0.8:
+                score = max(score, 0.8)
+        if desc:
+            d_tokens = {t for t in tokenize(desc) if len(t) > 1}
+            if d_tokens & q_tokens:
+                score = max(score, min(0.7, 0.2 * len(d_tokens & q_tokens)))
+        return score
+
+    # ---------- 3) 關聯提示 ----------
+    @staticmethod
+    def join_hints(tables: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        hints = []
+        names = [t["name"] for t in tables]
+        cols = {t["name"]: {c["name"] for c in t["columns"]} for t in tables}
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                for c in sorted(cols[a] & cols[b]):
+                    if _is_key(c):
+                        hints.append({"left": f"{a}.{c}", "right": f"{b}.{c}"})
+                for x, y in ((a, b), (b, a)):
+                    if x.startswith("Dim") and len(x) > 3:
+                        base = x[3:]
+                        for c in (base, base + "Key", base + "ID", base + "Id"):
+                            if c in cols[y]:
+                                key = next((k for k in cols[x] if _is_key(k) or k == base), None)
+                                if key:
+                                    hints.append({"left": f"{y}.{c}", "right": f"{x}.{key}"})
+        return hints
+
+    # ---------- 主流程 ----------
+    def link(self, query_text: str, db_overview: Dict[str, Any], top_n: Optional[int] = None,
+             max_columns: Optional[int] = None) -> Dict[str, Any]:
+        tables = (db_overview or {}).get("tables", [])
+        top_n = top_n or self.top_n
+        max_columns = self.max_columns if max_columns is None else max_columns
+        if len(tables) <= top_n and all(not max_columns or len(t["columns"]) <= max_columns for t in tables):
+            return db_overview
+
+        qv = np.asarray(embed_query(query_text), dtype=np.float32)
+        try:
+            emb, descs = self._card_scores(qv)
+        except Exception as e:
+            print(f"[warn] schema card scores unavailable: {e}")
+            emb, descs = {}, {}
+        missing = [t for t in tables if t["name"] not in emb]
+        if missing:
+            emb.update(self._fallback_scores(qv, missing))
+
+        q_tokens = set(tokenize(query_text))
+        q_idents = {w.lower() for w in re.findall(r"[A-Za-z][A-Za-z0-9_]*", query_text)}
+        scored, col_scores = {}, {}
+        for t in tables:
+            d = descs.get(t["name"], {})
+            cs = {c["name"]: self._column_score(c["name"], d.get(c["name"], ""), q_tokens, q_idents)
+                  for c in t["columns"]}
+            col_scores[t["name"]] = cs
+            name_hit = 1.0 if t["name"].lower() in q_idents else 0.0
+            top_cols = sorted(cs.values(), reverse=True)[:3]
+            scored[t["name"]] = emb.get(t["name"], 0.0) + name_hit + 0.5 * sum(top_cols)
+
+        ranked = sorted(tables, key=lambda t: -scored[t["name"]])
+        chosen = ranked[:top_n]
+        # 關聯提示：把與已選表可 join 的維度表帶進來（最多 top_n // 2 張）
+        extra = []
+        for t in ranked[top_n:]:
+            if len(extra) >= max(1, top_n // 2):
+                break
+            if t["name"].startswith("Dim") and self.join_hints(chosen + [t]) != self.join_hints(chosen):
+                extra.append(t)
+        chosen += extra
+
+        linked_tables = []
+        for t in chosen:
+            cs = col_scores[t["name"]]
+            cols = t["columns"]
+            if max_columns and len(cols) > max_columns:
+                # 保留相關欄位 + 鍵值/日期欄位，依原順序輸出
+                keep = sorted(cols, key=lambda c: -(cs[c["name"]] + (0.3 if _is_key(c["name"]) or _is_time(c["name"]) else 0)))
+                keep = {c["name"] for c in keep[:max_columns]}
+                cols = [c for c in cols if c["name"] in keep]
+            sample = [{k: v for k, v in r.items() if k in {c["name"] for c in cols}} for r in (t.get("sample") or [])]
+            linked_tables.append({**t, "columns": cols, "sample": sample,
+                                  "link_score": round(scored[t["name"]], 4)})
+
+        return {**db_overview, "tables": linked_tables, "total_tables": len(linked_tables),
+                "linked_from": len(tables), "join_hints": self.join_hints(linked_tables)}
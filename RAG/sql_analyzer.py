@@ -0,0 +1,169 @@
+# sql_analyzer.py — 離線 SQL 檢查（sqlglot AST，不連資料庫）
+# 在送出到 PostgreSQL 之前：
+#   - 唯讀：只允許單一 SELECT / WITH 查詢；AST 中出現 DML/DDL、SELECT INTO、FOR UPDATE、
+#     有副作用的函式（pg_sleep、set_config、nextval…）即拒絕。以語法節點判斷，CreateDate 之類的欄位名不會誤判
+#   - 識別字：每個 scope 的表/欄位依 PostgreSQL 規則（未加引號轉小寫）對照 schema catalog，
+#     錯誤訊息格式與 PG 相同（UndefinedTable / UndefinedColumn），並附上最接近的名稱
+# 無法解析或無法確定來源（表函式、SELECT * 的子查詢、其他 schema）時不報錯，交由資料庫判斷。
+# pip install sqlglot
+
+import difflib
+from typing import List, Dict, Any, Optional, Set
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.scope import traverse_scope, Scope
+
+_WRITE_NODES = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Alter,
+                exp.TruncateTable, exp.Command, exp.Into, exp.Lock)
+_UNSAFE_FUNCTIONS = {
+    "pg_sleep", "pg_sleep_for", "pg_sleep_until", "pg_terminate_backend", "pg_cancel_backend",
+    "set_config", "nextval", "setval", "pg_advisory_lock", "pg_advisory_xact_lock",
+    "lo_import", "lo_export", "pg_read_file", "pg_read_binary_file", "pg_ls_dir",
+    "dblink", "dblink_exec", "pg_reload_conf", "pg_rotate_logfile",
+}
+
+
+def _ident(node: exp.Identifier) -> str:
+    """PostgreSQL 的識別字折疊：加引號保留大小寫，未加引號轉小寫"""
+    return node.this if node.quoted else node.this.lower()
+
+
+def _suggest(name: str, candidates) -> str:
+    match = difflib.get_close_matches(name.lower(), [c.lower() for c in candidates], n=1, cutoff=0.6)
+    if not match:
+        return ""
+    real = next(c for c in candidates if c.lower() == match[0])
+    return f'; did you mean "{real}"?'
+
+
+class SchemaIndex:
+    """{table: {columns}}，由 db_overview（schema catalog）建立"""
+
+    def __init__(self, db_overview: Optional[Dict[str, Any]] = None, schema: str = "public"):
+        self.schema = schema
+        self.tables: Dict[str, Set[str]] = {
+            t["name"]: {c["name"] for c in t.get("columns", [])}
+            for t in (db_overview or {}).get("tables", [])
+        }
+
+    def __bool__(self):
+        return bool(self.tables)
+
+
+def _read_only_issues(statements: List[exp.Expression]) -> List[str]:
+    if len(statements) != 1:
+        return [f"ReadOnlyViolation: expected one statement, got {len(statements)}"]
+    tree = statements[0]
+    issues = []
+    if not isinstance(tree, exp.Query):
+        issues.append(f"ReadOnlyViolation: {tree.key.upper()} statement is not allowed; only SELECT / WITH")
+    for node in tree.find_all(*_WRITE_NODES):
+        if node is not tree:
+            issues.append(f"ReadOnlyViolation: {node.key.upper()} is not allowed in a read-only query")
+    for fn in tree.find_all(exp.Func):
+        name = (fn.name if isinstance(fn, exp.Anonymous) else fn.sql_name()).lower()
+        if name in _UNSAFE_FUNCTIONS:
+            issues.append(f"ReadOnlyViolation: function {name}() has side effects")
+    return issues
+
+
+def _source_columns(scope: Scope, alias: str, schema: SchemaIndex) -> Optional[Set[str]]:
+    """scope 中某個來源可提供的欄位；無法確定（表函式、其他 schema、SELECT *）時回傳 None"""
+    source = scope.sources.get(alias)
+    if isinstance(source, exp.Table):
+        if not isinstance(source.this, exp.Identifier) or (source.db and source.db != schema.schema):
+            return None
+        return schema.tables.get(_ident(source.this))
+    if isinstance(source, Scope):
+        if any(isinstance(s, exp.Star) or (isinstance(s, exp.Column) and isinstance(s.this, exp.Star))
+               for s in getattr(source.expression, "selects", [])):
+            return None
+        return set(source.expression.named_selects)
+    return None
+
+
+def _identifier_issues(tree: exp.Expression, schema: SchemaIndex) -> List[str]:
+    issues: List[str] = []
+    try:
+        scopes = traverse_scope(tree)
+    except SqlglotError:
+        return issues
+
+    for scope in scopes:
+        # 1) 資料表
+        for alias, source in scope.sources.items():
+            if not isinstance(source, exp.Table) or not isinstance(source.this, exp.Identifier):
+                continue
+            if source.db and source.db != schema.schema:
+                continue
+            name = _ident(source.this)
+            if name not in schema.tables and name not in scope.cte_sources:
+                issues.append(f'UndefinedTable: relation "{name}" does not exist'
+                              f'{_suggest(name, schema.tables)}')
+
+        # 2) 欄位
+        # ORDER BY / GROUP BY / HAVING 可引用 SELECT 中的別名（與欄位相同的識別字折疊規則）
+        aliases = {_ident(s.args["alias"]) for s in getattr(scope.expression, "selects", [])
+                   if isinstance(s, exp.Alias) and isinstance(s.args.get("alias"), exp.Identifier)}
+        for col in scope.columns:
+            if not isinstance(col.this, exp.Identifier):
+                continue
+            # 只檢查直接屬於此 scope 的欄位（子查詢的欄位由子 scope 處理）
+            if col.find_ancestor(exp.Query) is not scope.expression:
+                continue
+            name = _ident(col.this)
+            if col.table:
+                cols = _source_columns(scope, col.table, schema)
+                if cols is not None and name not in cols:
+                    source = scope.sources[col.table]
+                    owner = _ident(source.this) if isinstance(source, exp.Table) else col.table
+                    issues.append(f'UndefinedColumn: column {col.table}."{name}" does not exist in "{owner}"'
+                                  f'{_suggest(name, cols)}')
+                continue
+            if name in aliases:
+                continue
+            # 由內而外找來源（相關子查詢可引用外層欄位）；任何一層無法確定就放行
+            # 與來源別名同名的未限定名稱是整列參照（如 json_agg(t) FROM users t），不是欄位
+            candidates, known, s = set(), True, scope
+            while s is not None:
+                if any(name in (a, a.lower()) for a in s.sources):
+                    known = False
+                    break
+                provided = [_source_columns(s, a, schema) for a in s.sources]
+                if any(p is None for p in provided):
+                    known = False
+                    break
+                candidates.update(*provided)
+                s = s.parent if s.is_subquery else None
+            if not known or not candidates or name in candidates:
+                continue
+            issues.append(f'UndefinedColumn: column "{name}" does not exist{_suggest(name, candidates)}')
+    return list(dict.fromkeys(issues))
+
+
+def analyze_sql(sql: str, db_overview: Optional[Dict[str, Any]] = None,
+                dialect: str = "postgres") -> Dict[str, Any]:
+    """回傳 {"safe", "valid", "issues", "warnings", "tables", "error"}；error 為可直接回饋給 SQL 代理的訊息"""
+    result = {"safe": True, "valid": True, "issues": [], "warnings": [], "tables": [], "error": ""}
+    try:
+        statements = [s for s in sqlglot.parse(sql, read=dialect) if s is not None]
+    except SqlglotError as e:
+        # 解析器不支援的語法不代表資料庫也不支援，交給 PG 判斷
+        result["warnings"].append(f"ParseError: {str(e).splitlines()[0]}")
+        return result
+
+    issues = _read_only_issues(statements)
+    if issues:
+        result.update(safe=False, valid=False, issues=issues, error="Refused: " + "; ".join(issues))
+        return result
+
+    tree = statements[0]
+    result["tables"] = sorted({t.name for t in tree.find_all(exp.Table) if t.name})
+    schema = SchemaIndex(db_overview)
+    if schema:
+        issues = _identifier_issues(tree, schema)
+        if issues:
+            result.update(valid=False, issues=issues, error="; ".join(issues))
+    return result
@@ -0,0 +1,104 @@
+# sql_preflight.py — 執行前的 EXPLAIN 檢查與成本閘門
+# 生成的 SQL 先以 EXPLAIN (FORMAT JSON) 規劃（不執行）：
+#   - 不存在的表/欄位在規劃階段就會報錯（UndefinedTable / UndefinedColumn），不必等到全表掃描
+#   - 取得估計成本與列數；超過 PREFLIGHT_MAX_COST 時依 PREFLIGHT_COST_ACTION 處理：
+#       rewrite：回報昂貴節點，交回 SQL 代理改寫（走既有重試流程）
+#       reject ：直接拒絕，不再重試
+#       warn   ：只印警告，照常執行
+#   - 與實際查詢共用同一個交易；另以 SET LOCAL statement_timeout 限制執行時間（不受 PREFLIGHT 開關影響）
+
+import os, json, threading
+from typing import List, Dict, Any
+
+from sqlalchemy import text
+
+PREFLIGHT_ENABLED = os.getenv("PREFLIGHT", "1") != "0"
+PREFLIGHT_MAX_COST = float(os.getenv("PREFLIGHT_MAX_COST", "1000000"))   # 0 = 不設成本上限
+PREFLIGHT_COST_ACTION = os.getenv("PREFLIGHT_COST_ACTION", "rewrite")    # rewrite | reject | warn
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "30000"))  # 0 = 不限制
+
+
+class PreflightError(Exception):
+    """成本閘門擋下的查詢；訊息會作為 SQL 代理的錯誤回饋"""
+
+
+class CostLimitExceeded(PreflightError):
+    pass
+
+
+class QueryRejected(PreflightError):
+    pass
+
+
+def apply_statement_timeout(conn, timeout_ms: int = SQL_STATEMENT_TIMEOUT_MS):
+    """在目前交易內設定 statement_timeout（交易結束即還原，連線池中的其他使用者不受影響）"""
+    if timeout_ms > 0:
+        conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+
+
+def expensive_nodes(plan: Dict[str, Any], top: int = 3) -> List[Dict[str, Any]]:
+    """攤平計畫樹，回傳自身成本（Total Cost 減去子節點）最高的節點"""
+    nodes = []
+
+    def walk(node):
+        children = node.get("Plans") or []
+        own = node.get("Total Cost", 0.0) - sum(c.get("Total Cost", 0.0) for c in children)
+        nodes.append({"node": node.get("Node Type"), "relation": node.get("Relation Name"),
+                      "rows": node.get("Plan Rows"), "cost": round(own, 1)})
+        for c in children:
+            walk(c)
+
+    walk(plan)
+    return sorted(nodes, key=lambda n: -n["cost"])[:top]
+
+
+class SqlPreflight:
+    def __init__(self, max_cost: float = PREFLIGHT_MAX_COST, action: str = PREFLIGHT_COST_ACTION):
+        if action not in ("rewrite", "reject", "warn"):
+            raise ValueError(f"Unknown PREFLIGHT_COST_ACTION: {action}")
+        self.max_cost = max_cost
+        self.action = action
+        self._lock = threading.Lock()
+        self.counts = {"checked": 0, "plan_errors": 0, "over_cost": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def explain(self, conn, sql: str) -> Dict[str, Any]:
+        """EXPLAIN (FORMAT JSON)，回傳最上層計畫節點；SQL 錯誤直接以原本的 DB 例外拋出"""
+        self._count("checked")
+        try:
+            raw = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        except Exception:
+            self._count("plan_errors")
+            raise
+        doc = json.loads(raw) if isinstance(raw, str) else raw
+        return doc[0]["Plan"]
+
+    def check(self, conn, sql: str) -> Dict[str, Any]:
+        """在執行查詢的同一交易內規劃；超過成本上限時依 action 拋出 PreflightError"""
+        plan = self.explain(conn, sql)
+        cost, rows = plan.get("Total Cost", 0.0), plan.get("Plan Rows", 0)
+        info = {"cost": cost, "rows": rows}
+        if not self.max_cost or cost <= self.max_cost:
+            return info
+
+        self._count("over_cost")
+        hot = ", ".join(
+            f"{n['node']}{' on ' + n['relation'] if n['relation'] else ''} (rows≈{n['rows']}, cost≈{n['cost']})"
+            for n in expensive_nodes(plan))
+        msg = (f"estimated cost {cost:.0f} exceeds limit {self.max_cost:.0f} (rows≈{rows}); "
+               f"most expensive steps: {hot}")
+        if self.action == "reject":
+            raise QueryRejected(msg)
+        if self.action == "rewrite":
+            raise CostLimitExceeded(msg + ". Rewrite the SQL to read less data: add a selective date range "
+                                          "filter, aggregate before joining large tables, and avoid joining fact "
+                                          "tables on high-cardinality text keys.")
+        print(f"[warn] preflight: {msg}")
+        return info
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# test_plan_cache.py - 計畫快取的離線測試（不需資料庫 / API）
+# python test_plan_cache.py 或 pytest test_plan_cache.py
+
+import os
+import tempfile
+
+from plan_cache import PlanCache, normalize, rebind_sql, unbound_dates
+
+RETENTION_Q = "請給我 {start} 到 {end} 期間首次登入的新玩家，分析他們首日遊戲時長與後續 7 日留存的關係"
+# 後續 7 日的區間由 LLM 從參數推算（+7 天），不是參數本身的字面值
+RETENTION_SQL = ('SELECT COUNT(*) FROM public."SessionActive" '
+                 'WHERE "LoginDate" BETWEEN 20241001 AND 20241007 '
+                 'AND "UDID" IN (SELECT "UDID" FROM public."SessionActive" '
+                 'WHERE "LoginDate" BETWEEN 20241008 AND 20241014)')
+
+
+def _cache():
+    return PlanCache(path=os.path.join(tempfile.mkdtemp(), "plan_cache.sqlite"))
+
+
+def test_derived_dates_are_not_cached():
+    """SQL 含有參數以外的日期時不快取，避免換日期後沿用過期的推算值"""
+    cache = _cache()
+    q = RETENTION_Q.format(start="2024-10-01", end="2024-10-07")
+    _, params = normalize(q)
+    assert unbound_dates(RETENTION_SQL, params) == ["20241008", "20241014"]
+    assert cache.store(q, RETENTION_SQL, {"tables": []}) is False
+    assert cache.lookup(RETENTION_Q.format(start="2024-11-01", end="2024-11-07")) is None
+
+
+def test_rebind_refuses_derived_dates():
+    """舊版快取中已有此類 SQL 時，重新綁定回傳 None 而不是部分替換的 SQL"""
+    _, old = normalize(RETENTION_Q.format(start="2024-10-01", end="2024-10-07"))
+    _, new = normalize(RETENTION_Q.format(start="2024-11-01", end="2024-11-07"))
+    assert rebind_sql(RETENTION_SQL, old, new) is None
+
+
+def test_fully_bound_plan_is_rebound():
+    cache = _cache()
+    q = "請給我 2024-10-01 到 2024-10-31 台灣(TW) 的 SessionActive 筆數與每日趨勢"
+    sql = ('SELECT "LoginDate", COUNT(*) FROM public."SessionActive" '
+           "WHERE \"LoginDate\" BETWEEN 20241001 AND 20241031 AND \"Country\" = 'TW' GROUP BY 1")
+    assert cache.store(q, sql, {"tables": [{"name": "SessionActive"}]}) is True
+    hit = cache.lookup("請給我 2024-11-01 到 2024-11-30 美國(US) 的 SessionActive 筆數與每日趨勢")
+    assert hit is not None
+    assert "BETWEEN 20241101 AND 20241130" in hit["sql"] and "'US'" in hit["sql"]
+
+
+def main():
+    tests = [v for k, v in sorted(globals().items()) if k.startswith("test_") and callable(v)]
+    failed = 0
+    for t in tests:
+        try:
+            t()
+            print(f"✅ {t.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {t.__name__}: {e}")
+    print(f"{len(tests) - failed}/{len(tests)} passed")
+    return failed
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,235 @@
+# vector_index.py — cards 集合的本地向量索引
+# 取代每次查詢都走 Atlas $vectorSearch 的網路往返：
+# - flat：numpy 內積（embedding 已正規化 = cosine），幾百～幾萬張 card 時即為次毫秒 top-k
+# - hnsw：選用 hnswlib，語料很大時使用（未安裝時退回 flat）
+# 向量存於 .npy 並以 memory-map 開啟，card 文字/metadata 存於旁邊的 JSON；
+# 依 updatedAt 增量同步（選用 change stream 觸發立即同步），沒有 Mongo 連線時也能直接載入既有索引；
+# 同步失敗時同樣等 sync_interval 才重試，Mongo 連不上時查詢不會每次都卡在連線逾時。
+# ids / docs / 向量矩陣 / hnsw 以單一 IndexSnapshot 整組替換，查詢端取一次快照即可，不會讀到新舊混雜的狀態。
+# pip install numpy [hnswlib]
+
+import os, json, time, threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional, NamedTuple
+
+import numpy as np
+
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", ".cache/vector_index")
+VECTOR_INDEX_BACKEND = os.getenv("VECTOR_INDEX_BACKEND", "flat")          # flat | hnsw
+VECTOR_INDEX_SYNC_INTERVAL = float(os.getenv("VECTOR_INDEX_SYNC_INTERVAL", "60"))  # 秒
+
+_FIELDS = ("title", "type", "text", "meta")
+
+
+class IndexSnapshot(NamedTuple):
+    ids: List[str]
+    docs: List[Dict[str, Any]]
+    mat: Optional[np.ndarray]
+    hnsw: Any
+    synced_at: float
+
+
+_EMPTY = IndexSnapshot([], [], None, None, 0.0)
+
+
+class LocalVectorIndex:
+    """memory-mapped 的 card 向量索引；search() 回傳與 reference_search 相同格式的 card"""
+
+    def __init__(self, path: str = VECTOR_INDEX_PATH, backend: str = VECTOR_INDEX_BACKEND,
+                 sync_interval: float = VECTOR_INDEX_SYNC_INTERVAL):
+        self.base = Path(path)
+        self.base.parent.mkdir(parents=True, exist_ok=True)
+        self.vec_path = self.base.with_suffix(".npy")
+        self.meta_path = self.base.with_suffix(".json")
+        self.hnsw_path = self.base.with_suffix(".hnsw")
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_sync = 0.0
+        self._retry_at = 0.0
+        self._watcher: Optional[threading.Thread] = None
+        self._snap: IndexSnapshot = _EMPTY
+        self._load()
+
+    def snapshot(self) -> IndexSnapshot:
+        """目前索引的一致快照（同步只會整組替換，不會原地修改）"""
+        return self._snap
+
+    @property
+    def ids(self) -> List[str]:
+        return self._snap.ids
+
+    @property
+    def docs(self) -> List[Dict[str, Any]]:
+        return self._snap.docs
+
+    @property
+    def synced_at(self) -> float:
+        return self._snap.synced_at
+
+    # ---------- 持久化 ----------
+    def _load(self):
+        if not (self.vec_path.exists() and self.meta_path.exists()):
+            return
+        try:
+            meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+            mat = np.load(self.vec_path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            print(f"[warn] vector index load failed, will rebuild: {e}")
+            return
+        self._snap = IndexSnapshot(meta["ids"], meta["docs"], mat, self._open_hnsw(mat, build=False),
+                                   meta.get("synced_at", 0.0))
+
+    def _save(self, ids: List[str], docs: List[Dict[str, Any]], mat: np.ndarray, synced_at: float):
+        # 先寫暫存檔再 os.replace，讀取端不會看到半寫入的檔案
+        tmp_vec = self.vec_path.with_suffix(".npy.tmp")
+        with open(tmp_vec, "wb") as f:
+            np.save(f, mat)
+        os.replace(tmp_vec, self.vec_path)
+        tmp_meta = self.meta_path.with_suffix(".json.tmp")
+        tmp_meta.write_text(json.dumps({"ids": ids, "docs": docs, "synced_at": synced_at,
+                                        "dim": int(mat.shape[1]) if mat.ndim == 2 else 0},
+                                       ensure_ascii=False, default=str), encoding="utf-8")
+        os.replace(tmp_meta, self.meta_path)
+
+    def _open_hnsw(self, mat: np.ndarray, build: bool):
+        if self.backend != "hnsw" or mat is None or len(mat) == 0:
+            return None
+        try:
+            import hnswlib
+        except ImportError:
+            print("[warn] hnswlib not installed; falling back to flat index")
+            self.backend = "flat"
+            return None
+        idx = hnswlib.Index(space="ip", dim=int(mat.shape[1]))
+        if not build and self.hnsw_path.exists():
+            idx.load_index(str(self.hnsw_path), max_elements=len(mat))
+        else:
+            idx.init_index(max_elements=len(mat), ef_construction=200, M=16)
+            idx.add_items(np.asarray(mat), np.arange(len(mat)))
+            idx.save_index(str(self.hnsw_path))
+        idx.set_ef(64)
+        return idx
+
+    # ---------- 同步 ----------
+    def sync(self, col) -> int:
+        """依 updatedAt 增量同步；回傳新增/更新/刪除的 card 數（0 表示未變更，不重寫檔案）"""
+        with self._lock:
+            snap = self._snap
+            live_ids = {str(d["_id"]) for d in col.find({}, {"_id": 1})}
+            query: Dict[str, Any] = {"embedding": {"$exists": True}}
+            if snap.synced_at and snap.mat is not None:
+                query["updatedAt"] = {"$gt": snap.synced_at}
+            projection = {f: 1 for f in _FIELDS}
+            projection.update({"embedding": 1, "updatedAt": 1})
+            updated = {str(d["_id"]): d for d in col.find(query, projection)}
+
+            removed = [i for i in snap.ids if i not in live_ids]
+            self._dirty = False
+            self._last_sync = time.time()
+            if not updated and not removed:
+                return 0
+
+            ids, docs, rows = [], [], []
+            for pos, cid in enumerate(snap.ids):
+                if cid in live_ids and cid not in updated:
+                    ids.append(cid); docs.append(snap.docs[pos]); rows.append(snap.mat[pos])
+            synced_at = snap.synced_at
+            for cid, d in updated.items():
+                ids.append(cid)
+                docs.append({f: d.get(f) for f in _FIELDS})
+                rows.append(np.asarray(d["embedding"], dtype=np.float32))
+                synced_at = max(synced_at, float(d.get("updatedAt") or 0))
+
+            mat = np.vstack(rows).astype(np.float32) if rows else np.zeros((0, 0), dtype=np.float32)
+            if len(mat):
+                norms = np.linalg.norm(mat, axis=1, keepdims=True)
+                mat = mat / np.where(norms == 0, 1, norms)
+            self._save(ids, docs, mat, synced_at)
+            mat = np.load(self.vec_path, mmap_mode="r")
+            self._snap = IndexSnapshot(ids, docs, mat, self._open_hnsw(mat, build=True), synced_at)
+            return len(updated) + len(removed)
+
+    def maybe_sync(self, col) -> int:
+        """距上次同步超過 sync_interval、索引為空或 change stream 標記變更時才同步；
+        失敗後 sync_interval 內不再重試"""
+        if col is None:
+            return 0
+        now = time.time()
+        if now < self._retry_at:
+            return 0
+        if self._snap.mat is not None and not self._dirty and now - self._last_sync < self.sync_interval:
+            return 0
+        try:
+            return self.sync(col)
+        except Exception as e:
+            self._retry_at = time.time() + self.sync_interval
+            print(f"[warn] vector index sync failed, retry in {self.sync_interval:.0f}s: {e}")
+            return 0
+
+    def watch(self, col):
+        """選用：以 change stream 監聽 cards 集合，有變更時標記下次查詢前同步（需 replica set / Atlas）"""
+        if self._watcher is not None:
+            return
+
+        def run():
+            try:
+                with col.watch() as stream:
+                    for _ in stream:
+                        self._dirty = True
+            except Exception as e:
+                print(f"[warn] change stream stopped: {e}")
+            finally:
+                self._watcher = None
+
+        self._watcher = threading.Thread(target=run, name="vector-index-watch", daemon=True)
+        self._watcher.start()
+
+    # ---------- 查詢 ----------
+    def __len__(self) -> int:
+        return len(self._snap.ids)
+
+    def search(self, query_vec, k: int = 6, card_type: Optional[str] = None,
+               snapshot: Optional[IndexSnapshot] = None) -> List[Dict[str, Any]]:
+        """top-k 內積搜尋；card_type 會在評分前先過濾。可傳入 snapshot 讓呼叫端與其他讀取共用同一份索引"""
+        snap = snapshot or self._snap
+        ids, docs, mat, hnsw = snap.ids, snap.docs, snap.mat, snap.hnsw
+        if mat is None or len(docs) == 0:
+            return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+
+        allowed = None
+        if card_type is not None:
+            allowed = np.fromiter((d.get("type") == card_type for d in docs), dtype=bool, count=len(docs))
+            if not allowed.any():
+                return []
+
+        if hnsw is not None:
+            n = int(allowed.sum()) if allowed is not None else len(docs)
+            kw = {"filter": lambda i: bool(allowed[i])} if allowed is not None else {}
+            labels, dists = hnsw.knn_query(q, k=min(k, n), **kw)
+            hits = [(int(i), 1.0 - float(d)) for i, d in zip(labels[0], dists[0])]
+        else:
+            cand = np.flatnonzero(allowed) if allowed is not None else np.arange(len(docs))
+            scores = np.asarray(mat[cand] @ q) if allowed is not None else np.asarray(mat @ q)
+            kk = min(k, len(cand))
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            top = top[np.argsort(-scores[top])]
+            hits = [(int(cand[i]), float(scores[i])) for i in top]
+
+        return [{**docs[i], "_id": ids[i], "score": s} for i, s in hits]
+
+
+_index: Optional[LocalVectorIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_local_index() -> LocalVectorIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LocalVectorIndex()
+    return _index